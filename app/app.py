@@ -2,10 +2,33 @@ from flask import Flask, jsonify, request, render_template, Response, redirect,
 from flask.json import JSONEncoder
 from flask_pymongo import PyMongo
 from flask_moment import Moment
-from bson import ObjectId
+from bson import ObjectId, json_util
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 import pymongo
+import pymongo.errors
+import archive
+import base64
+import collections
 import datetime
+import json
 import os
+import re
+import tempfile
+import time
+
+import cache
+import database
+import dispatcher
+import events
+import indexes
+import ingest
+import leaderboard
+import metrics
+import outbox
+import reports
+import scorestore
+import stats
+import streaming
 
 
 class CustomJSONEncoder(JSONEncoder):
@@ -24,22 +47,136 @@ class CustomJSONEncoder(JSONEncoder):
 app = Flask(__name__)
 app.json_encoder = CustomJSONEncoder
 
-mongo_host = os.environ.get('MONGO_HOST', '127.0.0.1')
-app.config["MONGO_URI"] = "mongodb://{}:27017/marketcity".format(mongo_host)
+app.config["MONGO_URI"] = database.mongo_uri()
 
 #app.debug = True
 
-mongo = PyMongo(app)
+# per process metrics are written here and added up by /metrics, see metrics.py
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'marketcity-metrics'))
+# log requests slower than this many seconds with the mongo commands they ran, 0 to turn off
+METRICS_SLOW_REQUEST = float(os.environ.get('METRICS_SLOW_REQUEST', '0'))
+metrics_registry = metrics.Registry(METRICS_DIR, 'web')
+mongo_command_metrics = metrics.CommandMetrics(metrics_registry)
+app.wsgi_app = metrics.RequestMetrics(app.wsgi_app, metrics_registry, mongo_command_metrics, METRICS_SLOW_REQUEST)
+
+# connect on first use, so a client made before uWSGI forks its workers is never used
+# pool size and timeouts come from the environment, see database.py
+mongo_pool_stats = database.PoolStats()
+mongo = PyMongo(app, connect=False, event_listeners=[mongo_pool_stats, mongo_command_metrics], **database.client_options())
+
+
+def pool_metrics(registry):
+    pool = mongo_pool_stats.snapshot()
+    registry.set('marketcity_mongo_pool_checkouts_total', value=pool['checkouts'])
+    registry.set('marketcity_mongo_pool_checkout_timeouts_total', value=pool['timeouts'])
+    registry.set('marketcity_mongo_pool_checkout_wait_seconds_total', value=pool['waitSeconds'])
+
+
+metrics_registry.define('marketcity_mongo_pool_checkouts_total', 'counter', 'Connections checked out of the mongo pool')
+metrics_registry.define('marketcity_mongo_pool_checkout_timeouts_total', 'counter', 'Checkouts that timed out waiting for a connection')
+metrics_registry.define('marketcity_mongo_pool_checkout_wait_seconds_total', 'counter', 'Seconds spent waiting to check out a connection')
+metrics_registry.collector(pool_metrics)
+
+# the venue this server runs at, stored on every score and player it takes
+# a central server keeps the venue each synced score and signup came from
+VENUE = os.environ.get('VENUE', 'default')
+
+# reports can read from secondaries e.g. REPORT_READ_PREFERENCE=secondaryPreferred
+REPORT_READ_PREFERENCE = database.read_preference(os.environ.get('REPORT_READ_PREFERENCE'))
+# durability of scores and sync rows e.g. SCORE_WRITE_CONCERN=w=1 SYNC_WRITE_CONCERN=majority,j=true
+SCORE_WRITE_CONCERN = database.write_concern(os.environ.get('SCORE_WRITE_CONCERN'))
+SYNC_WRITE_CONCERN = database.write_concern(os.environ.get('SYNC_WRITE_CONCERN'))
+
+report_db = mongo.db.with_options(read_preference=REPORT_READ_PREFERENCE)
+
+# seconds GET responses of /station/<station>/status, /scores and /next/<station> are cached, see cache.py
+# uwsgi shares the cache between the workers, set CACHE_BACKEND=local only when one process serves the app
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'uwsgi')
+CACHE_TTL = float(os.environ.get('CACHE_TTL', '2'))
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', '1000'))
+response_cache = cache.ResponseCache(
+    cache.backend(CACHE_BACKEND, CACHE_MAX_ENTRIES, os.environ.get('CACHE_REDIS_URL', 'redis://localhost:6379/0')),
+    CACHE_TTL,
+    metrics_registry)
+sync_queue = mongo.db.get_collection('sync', write_concern=SYNC_WRITE_CONCERN)
+sync_outbox = outbox.Outbox(sync_queue, mongo.db.sync_dead)
+
+# set to 0 to manage indexes by hand with `flask ensure-indexes`
+MONGO_ENSURE_INDEXES = os.environ.get('MONGO_ENSURE_INDEXES', '1') == '1'
+# set to 1 on a server that gets the data of many venues, for reports of one venue, see indexes.VENUE_INDEXES
+VENUE_INDEXES = os.environ.get('VENUE_INDEXES') == '1'
+
+# how scores are stored, collection (one document per score) or bucket (one document per station per hour)
+# in bucket mode players only keep their bestScore, plays and lastScore instead of every score
+SCORE_STORAGE = os.environ.get('SCORE_STORAGE', 'collection')
+score_store = scorestore.score_store(mongo.db.with_options(write_concern=SCORE_WRITE_CONCERN), SCORE_STORAGE)
+report_store = scorestore.score_store(report_db, SCORE_STORAGE)
+
+# Content-Encodings the csv, pipe and json exports of /scoresraw and /players are sent with
+# when the client accepts one, zstd needs the zstandard package, empty to send them uncompressed
+EXPORT_ENCODINGS = [encoding for encoding in os.environ.get('EXPORT_ENCODINGS', 'zstd,gzip').split(',') if encoding]
+# rows joined into each chunk written to the client, and the compression level (default of each encoding)
+EXPORT_BATCH_ROWS = int(os.environ.get('EXPORT_BATCH_ROWS', '500'))
+EXPORT_COMPRESS_LEVEL = int(os.environ.get('EXPORT_COMPRESS_LEVEL', '0')) or None
+# rows in each row group of ?output=parquet, which needs the pyarrow package
+EXPORT_PARQUET_ROWS = int(os.environ.get('EXPORT_PARQUET_ROWS', '10000'))
+
+# `flask archive` moves scores, leaderboard entries, players and sync dead letters older than
+# ARCHIVE_DAYS into gzip files in ARCHIVE_DIR, /scores, /scoresraw and /players read them back
+# for ranges that reach that far, players stay in mongo with an empty scores array
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archive'))
+ARCHIVE_DAYS = int(os.environ.get('ARCHIVE_DAYS', '30'))
+report_archive = archive.Archive(ARCHIVE_DIR)
+
+# width of the score histogram buckets of /stats
+STATS_SCORE_BUCKET = int(os.environ.get('STATS_SCORE_BUCKET', '10'))
+
+# how POST /score/<station> writes, direct (before answering) or buffered
+# buffered answers once the score is in a local journal and writes it in the background, see ingest.ScoreBuffer
+INGEST_MODE = os.environ.get('INGEST_MODE', 'direct')
+INGEST_DIR = os.environ.get('INGEST_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ingest'))
+INGEST_BATCH_SIZE = int(os.environ.get('INGEST_BATCH_SIZE', '500'))
+INGEST_INTERVAL = float(os.environ.get('INGEST_INTERVAL', '0.05'))
+# fsync every score, survives losing power as well as the process
+INGEST_FSYNC = os.environ.get('INGEST_FSYNC', '0') == '1'
+# longest a score report waits for other processes to write their buffered scores
+INGEST_READ_WAIT = float(os.environ.get('INGEST_READ_WAIT', '1'))
 
 moment = Moment(app)
 
+# stations waiting on /station/<station>/player are woken up when their next player changes
+station_events = events.StationEvents()
+# seconds between checks for changes made by other processes
+STATION_EVENTS_RECHECK = int(os.environ.get('STATION_EVENTS_RECHECK', 5))
+# set to 1 when mongo runs as a replica set to be told of changes straight away
+STATION_CHANGE_STREAM = os.environ.get('STATION_CHANGE_STREAM') == '1'
+# longest ?wait= a long poll of /station/<station>/player may ask for, it holds a worker thread all along
+STATION_WAIT_MAX = int(os.environ.get('STATION_WAIT_MAX', '25'))
+# set to 1 for operator pages to reload from /station/<station>/player/events instead of
+# every 10 seconds, each open page holds a worker thread for its stream
+STATION_PAGE_EVENTS = os.environ.get('STATION_PAGE_EVENTS') == '1'
+
+
+def player_assigned(station):
+    station_events.publish(station)
+    response_cache.invalidate('next:{}'.format(station), 'stations', 'players')
+
+
+# players waiting to play in the order they are served, see dispatcher.py
+# set AUTO_DISPATCH to 1 to give the next player to a station as soon as it is free
+# instead of waiting for an operator to pick one on /next/<station>
+AUTO_DISPATCH = os.environ.get('AUTO_DISPATCH', '0') == '1'
+station_dispatcher = dispatcher.Dispatcher(mongo.db, player_assigned)
+
 station_schema = ['status']
 # Players that sign up to play via the /signup endpoint look like this in the database
 # they are uniquely identified by email field on the _id key
 # waiting field is to signify that a play has signed up (either once or again) and is waiting to play
 player_schema = ['email','firstName','lastName','displayName','phone','postcode','hand']
 player_schema_hidden = ['waiting', 'started', 'updatedAt']
-player_presenter = ['email','firstName','lastName','displayName','phone','postcode','updatedAt','hand','scores']
+player_presenter = ['email','firstName','lastName','displayName','phone','postcode','updatedAt','hand','scores','bestScore','plays','lastScore']
+# fields of each line of the pipe and csv players reports
+player_line_presenter = ['updatedAt','hand','email','phone','postcode','displayName','firstName','lastName']
 
 # Scores are populated by the game using the email field of each player
 # there can be many scores per player
@@ -51,13 +188,143 @@ score_presenter = ['email','displayName','score','easteregg']
 # there can only be one next player per station and a player can only play one game at a time
 # each station is uniquely identified by an integer and is stored in _id key
 next_player_schema = ['email','displayName']
-next_player_schema_hidden = ['isReady']
+next_player_schema_hidden = ['isReady', 'started', 'lease', 'leaseUntil']
 
 ISO8601_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
 
 def parse_isodate(date_string):
     return datetime.datetime.strptime(date_string, ISO8601_FORMAT)
 
+
+# Queries behind the reports, kept together so explain-queries checks exactly what the routes run
+def venue_of(data):
+    # venue of a score or signup synced from another server, this server's own otherwise
+    return data.get('venue') or VENUE
+
+
+def report_venues():
+    # ?venue=a,b limits a report to those venues, every venue by default
+    venues = [venue for venue in request.args.get('venue', '').split(',') if venue]
+    return venues or None
+
+
+def waiting_players_query(start, end):
+    # players signed up between start and end still waiting to play
+    return {
+        'updatedAt': {
+            '$gte': start,
+            '$lt': end
+        },
+        'waiting': True
+    }
+
+
+def find_waiting_players(start, end):
+    # newest first
+    return mongo.db.players.find(waiting_players_query(start, end)).sort('updatedAt', pymongo.DESCENDING)
+
+
+def find_station_overview(stations=None):
+    # status, next player and ready flag of the stations with one query per collection
+    # every station with a status or a next player when stations is None
+    query = {'_id': {'$in': stations}} if stations is not None else {}
+    statuses = {doc['_id']: doc.get('status') for doc in mongo.db.station.find(query)}
+    next_players = {doc['_id']: doc for doc in mongo.db.next_player.find(query)}
+    emails = [doc.get('email') for doc in next_players.values()]
+    players = {doc['_id']: doc for doc in mongo.db.players.find({'_id': {'$in': emails}}, {'displayName': 1, 'hand': 1})}
+
+    if stations is None:
+        stations = sorted(set(statuses) | set(next_players), key=str)
+
+    overview = []
+    for station in stations:
+        doc = {'station': station, 'status': statuses.get(station)}
+        next_player = next_players.get(station)
+        if next_player:
+            player = players.get(next_player.get('email'), {})
+            doc.update({
+                'email': next_player.get('email'),
+                'displayName': player.get('displayName', next_player.get('displayName', '')),
+                'hand': player.get('hand', 'right'),
+                'started': next_player.get('started', False),
+                'isReady': next_player.get('isReady', False)
+            })
+        overview.append(doc)
+    return overview
+
+
+# store and db can be given to run the same queries with another driver e.g. motor in asgi.py
+def find_scores(start, end, sort, skip=0, limit=0, after=None, fields=score_presenter, store=None, venues=None):
+    extra = keyset_query(sort, after) if after else None
+    return (store or report_store).find(start, end, keyset_sort(sort), skip, limit, extra, fields, venues)
+
+
+def find_players(start, end, sort, skip=0, limit=0, after=None, fields=player_presenter, db=None, venues=None):
+    query = {
+        'updatedAt': {
+            '$gte': start,
+            '$lt': end
+        },
+        # read from the archive instead, see archive.archive_players
+        'archived': {'$ne': True},
+    }
+    if venues:
+        query['venue'] = {'$in': venues}
+    if after:
+        query = {'$and': [query, keyset_query(sort, after)]}
+    db = report_db if db is None else db
+    return db.players.find(query, reports.projection(fields)).sort(keyset_sort(sort)).skip(skip).limit(limit)
+
+
+def find_archived(name, find, time_of, start, end, sort, skip=0, limit=0, after=None, venues=None):
+    # rows of a report from find(skip, limit), with the archived rows merged in when the range reaches into the archive
+    if not report_archive.partitions(name, start, end):
+        return find(skip, limit)
+    hot = find(0, skip + limit if limit else 0)
+    return report_archive.merge(name, hot, start, end, time_of, keyset_sort(sort), skip, limit, after, venues)
+
+
+# Keyset pagination, the ?after= continuation token holds the sort value and _id
+# of the last row of a page and the next page starts from there using the index
+# instead of skipping over every row before it
+# sorting by the player scores array cannot be continued this way
+KEYSET_UNSUPPORTED = ['scores']
+
+
+def keyset_sort(sort):
+    if sort == '_id' or sort in KEYSET_UNSUPPORTED:
+        return [(sort, pymongo.DESCENDING)]
+    # _id breaks ties so every row has a unique position
+    return [(sort, pymongo.DESCENDING), ('_id', pymongo.DESCENDING)]
+
+
+def keyset_query(sort, after):
+    value, last_id = after
+    if sort == '_id':
+        return {'_id': {'$lt': last_id}}
+    return {
+        '$or': [
+            {sort: {'$lt': value}},
+            {sort: value, '_id': {'$lt': last_id}}
+        ]
+    }
+
+
+def encode_after(doc, sort):
+    if sort in KEYSET_UNSUPPORTED:
+        return None
+    token = json_util.dumps([doc.get(sort), doc['_id']])
+    return base64.urlsafe_b64encode(token.encode('utf-8')).decode('ascii')
+
+
+def decode_after(token):
+    # raises ValueError for tokens that were not made by encode_after
+    after = json_util.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+    if not isinstance(after, list) or len(after) != 2:
+        raise ValueError('Invalid continuation token')
+    return after
+
+
 @app.route('/station/<station>', methods=['POST'])
 def station(station):
     if not station:
@@ -75,11 +342,52 @@ def station(station):
             return 'Bad request: Missing {}'.format(param), 400     
         doc[param] = content[param]
 
-    mongo.db.station.save(doc)
+    mongo.db.station.replace_one({'_id': station}, doc, upsert=True)
+    response_cache.invalidate('station:{}'.format(station), 'stations')
     return '', 204
 
 
+@app.route('/stations', methods=['GET'])
+@response_cache.cached('stations', 'players')
+def stations_overview():
+    # status, next player, ready flag and players waiting of every station in one request
+    # ?stations=1,2,3 for some of the stations, ?output=pipe for one station_overview_line per station
+    stations = request.args.get('stations')
+    if stations:
+        stations = [station for station in stations.split(',') if station]
+    else:
+        stations = None
+
+    overview = find_station_overview(stations)
+
+    # players waiting is for the whole venue, any station can take them, the same queue as /queue
+    waiting = len(station_dispatcher.waiting())
+
+    if request.args.get('output') == 'pipe':
+        lines = [reports.station_overview_line(dict(station, waiting=waiting)) for station in overview]
+        return Response(''.join(lines), mimetype='text/text; charset=utf-8')
+
+    return jsonify({'stations': overview, 'waiting': waiting})
+
+
+@app.route('/queue', methods=['GET'])
+def waiting_queue():
+    # players waiting in the order the dispatcher serves them
+    # ?output=pipe for one email|displayName|enqueuedAt line per player
+    waiting = station_dispatcher.waiting()
+    if request.args.get('output') == 'pipe':
+        lines = ['{}|{}|{}\n'.format(player['_id'], player.get('displayName', ''), player['enqueuedAt'].isoformat()) for player in waiting]
+        return Response(''.join(lines), mimetype='text/text; charset=utf-8')
+    return jsonify({'queue': [{
+        'email': player['_id'],
+        'displayName': player.get('displayName', ''),
+        'priority': player.get('priority', 0),
+        'enqueuedAt': player['enqueuedAt']
+    } for player in waiting]})
+
+
 @app.route('/station/<station>/status')
+@response_cache.cached('station:{station}')
 def station_status(station):
     if not station:
         return '', 404
@@ -89,9 +397,37 @@ def station_status(station):
     return result.get('status', 'Waiting for status'), 200
     
 
+def next_player_line(station, mark_ready=True):
+    # returns the line a station reads to know who to play with next and whether they are ready
+    # line is None when there is no player waiting for this station yet
+    next_player = mongo.db.next_player.find_one({'_id':station})
+    if not next_player:
+        return None, False
+
+    is_ready = next_player.get('isReady', False)
+    if mark_ready and not is_ready:
+        # only write when the station sees this player for the first time
+        mongo.db.next_player.update_one({'_id':station}, {'$set':{'isReady':True}})
+        station_events.publish(station)
+        response_cache.invalidate('next:{}'.format(station), 'stations')
+        is_ready = True
+
+    player = mongo.db.players.find_one({'_id': next_player.get('email')})
+    if not player:
+        return None, is_ready
+
+    return reports.station_player_line(player), is_ready
+
+
+def watch_station_events():
+    if STATION_CHANGE_STREAM:
+        station_events.watch(mongo.db.next_player)
+
+
 @app.route('/station/<station>/player', methods=['GET', 'POST'])
 def get_next_player(station):
     # either returns 200 with a result, 204 when successful but no result, or 404 when station not found
+    # GET with ?wait=<seconds> holds the request until the line differs from ?since=<last line> (long poll)
 
     # station has started playing with the next player
     if request.method == 'POST':
@@ -99,31 +435,78 @@ def get_next_player(station):
         # successfully processed reponse but not return any content
         return '', 204
 
-    next_player = mongo.db.next_player.find_one({'_id':station})
-    if next_player:
-        mongo.db.next_player.update_one({'_id':station}, {'$set':{'isReady':True}})
-        player = mongo.db.players.find_one({'_id': next_player.get('email')})
-        return "{0}|{1}|{2}|{3}\n".format(
-                player.get('email'),
-                player.get('displayName' ,''),
-                player.get('hand', 'right'),
-                player.get('started', False)
-            )
+    wait = min(request.args.get('wait', 0, int), STATION_WAIT_MAX)
+    since = request.args.get('since', '').strip()
+
+    version = station_events.version(station)
+    line, is_ready = next_player_line(station)
+
+    if wait > 0:
+        watch_station_events()
+        deadline = time.time() + wait
+        while (line or '').strip() == since and time.time() < deadline:
+            version = station_events.wait(station, version, min(deadline - time.time(), STATION_EVENTS_RECHECK))
+            line, is_ready = next_player_line(station)
+
+    if line:
+        return line
 
     # successfully received reponse but not returning any content
     # because there is no player waiting yet
     return '', 204
 
+
+@app.route('/station/<station>/player/events')
+def next_player_events(station):
+    # Server-Sent Events stream of the line returned by /station/<station>/player
+    # an empty message means there is no player waiting for this station
+    # stations get a message each time the line changes, ?ready=false (operator pages)
+    # does not mark the player as ready and gets a message on every change for the station
+    mark_ready = request.args.get('ready', True, parse_bool)
+    watch_station_events()
+
+    def generate():
+        yield 'retry: {}\n\n'.format(STATION_EVENTS_RECHECK * 1000)
+        version = station_events.version(station)
+        changed = True
+        # always send the current line first
+        last = object()
+        while True:
+            line, is_ready = next_player_line(station, mark_ready)
+            state = line if mark_ready else (line, is_ready)
+            if state != last or (changed and not mark_ready):
+                last = state
+                yield 'data: {}\n\n'.format((line or '').strip())
+            else:
+                # keeps proxies from closing the connection and finds stations that went away
+                yield ': keepalive\n\n'
+
+            latest = station_events.wait(station, version, STATION_EVENTS_RECHECK)
+            changed = latest != version
+            version = latest
+
+    headers = {
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    }
+    return Response(generate(), headers=headers, mimetype='text/event-stream')
+
+
 @app.route('/reset/<station>', methods=['GET'])
 def manage_reset(station):
     # get the next player for this station
     next_player = mongo.db.next_player.find_one({'_id':station})
     if next_player:
         mongo.db.next_player.delete_one({'_id':station})
+        station_events.publish(station)
+        response_cache.invalidate('next:{}'.format(station), 'stations')
+        if AUTO_DISPATCH:
+            station_dispatcher.dispatch([station])
     
     return 'OK', 200
             
 @app.route('/next/<station>', methods=['POST', 'GET'])
+@response_cache.cached('next:{station}', 'players')
 def manage_next_player(station):
     # GET    - return all players waiting to play and the current player waiting to play next for this station
     # POST   - assign a player to a station to play next
@@ -144,30 +527,59 @@ def manage_next_player(station):
                 return 'Bad request: Missing {}'.format(param), 400     
             doc[param] = content[param]
             
-        # get the next player for this station
-        next_player = mongo.db.next_player.find_one({'_id':station})
-
-        if not next_player:
-            mongo.db.next_player.save(doc)
-            mongo.db.players.update_one({'_id': doc['email']}, {'$unset':{'waiting': ''}})
-            mongo.db.players.update_one({'_id': doc['email']}, {'$unset':{'started': ''}})
-        
-        elif next_player['email'] == content['email'] and content['action'] == 'start':
-            mongo.db.players.update_one({'_id': next_player['email']}, {'$unset':{'waiting': ''}})
-            mongo.db.players.update_one({'_id': next_player['email']}, {'$set':{'started': True}})
-            
-        elif next_player['email'] == content['email'] and content['action'] == 'cancel':
-            mongo.db.next_player.delete_one({'_id':station})
-            mongo.db.players.update_one({'_id': next_player['email']}, {'$set':{'waiting': True}})
-            mongo.db.players.update_one({'_id': next_player['email']}, {'$unset':{'started': ''}})
-
-        elif next_player['email'] == content['email'] and content['action'] == 'complete':
-            mongo.db.next_player.delete_one({'_id':station})
-            mongo.db.players.update_one({'_id': next_player['email']}, {'$set':{'waiting': ''}})
-            mongo.db.players.update_one({'_id': next_player['email']}, {'$unset':{'started': True}})            
-            
-        # else already a player waiting so dont do anything
-
+        # each action is a single conditional write on the station so two operators
+        # acting at the same time can never both win, then one write to the player
+        # the winning write leases the station until the player is written, see dispatcher.lease
+        email = doc['email']
+        action = content.get('action')
+        changed = None
+        applied = action
+        held = dispatcher.lease()
+        current = dict(dispatcher.unleased(), _id=station, email=email)
+
+        if action == 'start':
+            changed = mongo.db.next_player.find_one_and_update(current, {'$set': dict(held, started=True)})
+            if changed:
+                mongo.db.players.update_one({'_id': email}, {'$unset': {'waiting': ''}, '$set': {'started': True}})
+                dispatcher.end_lease(mongo.db, station, held)
+
+        elif action == 'cancel':
+            changed = mongo.db.next_player.find_one_and_update(current, {'$set': held})
+            if changed:
+                mongo.db.players.update_one({'_id': email}, {'$set': {'waiting': True}, '$unset': {'started': ''}})
+                mongo.db.next_player.delete_one({'_id': station, 'lease': held['lease']})
+                # the station gets whoever is next before the cancelled player goes back in the queue
+                if AUTO_DISPATCH:
+                    station_dispatcher.dispatch([station])
+                station_dispatcher.enqueue(email, doc['displayName'])
+
+        elif action == 'complete':
+            changed = mongo.db.next_player.find_one_and_update(current, {'$set': held})
+            if changed:
+                mongo.db.players.update_one({'_id': email}, {'$set': {'waiting': ''}, '$unset': {'started': ''}})
+                mongo.db.next_player.delete_one({'_id': station, 'lease': held['lease']})
+                if AUTO_DISPATCH:
+                    station_dispatcher.dispatch([station])
+
+        if not changed:
+            # assign this player unless the station already has a next player
+            try:
+                result = mongo.db.next_player.update_one({'_id': station}, {'$setOnInsert': dict(doc, **held)}, upsert=True)
+                changed = result.upserted_id is not None
+            except DuplicateKeyError:
+                # another operator assigned a player at the same time, or this player to another station
+                changed = False
+            if changed:
+                applied = 'assign'
+                mongo.db.players.update_one({'_id': email}, {'$unset': {'waiting': '', 'started': ''}})
+                dispatcher.end_lease(mongo.db, station, held)
+                station_dispatcher.remove(email)
+
+        if changed:
+            app.logger.debug('[NEXT] %s %s at station %s', applied, email, station)
+            station_events.publish(station)
+            # the player's waiting and started flags show on every station page
+            response_cache.invalidate('next:{}'.format(station), 'stations', 'players')
         return redirect('/next/{}'.format(station))
 
     # get the next player for this station
@@ -199,16 +611,9 @@ def manage_next_player(station):
     else:
         start = end - datetime.timedelta(days=1)
 
-    query = {
-        'updatedAt': {
-            '$gte': start,
-            '$lt': end
-        },
-        'waiting': True
-    }
-    players = mongo.db.players.find(query).sort('updatedAt', pymongo.DESCENDING)
+    players = find_waiting_players(start, end)
 
-    return render_template('station.html', station=station, next_player=next_player, players_waiting=players)
+    return render_template('station.html', station=station, next_player=next_player, players_waiting=players, page_events=STATION_PAGE_EVENTS)
 
 
 def parse_bool(val):
@@ -217,6 +622,80 @@ def parse_bool(val):
     return False
 
 
+def player_score_update(doc):
+    # running totals kept on the player for every score they play
+    # firstScoreAt is cleared by signing up again, /stats counts the wait from updatedAt to it
+    score = doc['score']
+    update = {
+        '$max': {'bestScore': score},
+        '$min': {'firstScoreAt': doc['_id'].generation_time.replace(tzinfo=None)},
+        '$inc': {'plays': 1},
+        '$set': {'lastScore': score}
+    }
+    if SCORE_STORAGE == 'collection':
+        update['$push'] = {'scores': score}
+    return update
+
+
+def save_score(station, doc):
+    score_store.insert(doc, station)
+    leaderboard.record_score(mongo.db, doc['_id'], doc['email'], doc['displayName'], doc['score'], doc['easteregg'], doc.get('venue'))
+
+    # save score to players record
+    mongo.db.players.update_one({'_id': doc['email']}, player_score_update(doc))
+    stats.forget(mongo.db.stats_hourly, [doc], archived=report_archive.archived_before('scores'))
+    response_cache.invalidate('scores', 'players')
+
+
+def save_scores(scores):
+    # save_score for many (score, station) pairs in a few round trips
+    # returns {index: 'duplicate' or 'error'} for the scores that were not stored
+    errors = score_store.insert_many(scores)
+    inserted = [doc for index, (doc, station) in enumerate(scores) if index not in errors]
+    if inserted:
+        mongo.db.players.bulk_write([
+            pymongo.UpdateOne({'_id': doc['email']}, player_score_update(doc))
+            for doc in inserted
+        ], ordered=False)
+        leaderboard.record_scores(mongo.db, inserted)
+        stats.forget(mongo.db.stats_hourly, inserted, archived=report_archive.archived_before('scores'))
+        response_cache.invalidate('scores', 'players')
+    return errors
+
+
+def write_buffered_scores(records):
+    # records are {'score', 'station', 'sync'}, a record replayed after a restart is a duplicate and skipped
+    errors = save_scores([(record['score'], record['station']) for record in records])
+    for index, status in errors.items():
+        if status == 'error':
+            app.logger.warning('[INGEST] Dropping score %s that could not be stored', records[index]['score']['_id'])
+
+    rows = [record['sync'] for index, record in enumerate(records) if errors.get(index) != 'error']
+    if rows:
+        try:
+            sync_outbox.add_many(rows)
+        except BulkWriteError as e:
+            if any(status != 'duplicate' for status in scorestore.bulk_errors(e).values()):
+                raise
+
+
+score_buffer = ingest.ScoreBuffer(INGEST_DIR, write_buffered_scores, INGEST_BATCH_SIZE, INGEST_INTERVAL, INGEST_FSYNC)
+
+
+def idempotency_key():
+    # the sync _id a server replaying its outbox sent this request with, see outbox.py
+    key = request.headers.get(outbox.IDEMPOTENCY_HEADER)
+    if key and ObjectId.is_valid(key):
+        return ObjectId(key)
+    return None
+
+
+def wait_for_buffered_scores():
+    # score reports include every score answered before they were asked for
+    if INGEST_MODE == 'buffered' and not score_buffer.wait_flushed(INGEST_READ_WAIT):
+        app.logger.warning('[INGEST] Reporting before every buffered score was written')
+
+
 @app.route('/score/<station>', methods=['POST'])
 def score(station):  
     if not request.form:
@@ -229,26 +708,40 @@ def score(station):
     score = request.form.get('score', 0, int)
     easteregg = request.form.get('easteregg', False, parse_bool)
 
-    mongo.db.scores.save({
+    # a score synced from another server keeps its _id there, so sending it twice stores it once
+    key = idempotency_key()
+    doc = {
+        '_id': key or ObjectId(),
         'email': request.form['email'],
         'displayName': request.form['displayName'],
         'score': score,
-        'easteregg': easteregg
-    })
-    
-    # save score to players record
-    mongo.db.players.update({ 
-            "_id": request.form['email'] 
-        }, {
-            "$push": { "scores" : score}
+        'easteregg': easteregg,
+        'venue': venue_of(request.form)
+    }
+    # same _id as the score so a replayed score is only synced once
+    sync = outbox.row('/score/0', dict({param: request.form[param] for param in score_schema}, venue=doc['venue']), doc['_id'])
+
+    if INGEST_MODE == 'buffered':
+        score_buffer.append({
+            'score': doc,
+            'station': station,
+            'sync': sync
         })
+        # the next report misses the cache and waits for this score to be written
+        response_cache.invalidate('scores', 'players')
+        return 'OK', 200
+
+    try:
+        save_score(station, doc)
+    except DuplicateKeyError:
+        # sent again by a server that did not hear back the first time
+        return 'OK', 200
+
+    if key:
+        record_synced([(doc['venue'], key)])
 
     # sync scores with upstream server
-    mongo.db.sync.save({
-        'url': '/score/0',
-        'method': 'post',
-        'data': request.form
-    })    
+    sync_outbox.add(sync)
 
     return 'OK', 200
 
@@ -256,36 +749,34 @@ def score(station):
 @app.route('/testscore')
 def testscore():  
     
-    testdata = dict([('score','5'), ('easteregg','false'), ('email','esfefsefsef@gdrgdrgdr.com'), ('displayName','MillieTest')])
+    testdata = dict([('score','5'), ('easteregg','false'), ('email','esfefsefsef@gdrgdrgdr.com'), ('displayName','MillieTest'), ('venue', VENUE)])
     #score = testdata.get('score', 0, int)
     #easteregg = testdata.get('easteregg', False, parse_bool)
 
-    mongo.db.scores.save({
+    score_id = ObjectId()
+    save_score('test', {
+        '_id': score_id,
         'email': testdata['email'],
         'displayName': testdata['displayName'],
         'score': 5,
-        'easteregg': False
+        'easteregg': False,
+        'venue': VENUE
     })
-    
-    # save score to players record
-    mongo.db.players.update({ 
-            "_id": testdata['email'] 
-        }, {
-            "$push": { "scores" : 5}
-        })
 
     # sync scores with upstream server
-    mongo.db.sync.save({
-        'url': '/score/0',
-        'method': 'post',
-        'data': testdata
-    })    
+    sync_outbox.add(outbox.row('/score/0', testdata, score_id))
 
     return 'OK', 200
 
 
 
+def export_encoding():
+    # Content-Encoding of an export, from the Accept-Encoding of the request
+    return streaming.negotiate(request.accept_encodings, EXPORT_ENCODINGS)
+
+
 @app.route('/scores')
+@response_cache.cached('scores')
 def scores():
     # return a report of scores in various formats
 
@@ -307,54 +798,31 @@ def scores():
     else:
         start = end - datetime.timedelta(days=1)
 
-    query = {
-        '_id': {
-            '$gte': ObjectId.from_datetime(start),
-            '$lt': ObjectId.from_datetime(end)
-        },
-    }
-
     sort = request.args.get('sort', 'score')
     if sort == 'time':
         sort = '_id'
 
     skip = request.args.get('skip', 0, int)
     output = request.args.get('output')
+    venues = report_venues()
+
+    wait_for_buffered_scores()
     
-    cursor = mongo.db.scores.find(query).sort(sort, pymongo.DESCENDING).skip(skip)
+    if sort == 'score' and not skip:
+        # read the top of the board from the precomputed leaderboard
+        top = leaderboard.top_scores(report_db, report_store, start, end, venues=venues, archive=report_archive)
+    else:
+        cursor = find_scores(start, end, sort, skip, venues=venues)
+        top = leaderboard.unique_players(cursor)
     
     # output in delimited format
     headers = {}
     mimetype = 'text/text; charset=utf-8'
-    seperator = '|'
-    newline = '~~'
-        
+    line = reports.score_line('|', '~~')
+
     def generatescores():
-        tmpe = []
-        tmpdn = []
-        count = 0
-        
-        for score in cursor: 
-            if count <=9:
-                
-                if score.get('email','') not in tmpe:
-                    
-                    tmpe.append(score.get('email',''))
-                    
-                    if score.get('displayName','') not in tmpdn:
-                        
-                        tmpdn.append(score.get('displayName',''))
-
-                        yield "{1}{0}{2}{0}{3}{0}{4}{0}{5}{6}".format(
-                            seperator,
-                            score['_id'].generation_time.isoformat(),
-                            score.get('score', 0),
-                            score.get('easteregg', False),
-                            score.get('email',''),
-                            score.get('displayName' ,''),
-                            newline
-                        )
-                        count = count + 1
+        for score in top: 
+            yield line(score)
     
     return Response(generatescores(), headers=headers, mimetype=mimetype)
 
@@ -380,13 +848,6 @@ def scoresraw():
     else:
         start = end - datetime.timedelta(days=1)
 
-    query = {
-        '_id': {
-            '$gte': ObjectId.from_datetime(start),
-            '$lt': ObjectId.from_datetime(end)
-        },
-    }
-
     sort = request.args.get('sort', 'score')
     if sort == 'time':
         sort = '_id'
@@ -394,59 +855,74 @@ def scoresraw():
     skip = request.args.get('skip', 0, int)
     limit = request.args.get('limit', 0, int)
     output = request.args.get('output')
-    
-    cursor = mongo.db.scores.find(query).sort(sort, pymongo.DESCENDING).skip(skip).limit(limit)
 
-    if output in ['json','html']:
-        scores = []
-        for score in cursor: 
-            scores.append({
-                'time': score['_id'].generation_time,
-                'score': score.get('score', 0),
-                'easteregg': score.get('easteregg', False),
-                'email': score.get('email',''),
-                'displayName': score.get('displayName' ,''),
-            })
+    wait_for_buffered_scores()
+
+    after = after_token = request.args.get('after')
+    if after:
+        if sort in KEYSET_UNSUPPORTED:
+            return 'Bad request: Param "after" can not be used with this sort', 400
+        try:
+            after = decode_after(after)
+        except (ValueError, TypeError):
+            return 'Bad request: Param "after" is not a valid continuation token', 400
+
+    if output == 'parquet' and not streaming.parquet_available():
+        return 'Parquet output needs the pyarrow package on the server', 501
+
+    venues = report_venues()
+    cursor = find_archived('scores', lambda skip, limit: find_scores(start, end, sort, skip, limit, after, venues=venues),
+        archive.score_time, start, end, sort, skip, limit, after, venues)
+    filename = "VR Scores {} to {}".format(start.isoformat()[:10], end.isoformat()[:10])
+
+    if output == 'parquet':
+        return streaming.parquet_response(cursor, reports.SCORE_COLUMNS, filename + '.parquet', EXPORT_PARQUET_ROWS)
+
+    if output in ['json','ndjson','html']:
+        page = streaming.Page(cursor)
 
         if output == 'html':
-            return render_template('report-scores.html', scores=scores)
-        
-        return jsonify({
-            'scores': scores,
-            'query': {
+            scores = ({
+                    'time': score['_id'].generation_time,
+                    'score': score.get('score', 0),
+                    'easteregg': score.get('easteregg', False),
+                    'email': score.get('email',''),
+                    'displayName': score.get('displayName' ,''),
+                } for score in page)
+            return streaming.template_response(app, 'report-scores.html', scores=scores)
+
+        scores = (reports.score_json(score) for score in page)
+
+        def query():
+            return {
                 'from': start.isoformat(),
                 'to': end.isoformat(),
                 'sort': sort,
                 'skip': skip,
-                'limit': limit
+                'limit': limit,
+                'after': after_token,
+                # pass as ?after= to get the next page, null on the last page
+                'next': encode_after(page.last, sort) if limit and page.count == limit else None
             }
-        })
+
+        return streaming.json_response('scores', scores, query, CustomJSONEncoder, output,
+            export_encoding(), EXPORT_BATCH_ROWS, EXPORT_COMPRESS_LEVEL)
 
     # output in delimited format
     headers = {}
     if output == 'csv':
-        filename = "VR Players {} to {}".format(start.isoformat()[:10], end.isoformat()[:10])
-        headers['Content-Disposition'] = "attachment; filename='{}.csv'".format(filename)
+        headers['Content-Disposition'] = streaming.attachment(filename + '.csv')
         mimetype = 'text/csv; charset=utf-8'
-        seperator = ','
-        newline = '\n'
+        line = reports.score_line(',', '\n')
     else:
         mimetype = 'text/text; charset=utf-8'
-        seperator = '|'
-        newline = '~~'
+        line = reports.score_line('|', '~~')
+
     def generate():
         for score in cursor: 
-            yield "{1}{0}{2}{0}{3}{0}{4}{0}{5}{6}".format(
-                seperator,
-                score['_id'].generation_time.isoformat(),
-                score.get('score', 0),
-                score.get('easteregg', False),
-                score.get('email',''),
-                score.get('displayName' ,''),
-                newline
-            )
+            yield line(score)
     
-    return Response(generate(), headers=headers, mimetype=mimetype)
+    return streaming.export_response(generate(), mimetype, headers, export_encoding(), EXPORT_BATCH_ROWS, EXPORT_COMPRESS_LEVEL)
 
 
 
@@ -473,72 +949,198 @@ def players():
     else:
         start = end - datetime.timedelta(days=1)
 
-    query = {
-        'updatedAt': {
-            '$gte': start,
-            '$lt': end
-        },
-    }
-    
     sort = request.args.get('sort', 'time')
     if sort == 'time':
         sort = 'updatedAt'
     elif sort == 'score':
-        sort = 'scores'        
+        sort = 'scores' if SCORE_STORAGE == 'collection' else 'bestScore'
 
     skip = request.args.get('skip', default=0, type=int)
     limit = request.args.get('limit', default=0, type=int)
     output = request.args.get('output', 'pipe')
 
-    cursor = mongo.db.players.find(query).sort(sort, pymongo.DESCENDING).skip(skip).limit(limit)
+    after = after_token = request.args.get('after')
+    if after:
+        if sort in KEYSET_UNSUPPORTED:
+            return 'Bad request: Param "after" can not be used with this sort', 400
+        try:
+            after = decode_after(after)
+        except (ValueError, TypeError):
+            return 'Bad request: Param "after" is not a valid continuation token', 400
+
+    if output == 'parquet' and not streaming.parquet_available():
+        return 'Parquet output needs the pyarrow package on the server', 501
+
+    fields = player_presenter if output in ['html','json','ndjson'] else player_line_presenter
+    venues = report_venues()
+    cursor = find_archived('players', lambda skip, limit: find_players(start, end, sort, skip, limit, after, fields, venues=venues),
+        archive.player_time, start, end, sort, skip, limit, after, venues)
+    filename = "VR Players {} to {}".format(start.isoformat()[:10], end.isoformat()[:10])
+
+    if output == 'parquet':
+        return streaming.parquet_response(cursor, reports.PLAYER_COLUMNS, filename + '.parquet', EXPORT_PARQUET_ROWS)
 
     if output == 'html':
-        return render_template('report-players.html', players=cursor)
+        return streaming.template_response(app, 'report-players.html', players=cursor)
 
-    if output == 'json':
-        players = []
-        for player in cursor: 
-            players.append({
-                param: player.get(param) 
-                for param in player_presenter
-            })
-        return jsonify({
-            'players': players,
-            'query': {
+    if output in ['json','ndjson']:
+        page = streaming.Page(cursor)
+        row = reports.player_json(player_presenter)
+        players = (row(player) for player in page)
+
+        def query():
+            return {
                 'from': start.isoformat(),
                 'to': end.isoformat(),
                 'sort': sort,
                 'skip': skip,
-                'limit': limit
+                'limit': limit,
+                'after': after_token,
+                # pass as ?after= to get the next page, null on the last page
+                'next': encode_after(page.last, sort) if limit and page.count == limit else None
             }
-        })
+
+        return streaming.json_response('players', players, query, CustomJSONEncoder, output,
+            export_encoding(), EXPORT_BATCH_ROWS, EXPORT_COMPRESS_LEVEL)
     
     # output in delimited format
     headers = {}
     if output == 'csv':
-        filename = "VR Scores {} to {}".format(start.isoformat()[:10], end.isoformat()[:10])
-        headers['Content-Disposition'] = "attachment; filename='{}.csv'".format(filename)
+        headers['Content-Disposition'] = streaming.attachment(filename + '.csv')
         mimetype = 'text/csv; charset=utf-8'
-        seperator = ','
+        line = reports.player_line(',')
     else:
         mimetype = 'text/text; charset=utf-8'
-        seperator = '|'
+        line = reports.player_line('|')
 
     def generate():
         for player in cursor: 
-            yield '{1}{0}{2}{0}{3}{0}{4}{0}{5}{0}{6}{0}{7}{0}{8}"\n'.format(
-                seperator,
-                player.get('updatedAt').isoformat(),
-                player.get('hand', 'both'),
-                player.get('email',''),
-                player.get('phone',''),
-                player.get('postcode',''),
-                player.get('displayName' ,''),
-                player.get('firstName' ,''),
-                player.get('lastName' ,'')
-            )
+            yield line(player)
     
-    return Response(generate(), headers=headers, mimetype=mimetype)
+    return streaming.export_response(generate(), mimetype, headers, export_encoding(), EXPORT_BATCH_ROWS, EXPORT_COMPRESS_LEVEL)
+
+
+@app.route('/stats', methods=['GET'])
+@response_cache.cached('scores', 'players')
+def event_stats():
+    # plays per station per hour, distinct players, score histogram, easter egg rate and wait to play
+    # the range is widened to whole hours
+
+    end = request.args.get('to')
+    if end:
+        try:
+            end = parse_isodate(end)
+        except ValueError:
+            return 'Bad request: Param "to" format required in UTC time zone and ISO8601 format {}'.format(ISO8601_FORMAT), 400   
+    else:
+        end = datetime.datetime.utcnow()
+
+    start = request.args.get('from')
+    if start:
+        try:
+            start = parse_isodate(start)
+        except ValueError:
+            return 'Bad request: Param "start" format required in UTC time zone and ISO8601 format {}'.format(ISO8601_FORMAT), 400   
+    else:
+        start = end - datetime.timedelta(days=1)
+
+    output = request.args.get('output', 'json')
+
+    wait_for_buffered_scores()
+
+    venues = report_venues()
+    counts = stats.hourly(report_db, report_store, mongo.db.stats_hourly, start, end, STATS_SCORE_BUCKET, venues=venues)
+    summary = stats.summary(counts, STATS_SCORE_BUCKET)
+    summary['from'] = leaderboard.bucket_start(start)
+    summary['to'] = counts[-1]['hour'] + leaderboard.BUCKET_SIZE if counts else summary['from']
+    summary['venues'] = venues
+
+    if output == 'html':
+        return render_template('report-stats.html', stats=summary)
+
+    if output == 'csv':
+        filename = "VR Stats {} to {}".format(start.isoformat()[:10], end.isoformat()[:10])
+        headers = {'Content-Disposition': streaming.attachment(filename + '.csv')}
+        lines = ['{},{},{},{}\n'.format(hour['hour'].isoformat(), station['station'], station['plays'], station['eastereggs'])
+            for hour in summary['hours'] for station in hour['stations']]
+        return Response(''.join(lines), headers=headers, mimetype='text/csv; charset=utf-8')
+
+    return jsonify(summary)
+
+
+def signup_update(fields, updated_at, sync_id=None):
+    # filter and update of a signup, a returning player keeps their scores and totals
+    # a signup synced from another server (sync_id) only applies when newer than the last one applied
+    query = {'_id': fields['email']}
+    update = {
+        # all players are waiting to play each time they sign up
+        '$set': dict(fields, updatedAt=updated_at, waiting=True),
+        # and /stats counts their wait from this signup, an archived player is back in the reports
+        '$unset': {'started': '', 'firstScoreAt': '', 'archived': ''}
+    }
+    if SCORE_STORAGE == 'collection':
+        # add a base scores array with no scores
+        update['$setOnInsert'] = {'scores': []}
+    if sync_id:
+        update['$set']['syncId'] = sync_id
+        query['$or'] = [{'syncId': {'$exists': False}}, {'syncId': {'$lt': sync_id}}]
+    return query, update
+
+
+def signed_up(signups, sync=True, local=True):
+    # queue and sync signups that were applied, as (fields, player before the signup or None, sync_id)
+    # only players signing up here (local) join the queue, not the ones synced from a venue
+    for fields, before, sync_id in signups:
+        if sync:
+            # only the fields that changed go upstream, with the email they belong to
+            delta = {param: value for param, value in fields.items() if before is None or before.get(param) != value}
+            delta['email'] = fields['email']
+            delta['venue'] = fields['venue']
+            sync_outbox.add(outbox.row(url_for('signup'), delta, sync_id))
+
+        if local:
+            player = dict(before or {}, **fields)
+            station_dispatcher.enqueue(player['email'], player.get('displayName', ''))
+
+    if local and AUTO_DISPATCH:
+        station_dispatcher.dispatch()
+
+    # operators watching their station get to see the new player
+    station_events.publish_all()
+    response_cache.invalidate('players')
+
+
+def apply_signups(signups, sync=True, local=True):
+    # signups are (result, fields, updated_at, sync_id), sets the status of each result
+    # a later signup of the same player in the batch is applied on top of an earlier one
+    latest = collections.OrderedDict()
+    merged = collections.defaultdict(list)
+    for result, fields, updated_at, sync_id in signups:
+        earlier = latest.get(fields['email'])
+        if earlier:
+            fields = dict(earlier[1], **fields)
+            merged[fields['email']].append(earlier[0])
+        latest[fields['email']] = (result, fields, updated_at, sync_id)
+    signups = list(latest.values())
+
+    emails = [fields['email'] for result, fields, updated_at, sync_id in signups]
+    before = {doc['_id']: doc for doc in mongo.db.players.find({'_id': {'$in': emails}}, reports.projection(player_schema))}
+    try:
+        mongo.db.players.bulk_write([
+            pymongo.UpdateOne(*signup_update(fields, updated_at, sync_id), upsert=True)
+            for result, fields, updated_at, sync_id in signups
+        ], ordered=False)
+    except BulkWriteError as e:
+        for index, status in scorestore.bulk_errors(e).items():
+            signups[index][0]['status'] = status
+    for result, fields, updated_at, sync_id in signups:
+        for earlier in merged[fields['email']]:
+            earlier['status'] = result['status']
+
+    applied = [(fields, before.get(fields['email']), sync_id) for result, fields, updated_at, sync_id in signups if result['status'] == 'ok']
+    if applied:
+        signed_up(applied, sync, local)
+    return applied
 
 
 @app.route('/signup', methods=['GET','POST'])
@@ -553,32 +1155,218 @@ def signup():
         if not content:
             return 'Bad request: Please send JSON or from data containing {}'.format(player_schema), 400
 
-        doc = dict()
+        # a signup synced from another server only carries the fields that changed
+        key = idempotency_key()
+        fields = dict()
         for param in player_schema:
             if param not in content or content[param] == '':
+                if key and param != 'email':
+                    continue
                 return 'Bad request: Missing {}'.format(param), 400     
-            doc[param] = content[param]
+            fields[param] = content[param]
+        fields['venue'] = venue_of(content)
 
-        # use email as player primary key
-        doc['_id'] = content['email']
-        doc['updatedAt'] = datetime.datetime.utcnow()
-        # all players are waiting to play each time they sign up
-        doc['waiting'] = True
-        # add a base scores array with no scoress
-        doc['scores'] = []
+        if key:
+            # applied like /sync/batch does, only when newer than the last one applied
+            updated_at = key.generation_time.replace(tzinfo=None)
+        else:
+            updated_at = datetime.datetime.utcnow()
+
+        query, update = signup_update(fields, updated_at, key)
+        try:
+            before = mongo.db.players.find_one_and_update(query, update, reports.projection(player_schema), upsert=True)
+        except DuplicateKeyError:
+            # sent again, or older than the signup the player has
+            before = None
+            fields = None
+        if fields:
+            signed_up([(fields, before, key)], local=not key)
+            if key:
+                record_synced([(fields['venue'], key)])
+
+        return render_template('signup.html', firstName=content.get('firstName', ''), lastName=content.get('lastName', ''))
+
+    return render_template('signup.html')
 
-        mongo.db.players.save(doc)
 
-        # sync player with upstream server
-        mongo.db.sync.save({
-            'url': url_for('signup'),
-            'method': 'post',
-            'data': content
-        })   
+@app.route('/signup/batch', methods=['POST'])
+def signup_batch():
+    # signups a kiosk queued while offline, as a JSON list of
+    # {"id": <ObjectId made by the kiosk>, "signedUpAt": "2019-01-01T10:00:00Z", <player fields>}
+    # id makes sending a signup again harmless and is optional like signedUpAt (defaults to now)
+    # each signup gets a status back, ok, duplicate (applied before or older than the player's) or invalid
+    signups = request.get_json(silent=True)
+    if not isinstance(signups, list):
+        return 'Bad request: Please send a JSON list of signups', 400
+
+    results = []
+    valid = []
+    for signup in signups:
+        if not isinstance(signup, dict):
+            results.append({'id': None, 'status': 'invalid', 'error': 'Not an object'})
+            continue
+
+        result = {'id': signup.get('id'), 'status': 'ok'}
+        results.append(result)
+
+        missing = [param for param in player_schema if param not in signup or signup[param] == '']
+        if missing:
+            result.update(status='invalid', error='Missing {}'.format(missing[0]))
+            continue
+
+        sync_id = None
+        if result['id'] is not None:
+            if not ObjectId.is_valid(result['id']):
+                result.update(status='invalid', error='Invalid id')
+                continue
+            sync_id = ObjectId(result['id'])
+
+        updated_at = datetime.datetime.utcnow()
+        if signup.get('signedUpAt'):
+            try:
+                updated_at = parse_isodate(signup['signedUpAt'])
+            except (TypeError, ValueError):
+                result.update(status='invalid', error='signedUpAt format required in UTC time zone and ISO8601 format {}'.format(ISO8601_FORMAT))
+                continue
 
-        return render_template('signup.html', firstName=content['firstName'], lastName=content['lastName'])
+        fields = {param: signup[param] for param in player_schema}
+        fields['venue'] = venue_of(signup)
+        valid.append((result, fields, updated_at, sync_id))
 
-    return render_template('signup.html')
+    if valid:
+        apply_signups(valid)
+
+    return jsonify({'results': results})
+
+
+def parse_int(val):
+    try:
+        return int(val)
+    except (TypeError, ValueError):
+        return 0
+
+
+@app.route('/sync/batch', methods=['POST'])
+def sync_batch():
+    # apply many requests queued in the sync collection of another server in one go
+    # body is a JSON list, or NDJSON with one request per line, of
+    # {"id": <sync _id>, "url": "/score/0" or "/signup", "method": "post", "data": {...}}
+    # requests are applied at most once keyed on their id, each gets a status back
+    # ok, duplicate (applied before), invalid (will never apply) or error (try again)
+    if request.mimetype == 'application/x-ndjson':
+        try:
+            reqs = [json.loads(line) for line in request.get_data(as_text=True).splitlines() if line.strip()]
+        except ValueError:
+            return 'Bad request: Invalid NDJSON', 400
+    else:
+        reqs = request.get_json(silent=True)
+
+    if not isinstance(reqs, list):
+        return 'Bad request: Please send a JSON list of requests', 400
+
+    results = []
+    signups = []
+    scores = []
+    for req in reqs:
+        if not isinstance(req, dict):
+            results.append({'id': None, 'status': 'invalid', 'error': 'Missing id'})
+            continue
+
+        result = {'id': req.get('id'), 'status': 'ok'}
+        results.append(result)
+        if not ObjectId.is_valid(result['id']):
+            result.update(status='invalid', error='Missing id')
+            continue
+        sync_id = ObjectId(result['id'])
+
+        url = req.get('url', '')
+        data = req.get('data')
+        if not isinstance(data, dict):
+            result.update(status='invalid', error='Missing data')
+            continue
+
+        if url == url_for('signup'):
+            schema = player_schema
+        elif re.match(r'^/score/[^/]+$', url):
+            schema = score_schema
+            station = url.split('/')[2]
+        else:
+            result.update(status='invalid', error='Unknown url {}'.format(url))
+            continue
+
+        # signups only carry the fields that changed
+        required = ['email'] if schema is player_schema else schema
+        missing = [param for param in required if param not in data or data[param] == '']
+        if missing:
+            result.update(status='invalid', error='Missing {}'.format(missing[0]))
+            continue
+
+        if schema is player_schema:
+            fields = {param: data[param] for param in player_schema if data.get(param, '') != ''}
+            fields['venue'] = venue_of(data)
+            signups.append((result, fields, sync_id.generation_time.replace(tzinfo=None), sync_id))
+        else:
+            # the sync _id becomes the score _id, so a replayed score is a duplicate key
+            scores.append((result, {
+                '_id': sync_id,
+                'email': data['email'],
+                'displayName': data['displayName'],
+                'score': parse_int(data['score']),
+                'easteregg': parse_bool(str(data['easteregg'])),
+                'venue': venue_of(data)
+            }, station))
+
+    # players first so scores in the same batch land on their player
+    synced = []
+    if signups:
+        applied = apply_signups(signups, sync=False, local=False)
+        synced += [(fields['venue'], sync_id) for fields, before, sync_id in applied]
+
+    if scores:
+        errors = save_scores([(doc, station) for result, doc, station in scores])
+        for index, status in errors.items():
+            scores[index][0]['status'] = status
+        synced += [(doc['venue'], doc['_id']) for index, (result, doc, station) in enumerate(scores) if index not in errors]
+
+    if synced:
+        record_synced(synced)
+
+    return jsonify({'results': results})
+
+
+def record_synced(synced):
+    # per venue sync cursors, the newest sync _id applied from each venue and how many rows were
+    # synced is a list of (venue, sync _id) of the rows just applied
+    venues = {}
+    for venue, sync_id in synced:
+        latest, count = venues.get(venue, (sync_id, 0))
+        venues[venue] = (max(latest, sync_id), count + 1)
+    now = datetime.datetime.utcnow()
+    mongo.db.sync_cursors.bulk_write([
+        pymongo.UpdateOne({'_id': venue}, {
+            '$max': {'syncId': latest},
+            '$inc': {'rows': count},
+            '$set': {'syncedAt': now}
+        }, upsert=True) for venue, (latest, count) in venues.items()
+    ], ordered=False)
+
+
+@app.route('/sync/cursors', methods=['GET'])
+def sync_cursors():
+    # how far the sync of every venue got, lag is the age in seconds of the newest row applied
+    now = datetime.datetime.utcnow()
+    venues = []
+    for cursor in mongo.db.sync_cursors.find().sort('_id', pymongo.ASCENDING):
+        sent_at = cursor['syncId'].generation_time.replace(tzinfo=None)
+        venues.append({
+            'venue': cursor['_id'],
+            'syncId': str(cursor['syncId']),
+            'sentAt': sent_at,
+            'syncedAt': cursor.get('syncedAt'),
+            'rows': cursor.get('rows', 0),
+            'lag': (now - sent_at).total_seconds()
+        })
+    return jsonify({'venues': venues})
 
 
 @app.route('/WIxJPpENIKApy0RkFqINnIVllmIJT99FIMeg9NqeKgxcPCUa5uhSMkdEm6lE', methods=['GET'])
@@ -586,6 +1374,33 @@ def report():
     return render_template('index.html')
 
 
+@app.before_request
+def metrics_route():
+    # label request metrics with the route rule rather than the path
+    request.environ['metrics.route'] = request.url_rule.rule if request.url_rule else 'unmatched'
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    metrics_registry.flush(force=True)
+    return Response(metrics.collect(METRICS_DIR), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/mongo/pool', methods=['GET'])
+def mongo_pool():
+    # connection pool checkout waits of this worker process, to size workers against maxPoolSize
+    return jsonify(dict(mongo_pool_stats.snapshot(), options=database.client_options()))
+
+
+@app.before_first_request
+def startup():
+    if MONGO_ENSURE_INDEXES:
+        try:
+            indexes.ensure_indexes(mongo.db, VENUE_INDEXES)
+        except pymongo.errors.PyMongoError:
+            app.logger.exception('Could not create indexes')
+
+
 def ignore_exception(IgnoreException=Exception,DefaultVal=None):
     """ Decorator for ignoring exception from a function
     e.g.   @ignore_exception(DivideByZero)
@@ -601,6 +1416,145 @@ def ignore_exception(IgnoreException=Exception,DefaultVal=None):
     return dec
 
 
+@app.cli.command('rebuild-leaderboard')
+def rebuild_leaderboard():
+    """ Recreate the leaderboard from every score in the database """
+    count = leaderboard.rebuild(mongo.db, score_store)
+    print('Rebuilt leaderboard with {} entries'.format(count))
+
+
+@app.cli.command('migrate-score-buckets')
+def migrate_score_buckets():
+    """ Copy every score into score_buckets and recount the player totals for SCORE_STORAGE=bucket """
+    buckets = scorestore.BucketStore(mongo.db)
+    totals = {}
+    batch = []
+    copied = 0
+    for score in mongo.db.scores.find().sort('_id', pymongo.ASCENDING):
+        batch.append((score, score.get('station')))
+        if len(batch) == 1000:
+            copied += len(batch) - len(buckets.insert_many(batch))
+            batch = []
+
+        total = totals.setdefault(score.get('email', ''), {'bestScore': 0, 'plays': 0})
+        total['bestScore'] = max(total['bestScore'], score.get('score', 0))
+        total['plays'] += 1
+        total['lastScore'] = score.get('score', 0)
+    if batch:
+        copied += len(batch) - len(buckets.insert_many(batch))
+
+    for email, total in totals.items():
+        mongo.db.players.update_one({'_id': email}, {'$set': total})
+    print('Copied {} scores for {} players into score buckets'.format(copied, len(totals)))
+
+
+@app.cli.command('rebuild-queue')
+def rebuild_queue():
+    """ Queue every waiting player without a station, e.g. after turning on AUTO_DISPATCH """
+    count = station_dispatcher.rebuild()
+    print('Queued {} waiting players'.format(count))
+
+
+@app.cli.command('requeue-sync-dead')
+def requeue_sync_dead():
+    """ Move the rows in sync_dead back into the sync queue to be sent again """
+    count = sync_outbox.requeue_dead()
+    print('Requeued {} dead sync rows'.format(count))
+
+
+@app.cli.command('archive')
+def archive_old_data():
+    """ Move scores, leaderboard entries, players and sync dead letters older than ARCHIVE_DAYS to the files in ARCHIVE_DIR """
+    if ARCHIVE_DAYS <= 0:
+        print('ARCHIVE_DAYS is 0, nothing is archived')
+        return
+    before = archive.day_start(datetime.datetime.utcnow()) - datetime.timedelta(days=ARCHIVE_DAYS)
+
+    # count the hours of /stats while their scores and players are still in mongo
+    oldest = archive.oldest_score(score_store)(None, before)
+    if oldest:
+        stats.hourly(mongo.db, score_store, mongo.db.stats_hourly, oldest, before, STATS_SCORE_BUCKET)
+
+    fields = score_presenter + ['station', 'venue']
+    count = archive.archive_scores(report_archive, score_store, before, fields)
+    print('Archived {} scores before {}'.format(count, before.isoformat()))
+    count = archive.archive_leaderboard(report_archive, mongo.db, before)
+    print('Archived {} leaderboard entries before {}'.format(count, before.isoformat()))
+    count = archive.archive_players(report_archive, mongo.db, before)
+    print('Archived {} players before {}'.format(count, before.isoformat()))
+    count = archive.archive_sync_dead(report_archive, mongo.db, before)
+    print('Archived {} sync dead letters before {}'.format(count, before.isoformat()))
+    response_cache.invalidate('scores', 'players')
+
+
+@app.cli.command('tag-venue')
+def tag_venue():
+    """ Set VENUE on the scores, players and leaderboard entries stored before they carried a venue """
+    for collection in ['scores', 'players', 'score_buckets']:
+        result = mongo.db[collection].update_many({'venue': {'$exists': False}}, {'$set': {'venue': VENUE}})
+        print('Tagged {} {} with venue {}'.format(result.modified_count, collection, VENUE))
+    # leaderboard entries hold the venue in their _id
+    count = leaderboard.rebuild(mongo.db, score_store)
+    print('Rebuilt leaderboard with {} entries'.format(count))
+
+
+@app.cli.command('ensure-indexes')
+def ensure_indexes():
+    """ Create the indexes the report queries need """
+    indexes.ensure_indexes(mongo.db, VENUE_INDEXES)
+    print('Indexes are up to date')
+
+
+@app.cli.command('explain-queries')
+def explain_queries():
+    """ Fail when any report query scans a collection or sorts in memory """
+    end = datetime.datetime.utcnow()
+    start = end - datetime.timedelta(days=1)
+    best, raw = leaderboard.cursors(report_db, report_store, start, end)
+
+    queries = [
+        ('/next/<station>', find_waiting_players(start, end)),
+        ('/scores', best),
+        ('/players', find_players(start, end, 'updatedAt')),
+    ]
+    if SCORE_STORAGE == 'collection':
+        queries += [
+            ('/scores?sort=time', find_scores(start, end, '_id')),
+            ('/scoresraw', find_scores(start, end, 'score')),
+            ('/scoresraw?sort=time', find_scores(start, end, '_id')),
+            ('/players?sort=score', find_players(start, end, 'scores')),
+        ] + [('/scores (partial hour)', cursor) for cursor in raw]
+    else:
+        # bucket reports are aggregations sorting the hours they read, only the hour range uses an index
+        queries += [
+            ('/scoresraw (hours)', report_db.score_buckets.find({'hour': {'$gte': leaderboard.bucket_start(start), '$lt': end}})),
+            ('/players?sort=score', find_players(start, end, 'bestScore')),
+        ]
+    if VENUE_INDEXES:
+        venues = [VENUE]
+        best, raw = leaderboard.cursors(report_db, report_store, start, end, venues)
+        queries += [
+            ('/scores?venue=', best),
+            ('/players?venue=', find_players(start, end, 'updatedAt', venues=venues)),
+        ]
+        if SCORE_STORAGE == 'collection':
+            queries += [
+                ('/scoresraw?venue=', find_scores(start, end, 'score', venues=venues)),
+                ('/scoresraw?sort=time&venue=', find_scores(start, end, '_id', venues=venues)),
+            ]
+
+    failed = False
+    for route, cursor in queries:
+        if cursor is None:
+            continue
+        stages = indexes.slow_stages(cursor)
+        print('{} {} {}'.format('FAIL' if stages else 'OK  ', route, ' '.join(stages)))
+        failed = failed or bool(stages)
+
+    if failed:
+        raise SystemExit(1)
+
+
 if __name__ == "__main__":
     # Only for debugging while developing
     app.run(host='0.0.0.0', debug=True, port=5000)
@@ -0,0 +1,329 @@
+import datetime
+import fcntl
+import gzip
+import heapq
+import itertools
+import json
+import logging
+import os
+
+import pymongo
+from bson import json_util
+
+# Old scores, leaderboard entries and sync dead letters are moved out of mongo
+# into gzip NDJSON files with one partition per collection per day, so the
+# collections the app works on only hold recent data and stay in memory.
+# Old players are copied there and stay in mongo with archived set and an empty
+# scores array, a player who signs up again keeps their totals.
+# <directory>/<collection>/<YYYY-MM-DD>.<part>.ndjson.gz
+# A day is archived again in a new part when documents of that day turn up
+# after it was archived, e.g. scores synced late from another venue.
+# <directory>/manifest.json lists every partition
+# {'partitions': [{'collection', 'day', 'file', 'from', 'to', 'count', 'bytes', 'archivedAt'}]}
+# with the range of times the documents of the partition fall in, from
+# inclusive and to exclusive, written after the partition file so the
+# manifest never lists a file that is not complete.
+
+DAY = datetime.timedelta(days=1)
+
+MANIFEST = 'manifest.json'
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# documents come back with naive UTC datetimes like the ones read from mongo
+JSON_OPTIONS = json_util.JSONOptions(tz_aware=False)
+
+
+def day_start(when):
+    return datetime.datetime(when.year, when.month, when.day)
+
+
+def format_time(when):
+    return when.strftime(TIME_FORMAT)
+
+
+def parse_time(value):
+    return datetime.datetime.strptime(value, TIME_FORMAT)
+
+
+def score_time(score):
+    return score['_id'].generation_time.replace(tzinfo=None)
+
+
+def player_time(player):
+    return player['updatedAt']
+
+
+def dead_time(req):
+    return req['diedAt']
+
+
+def entry_time(entry):
+    return entry['bucket']
+
+
+def id_key(_id):
+    # leaderboard entries have a document as their _id
+    return tuple(sorted(_id.items())) if isinstance(_id, dict) else _id
+
+
+class SortValue(object):
+    """ Orders documents like a mongo sort, see sort_key """
+
+    __slots__ = ['values', 'directions']
+
+    def __init__(self, values, directions):
+        self.values = values
+        self.directions = directions
+
+    def __lt__(self, other):
+        for value, other_value, direction in zip(self.values, other.values, self.directions):
+            if value != other_value:
+                return (value < other_value) == (direction == pymongo.ASCENDING)
+        return False
+
+
+def sort_key(sort):
+    # key function putting documents in the order of a mongo sort e.g. [('score', -1), ('_id', -1)]
+    directions = [direction for field, direction in sort]
+
+    def value(doc, field, direction):
+        value = doc.get(field)
+        if isinstance(value, list):
+            # arrays sort by their largest element descending and smallest ascending
+            value = (max if direction == pymongo.DESCENDING else min)(value) if value else None
+        if isinstance(value, datetime.datetime) and value.tzinfo is not None:
+            # continuation tokens are read back timezone aware
+            value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        # missing fields sort before any value
+        return (0,) if value is None else (1, value)
+
+    def key(doc):
+        return SortValue([value(doc, field, direction) for field, direction in sort], directions)
+    return key
+
+
+class Archive(object):
+    """ Reads and writes the archive partitions of a directory
+
+    The manifest is read again whenever the archive job changed it, so every
+    process serving reports sees new partitions on its next request.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._manifest = {'partitions': []}
+        self._mtime = None
+
+    def _path(self, *names):
+        return os.path.join(self.directory, *names)
+
+    def manifest(self):
+        try:
+            mtime = os.stat(self._path(MANIFEST)).st_mtime
+        except OSError:
+            return {'partitions': []}
+        if mtime != self._mtime:
+            with open(self._path(MANIFEST)) as f:
+                self._manifest = json.load(f)
+            self._mtime = mtime
+        return self._manifest
+
+    def partitions(self, name, start=None, end=None):
+        # partitions of a collection with documents between start and end, oldest first
+        found = []
+        for partition in self.manifest()['partitions']:
+            if partition['collection'] != name:
+                continue
+            if start is not None and parse_time(partition['to']) <= start:
+                continue
+            if end is not None and parse_time(partition['from']) >= end:
+                continue
+            found.append(partition)
+        return sorted(found, key=lambda partition: (partition['day'], partition['file']))
+
+    def archived_before(self, name):
+        # the end of the last archived day of a collection, None when nothing was archived
+        ends = [parse_time(partition['to']) for partition in self.partitions(name)]
+        return max(ends) if ends else None
+
+    def read(self, partition):
+        with gzip.open(self._path(partition['file']), 'rt', encoding='utf-8') as f:
+            for line in f:
+                yield json_util.loads(line, json_options=JSON_OPTIONS)
+
+    def find(self, name, start, end, time_of, venues=None):
+        # archived documents between start and end, time_of gives the time of a document
+        for partition in self.partitions(name, start, end):
+            for doc in self.read(partition):
+                if start <= time_of(doc) < end and (not venues or doc.get('venue') in venues):
+                    yield doc
+
+    def merge(self, name, hot, start, end, time_of, sort, skip=0, limit=0, after=None, venues=None):
+        # the documents of a report whose range reaches into the archive
+        # hot is the report query without skip (and with a limit of skip + limit)
+        # the archived documents of the range are held in memory to be sorted,
+        # the hot ones are read from the cursor as they are merged in
+        key = sort_key(sort)
+        archived = self.find(name, start, end, time_of, venues)
+        if after:
+            # the keyset continuation token holds the sort value and _id of the last row sent
+            last = key({sort[0][0]: after[0], '_id': after[1]})
+            archived = (doc for doc in archived if last < key(doc))
+        rows = heapq.merge(hot, sorted(archived, key=key), key=key)
+        return itertools.islice(rows, skip, skip + limit if limit else None)
+
+    def ids(self, name, day):
+        # _ids already archived for a day, to not archive them twice
+        ids = set()
+        for partition in self.partitions(name):
+            if partition['day'] == day.strftime('%Y-%m-%d'):
+                ids.update(id_key(doc['_id']) for doc in self.read(partition))
+        return ids
+
+    def write(self, name, day, docs):
+        # writes docs as a new partition of the day, returns its manifest entry
+        if not docs:
+            return None
+        if not os.path.isdir(self._path(name)):
+            os.makedirs(self._path(name))
+
+        with open(self._path('.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            part = len([partition for partition in self.partitions(name) if partition['day'] == day.strftime('%Y-%m-%d')])
+            filename = '{}/{}.{}.ndjson.gz'.format(name, day.strftime('%Y-%m-%d'), part)
+            path = self._path(filename)
+            with open(path + '.tmp', 'wb') as raw:
+                with gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6) as f:
+                    for doc in docs:
+                        f.write((json_util.dumps(doc, json_options=json_util.RELAXED_JSON_OPTIONS) + '\n').encode('utf-8'))
+                raw.flush()
+                os.fsync(raw.fileno())
+            os.replace(path + '.tmp', path)
+
+            partition = {
+                'collection': name,
+                'day': day.strftime('%Y-%m-%d'),
+                'file': filename,
+                'from': format_time(day),
+                'to': format_time(day + DAY),
+                'count': len(docs),
+                'bytes': os.path.getsize(path),
+                'archivedAt': format_time(datetime.datetime.utcnow())
+            }
+
+            # read from disk rather than the copy in memory, another job may have added to it
+            manifest = {'partitions': []}
+            if os.path.exists(self._path(MANIFEST)):
+                with open(self._path(MANIFEST)) as f:
+                    manifest = json.load(f)
+            manifest['partitions'].append(partition)
+            with open(self._path(MANIFEST + '.tmp'), 'w') as f:
+                json.dump(manifest, f, indent=1, sort_keys=True)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(self._path(MANIFEST + '.tmp'), self._path(MANIFEST))
+
+        logging.info('[ARCHIVE] Wrote %s %s to %s', len(docs), name, filename)
+        return partition
+
+    def archive_days(self, name, oldest, find, remove, before):
+        # moves the documents of every day before `before` into the archive one day at a time
+        # oldest(start, end) is the time of the oldest document between start and end or None
+        # find(start, end) the documents between start and end and remove(docs) deletes (or
+        # trims) them in mongo once they are in the archive, returns the number of documents moved
+        count = 0
+        first = oldest(None, before)
+        while first is not None:
+            day = day_start(first)
+            end = min(day + DAY, before)
+            docs = list(find(day, end))
+            archived = self.ids(name, day)
+            self.write(name, day, [doc for doc in docs if id_key(doc['_id']) not in archived])
+            remove(docs)
+            count += len(docs)
+            first = oldest(end, before)
+        return count
+
+
+def oldest_score(store):
+    def oldest(start, end):
+        for score in store.find(start, end, [('_id', pymongo.ASCENDING)], 0, 1, fields=['_id']):
+            return score_time(score)
+    return oldest
+
+
+def oldest_by(collection, field, query=None):
+    def oldest(start, end):
+        between = {'$lt': end}
+        if start is not None:
+            between['$gte'] = start
+        for doc in collection.find(dict(query or {}, **{field: between}), {field: True}).sort(field, pymongo.ASCENDING).limit(1):
+            return doc[field]
+    return oldest
+
+
+def find_by(collection, field, query=None):
+    def find(start, end):
+        return collection.find(dict(query or {}, **{field: {'$gte': start, '$lt': end}}))
+    return find
+
+
+def remove_older(collection, field, before):
+    # only while still older, a player who signed up again in the meantime stays
+    def remove(docs):
+        ids = [doc['_id'] for doc in docs]
+        for i in range(0, len(ids), 1000):
+            collection.delete_many({'_id': {'$in': ids[i:i + 1000]}, field: {'$lt': before}})
+    return remove
+
+
+def trim_older(collection, field, before):
+    # keeps the documents, marked as archived and with an empty scores array
+    def trim(docs):
+        ids = [doc['_id'] for doc in docs]
+        for i in range(0, len(ids), 1000):
+            query = {'_id': {'$in': ids[i:i + 1000]}, field: {'$lt': before}}
+            collection.update_many(query, {'$set': {'archived': True}})
+            # only players that have one, in bucket mode they only keep their totals
+            collection.update_many(dict(query, scores={'$exists': True}), {'$set': {'scores': []}})
+    return trim
+
+
+def archive_scores(archive, store, before, fields):
+    return archive.archive_days(
+        'scores',
+        oldest_score(store),
+        lambda start, end: store.find(start, end, [('_id', pymongo.ASCENDING)], fields=fields),
+        store.remove,
+        before)
+
+
+def archive_players(archive, db, before):
+    # a player deleted here would sign up again as a new player, losing their totals and syncId
+    not_archived = {'archived': {'$ne': True}}
+    return archive.archive_days(
+        'players',
+        oldest_by(db.players, 'updatedAt', not_archived),
+        find_by(db.players, 'updatedAt', not_archived),
+        trim_older(db.players, 'updatedAt', before),
+        before)
+
+
+def archive_leaderboard(archive, db, before):
+    return archive.archive_days(
+        'leaderboard',
+        oldest_by(db.leaderboard, 'bucket'),
+        find_by(db.leaderboard, 'bucket'),
+        remove_older(db.leaderboard, 'bucket', before),
+        before)
+
+
+def archive_sync_dead(archive, db, before):
+    return archive.archive_days(
+        'sync_dead',
+        oldest_by(db.sync_dead, 'diedAt'),
+        find_by(db.sync_dead, 'diedAt'),
+        remove_older(db.sync_dead, 'diedAt', before),
+        before)
@@ -0,0 +1,530 @@
+"""
+ASGI entry point, serves the same routes as uwsgi.ini on asyncio
+
+    uvicorn asgi:application --host 0.0.0.0 --port 8080
+
+The routes that spend most of their time waiting are served here on the event
+loop with the motor driver, so thousands of idle stations and slow downloads
+share one process without holding a worker or thread each:
+
+    GET /station/<station>/player            including ?wait= long polls
+    GET /station/<station>/player/events     Server-Sent Events
+    GET /scoresraw and /players              pipe, csv and ndjson output
+
+Every other route, the html, json and parquet reports and the reports whose
+range reaches into the archive (see archive.py) run the Flask app on a pool
+of ASGI_WSGI_THREADS threads. Needs motor and an ASGI server, uwsgi.ini keeps
+serving the app without them.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import logging
+import os
+import re
+import sys
+import time
+from tempfile import SpooledTemporaryFile
+from urllib.parse import parse_qs
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from werkzeug.http import parse_accept_header
+
+import app
+import database
+import reports
+import scorestore
+import streaming
+
+# threads running Flask for the routes not served natively
+ASGI_WSGI_THREADS = int(os.environ.get('ASGI_WSGI_THREADS', '16'))
+# reports are sent in chunks of about this many bytes
+ASGI_CHUNK_SIZE = int(os.environ.get('ASGI_CHUNK_SIZE', '65536'))
+
+
+class WsgiBridge(object):
+    """ Runs a WSGI app for ASGI requests on a thread pool
+
+    Requests run in parallel on the pool and every chunk of the response is
+    passed back to the event loop as it is produced, waiting until it was sent.
+    """
+
+    def __init__(self, wsgi_app, threads):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+
+    @staticmethod
+    def environ(scope, body):
+        server = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        if scope.get('client'):
+            environ['REMOTE_ADDR'] = scope['client'][0]
+
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').upper().replace('-', '_')
+            if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                name = 'HTTP_' + name
+            value = value.decode('latin-1')
+            if name in environ:
+                value = environ[name] + ',' + value
+            environ[name] = value
+        return environ
+
+    async def __call__(self, scope, receive, send):
+        loop = asyncio.get_event_loop()
+        # the Flask app records its own request metrics
+        scope['metrics.wsgi'] = True
+        with SpooledTemporaryFile(max_size=65536) as body:
+            while True:
+                message = await receive()
+                body.write(message.get('body', b''))
+                if not message.get('more_body'):
+                    break
+            body.seek(0)
+            environ = self.environ(scope, body)
+
+            def send_from_thread(message):
+                asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+            def run():
+                response = {}
+
+                def start_response(status, headers, exc_info=None):
+                    response['start'] = {
+                        'type': 'http.response.start',
+                        'status': int(status.split(' ', 1)[0]),
+                        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+                    }
+
+                result = self.wsgi_app(environ, start_response)
+                try:
+                    for data in result:
+                        if 'start' in response:
+                            send_from_thread(response.pop('start'))
+                        if data:
+                            send_from_thread({'type': 'http.response.body', 'body': data, 'more_body': True})
+                    if 'start' in response:
+                        send_from_thread(response.pop('start'))
+                    send_from_thread({'type': 'http.response.body'})
+                finally:
+                    if hasattr(result, 'close'):
+                        result.close()
+
+            await loop.run_in_executor(self.executor, run)
+
+
+class StationWaiter(object):
+    """ Lets coroutines wait on app.station_events without holding a thread """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self._changed = asyncio.Event()
+        app.station_events.listen(self._publish)
+
+    def _publish(self, station):
+        # called on whichever thread published
+        self.loop.call_soon_threadsafe(self._notify)
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait(self, station, version, timeout):
+        # returns the latest version, which equals version when timed out
+        deadline = self.loop.time() + timeout
+        while True:
+            latest = app.station_events.version(station)
+            remaining = deadline - self.loop.time()
+            if latest != version or remaining <= 0:
+                return latest
+            try:
+                await asyncio.wait_for(self._changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+
+wsgi = WsgiBridge(app.app, ASGI_WSGI_THREADS)
+
+# created on first use so they belong to the server's event loop
+_db = None
+_waiter = None
+
+
+def db():
+    global _db
+    if _db is None:
+        _db = AsyncIOMotorClient(
+            app.app.config['MONGO_URI'],
+            event_listeners=[app.mongo_command_metrics],
+            **database.client_options()
+        ).get_default_database()
+    return _db
+
+
+def report_db():
+    return db().with_options(read_preference=app.REPORT_READ_PREFERENCE)
+
+
+def waiter():
+    global _waiter
+    if _waiter is None:
+        _waiter = StationWaiter(asyncio.get_event_loop())
+    return _waiter
+
+
+def arg_int(args, name, default=0):
+    # like request.args.get(name, default, int)
+    try:
+        return int(args[name])
+    except (KeyError, ValueError):
+        return default
+
+
+def arg_venues(args):
+    # like app.report_venues
+    venues = [venue for venue in args.get('venue', '').split(',') if venue]
+    return venues or None
+
+
+def export_encoding(scope):
+    # like app.export_encoding, from the Accept-Encoding of the request
+    accept = [value for name, value in scope['headers'] if name == b'accept-encoding']
+    return streaming.negotiate(parse_accept_header(accept[0].decode('latin-1') if accept else None), app.EXPORT_ENCODINGS)
+
+
+async def start(send, status, content_type, headers=None):
+    headers = dict(headers or {}, **{'Content-Type': content_type})
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers.items()]
+    })
+
+
+async def respond(send, status, text='', content_type='text/html; charset=utf-8'):
+    await start(send, status, content_type)
+    await send({'type': 'http.response.body', 'body': text.encode('utf-8')})
+
+
+async def until_disconnected(receive, coroutine):
+    # run coroutine until it is done or the client goes away
+    task = asyncio.ensure_future(coroutine)
+
+    async def watch():
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                task.cancel()
+                return
+
+    watcher = asyncio.ensure_future(watch())
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    finally:
+        watcher.cancel()
+
+
+async def next_player_line(station, mark_ready=True):
+    # app.next_player_line with motor
+    next_player = await db().next_player.find_one({'_id': station})
+    if not next_player:
+        return None, False
+
+    is_ready = next_player.get('isReady', False)
+    if mark_ready and not is_ready:
+        await db().next_player.update_one({'_id': station}, {'$set': {'isReady': True}})
+        app.station_events.publish(station)
+        app.response_cache.invalidate('next:{}'.format(station), 'stations')
+        is_ready = True
+
+    player = await db().players.find_one({'_id': next_player.get('email')})
+    if not player:
+        return None, is_ready
+    return reports.station_player_line(player), is_ready
+
+
+async def station_player(scope, receive, send, args, station):
+    # GET /station/<station>/player, see app.get_next_player
+    loop = asyncio.get_event_loop()
+    wait = min(arg_int(args, 'wait'), app.STATION_WAIT_MAX)
+    since = args.get('since', '').strip()
+
+    version = app.station_events.version(station)
+    line, is_ready = await next_player_line(station)
+
+    if wait > 0:
+        app.watch_station_events()
+        deadline = loop.time() + wait
+        while (line or '').strip() == since and loop.time() < deadline:
+            version = await waiter().wait(station, version, min(deadline - loop.time(), app.STATION_EVENTS_RECHECK))
+            line, is_ready = await next_player_line(station)
+
+    if line:
+        await respond(send, 200, line)
+    else:
+        await respond(send, 204)
+
+
+async def station_player_events(scope, receive, send, args, station):
+    # GET /station/<station>/player/events, see app.next_player_events
+    mark_ready = app.parse_bool(args.get('ready', 'true'))
+    app.watch_station_events()
+
+    async def generate():
+        await start(send, 200, 'text/event-stream; charset=utf-8', {
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        })
+
+        async def event(text):
+            await send({'type': 'http.response.body', 'body': text.encode('utf-8'), 'more_body': True})
+
+        await event('retry: {}\n\n'.format(app.STATION_EVENTS_RECHECK * 1000))
+        version = app.station_events.version(station)
+        changed = True
+        # always send the current line first
+        last = object()
+        while True:
+            line, is_ready = await next_player_line(station, mark_ready)
+            state = line if mark_ready else (line, is_ready)
+            if state != last or (changed and not mark_ready):
+                last = state
+                await event('data: {}\n\n'.format((line or '').strip()))
+            else:
+                await event(': keepalive\n\n')
+
+            latest = await waiter().wait(station, version, app.STATION_EVENTS_RECHECK)
+            changed = latest != version
+            version = latest
+
+    await until_disconnected(receive, generate())
+
+
+def report_range(args):
+    # from and to of a report as the Flask routes read them, raises ValueError with the 400 message
+    end = args.get('to')
+    if end:
+        try:
+            end = app.parse_isodate(end)
+        except ValueError:
+            raise ValueError('Bad request: Param "to" format required in UTC time zone and ISO8601 format {}'.format(app.ISO8601_FORMAT))
+    else:
+        end = datetime.datetime.utcnow()
+
+    start = args.get('from')
+    if start:
+        try:
+            start = app.parse_isodate(start)
+        except ValueError:
+            raise ValueError('Bad request: Param "start" format required in UTC time zone and ISO8601 format {}'.format(app.ISO8601_FORMAT))
+    else:
+        start = end - datetime.timedelta(days=1)
+    return start, end
+
+
+def report_after(args, sort):
+    # ?after= continuation token, raises ValueError with the 400 message
+    after = args.get('after')
+    if not after:
+        return None
+    if sort in app.KEYSET_UNSUPPORTED:
+        raise ValueError('Bad request: Param "after" can not be used with this sort')
+    try:
+        return app.decode_after(after)
+    except (ValueError, TypeError):
+        raise ValueError('Bad request: Param "after" is not a valid continuation token')
+
+
+async def stream_report(send, cursor, row, content_type, headers=None, encoding=None):
+    # like streaming.export_response, compressed with encoding when given
+    headers = dict(headers or {}, Vary='Accept-Encoding')
+    compressor = None
+    if encoding:
+        headers['Content-Encoding'] = encoding
+        compressor = streaming.compressor(encoding, app.EXPORT_COMPRESS_LEVEL)
+    await start(send, 200, content_type, headers)
+
+    async def write(text, more_body=True):
+        body = text.encode('utf-8')
+        if compressor:
+            body = compressor.compress(body)
+            if not more_body:
+                body += compressor.flush()
+        if body or not more_body:
+            await send({'type': 'http.response.body', 'body': body, 'more_body': more_body})
+
+    chunk = []
+    size = 0
+    async for doc in cursor:
+        text = row(doc)
+        chunk.append(text)
+        size += len(text)
+        if size >= ASGI_CHUNK_SIZE:
+            await write(''.join(chunk))
+            chunk = []
+            size = 0
+    await write(''.join(chunk), more_body=False)
+
+
+async def scores_raw(scope, receive, send, args):
+    # GET /scoresraw, see app.scoresraw
+    output = args.get('output')
+    if output in ['json', 'html', 'parquet']:
+        return await wsgi(scope, receive, send)
+
+    try:
+        start_time, end_time = report_range(args)
+        sort = args.get('sort', 'score')
+        if sort == 'time':
+            sort = '_id'
+        after = report_after(args, sort)
+    except ValueError as e:
+        return await respond(send, 400, str(e))
+
+    if app.report_archive.partitions('scores', start_time, end_time):
+        # merged with the archived scores by app.find_archived
+        return await wsgi(scope, receive, send)
+
+    await asyncio.get_event_loop().run_in_executor(wsgi.executor, app.wait_for_buffered_scores)
+    store = scorestore.score_store(report_db(), app.SCORE_STORAGE)
+    cursor = app.find_scores(start_time, end_time, sort, arg_int(args, 'skip'), arg_int(args, 'limit'), after, store=store, venues=arg_venues(args))
+
+    headers = {}
+    if output == 'ndjson':
+        content_type = 'application/x-ndjson'
+
+        def row(score):
+            return streaming.dumps(reports.score_json(score), app.CustomJSONEncoder) + '\n'
+    elif output == 'csv':
+        filename = "VR Scores {} to {}".format(start_time.isoformat()[:10], end_time.isoformat()[:10])
+        headers['Content-Disposition'] = streaming.attachment(filename + '.csv')
+        content_type = 'text/csv; charset=utf-8'
+        row = reports.score_line(',', '\n')
+    else:
+        content_type = 'text/text; charset=utf-8'
+        row = reports.score_line('|', '~~')
+
+    await until_disconnected(receive, stream_report(send, cursor, row, content_type, headers, export_encoding(scope)))
+
+
+async def players(scope, receive, send, args):
+    # GET /players, see app.players
+    output = args.get('output', 'pipe')
+    if output in ['json', 'html', 'parquet']:
+        return await wsgi(scope, receive, send)
+
+    try:
+        start_time, end_time = report_range(args)
+        sort = args.get('sort', 'time')
+        if sort == 'time':
+            sort = 'updatedAt'
+        elif sort == 'score':
+            sort = 'scores' if app.SCORE_STORAGE == 'collection' else 'bestScore'
+        after = report_after(args, sort)
+    except ValueError as e:
+        return await respond(send, 400, str(e))
+
+    if app.report_archive.partitions('players', start_time, end_time):
+        # merged with the archived players by app.find_archived
+        return await wsgi(scope, receive, send)
+
+    fields = app.player_presenter if output == 'ndjson' else app.player_line_presenter
+    cursor = app.find_players(start_time, end_time, sort, arg_int(args, 'skip'), arg_int(args, 'limit'), after, fields, db=report_db(), venues=arg_venues(args))
+
+    headers = {}
+    if output == 'ndjson':
+        content_type = 'application/x-ndjson'
+        player_json = reports.player_json(app.player_presenter)
+
+        def row(player):
+            return streaming.dumps(player_json(player), app.CustomJSONEncoder) + '\n'
+    elif output == 'csv':
+        filename = "VR Players {} to {}".format(start_time.isoformat()[:10], end_time.isoformat()[:10])
+        headers['Content-Disposition'] = streaming.attachment(filename + '.csv')
+        content_type = 'text/csv; charset=utf-8'
+        row = reports.player_line(',')
+    else:
+        content_type = 'text/text; charset=utf-8'
+        row = reports.player_line('|')
+
+    await until_disconnected(receive, stream_report(send, cursor, row, content_type, headers, export_encoding(scope)))
+
+
+# pattern, route rule as Flask names it in request metrics and handler
+ROUTES = [
+    (re.compile(r'^/station/([^/]+)/player$'), '/station/<station>/player', station_player),
+    (re.compile(r'^/station/([^/]+)/player/events$'), '/station/<station>/player/events', station_player_events),
+    (re.compile(r'^/scoresraw$'), '/scoresraw', scores_raw),
+    (re.compile(r'^/players$'), '/players', players),
+]
+
+
+async def measured(scope, receive, send, rule, route, *args):
+    # records the same request metrics as metrics.RequestMetrics does for Flask
+    started = time.time()
+    response = {'status': '500', 'bytes': 0}
+
+    async def counted(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = str(message['status'])
+        else:
+            response['bytes'] += len(message.get('body', b''))
+        await send(message)
+
+    try:
+        await route(scope, receive, counted, *args)
+    finally:
+        if not scope.get('metrics.wsgi'):
+            labels = {'route': rule, 'method': scope['method'], 'status': response['status']}
+            app.metrics_registry.observe('marketcity_http_request_duration_seconds', labels, time.time() - started)
+            app.metrics_registry.inc('marketcity_http_response_bytes_total', {'route': rule}, response['bytes'])
+            app.metrics_registry.flush()
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await asyncio.get_event_loop().run_in_executor(wsgi.executor, app.startup)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    if scope['method'] == 'GET':
+        for pattern, rule, route in ROUTES:
+            match = pattern.match(scope['path'])
+            if match:
+                args = {name: values[0] for name, values in parse_qs(scope['query_string'].decode('latin-1'), keep_blank_values=True).items()}
+                try:
+                    return await measured(scope, receive, send, rule, route, args, *match.groups())
+                except Exception:
+                    logging.exception('[ASGI] %s %s failed', scope['method'], scope['path'])
+                    raise
+
+    await wsgi(scope, receive, send)
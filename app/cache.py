@@ -0,0 +1,202 @@
+from collections import OrderedDict
+import functools
+import hashlib
+import logging
+import pickle
+import struct
+import threading
+import time
+
+from flask import Response, make_response, request
+
+# Short lived cache of whole GET responses for routes that stations and
+# dashboards poll. Entries are keyed on the route, the query args and the
+# generation of every tag the route depends on, writes bump the generation
+# of the tags they change so the next request misses. Every response carries
+# an ETag, a request with a matching If-None-Match gets a 304.
+#
+# Backends, chosen with CACHE_BACKEND
+# local - an LRU in each process, invalidation only reaches the process that
+#         wrote, other processes serve their entry until the TTL runs out
+# uwsgi - uWSGI's shared memory cache, shared by every worker, needs
+#         cache2 = name=responses,items=1000,blocksize=4096,blocks=8192,bitmap=1,purge_lru=1
+#         in uwsgi.ini, the default; outside uWSGI (e.g. flask run) the local
+#         backend is used instead
+# redis - a Redis server at CACHE_REDIS_URL, needs the redis package
+# none  - no caching
+
+
+class LocalBackend(object):
+    """ LRU of at most max_entries entries in this process """
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._generations = {}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def generations(self, tags):
+        with self._lock:
+            return [self._generations.get(tag, 0) for tag in tags]
+
+    def bump(self, tags):
+        with self._lock:
+            for tag in tags:
+                self._generations[tag] = self._generations.get(tag, 0) + 1
+
+
+class UwsgiBackend(object):
+    """ uWSGI cache2 shared by every worker, LRU when configured with purge_lru """
+
+    def __init__(self, name='responses'):
+        import uwsgi
+        self.uwsgi = uwsgi
+        self.name = name
+
+    def get(self, key):
+        value = self.uwsgi.cache_get(key, self.name)
+        return pickle.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl):
+        # entries larger than the cache blocks are not stored
+        self.uwsgi.cache_update(key, pickle.dumps(value), int(max(1, ttl)), self.name)
+
+    def generations(self, tags):
+        # cache_inc keeps a generation as a native 64 bit integer
+        generations = []
+        for tag in tags:
+            value = self.uwsgi.cache_get('generation:' + tag, self.name)
+            generations.append(struct.unpack('q', value)[0] if value else 0)
+        return generations
+
+    def bump(self, tags):
+        # atomic, so two workers bumping the same tag never lose a generation
+        for tag in tags:
+            self.uwsgi.cache_inc('generation:' + tag, 1, 0, self.name)
+
+
+class RedisBackend(object):
+    """ Redis, LRU when the server runs with maxmemory-policy allkeys-lru """
+
+    def __init__(self, url):
+        import redis
+        self.redis = redis.StrictRedis.from_url(url)
+
+    def get(self, key):
+        value = self.redis.get('cache:' + key)
+        return pickle.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl):
+        self.redis.set('cache:' + key, pickle.dumps(value), px=int(ttl * 1000))
+
+    def generations(self, tags):
+        if not tags:
+            return []
+        return [int(generation or 0) for generation in self.redis.mget(['generation:' + tag for tag in tags])]
+
+    def bump(self, tags):
+        pipeline = self.redis.pipeline()
+        for tag in tags:
+            pipeline.incr('generation:' + tag)
+        pipeline.execute()
+
+
+# response headers kept with a cached entry
+CACHED_HEADERS = ['Content-Type', 'Content-Disposition']
+
+
+class ResponseCache(object):
+    """ Caches GET responses of the views decorated with cached() """
+
+    def __init__(self, backend, ttl, registry=None):
+        self.backend = backend
+        self.ttl = ttl
+        self.registry = registry
+        if registry is not None:
+            registry.define('marketcity_cache_requests_total', 'counter', 'Cached route requests by result, hit, miss or not_modified')
+
+    def key(self, args, tags):
+        # route and query args, a missing ?to= means now so it is rounded down to the TTL
+        args = sorted((name, value) for name, value in args.items(multi=True) if value != '')
+        if 'to' not in dict(args):
+            args.append(('to', int(time.time() // self.ttl)))
+        return '{}|{}|{}'.format(request.path, args, self.backend.generations(tags))
+
+    def invalidate(self, *tags):
+        if self.backend is not None:
+            self.backend.bump(tags)
+
+    def count(self, route, result):
+        if self.registry is not None:
+            self.registry.inc('marketcity_cache_requests_total', {'route': route, 'result': result})
+
+    def cached(self, *tags):
+        # tags are formatted with the view arguments e.g. 'station:{station}'
+        def decorate(view):
+            @functools.wraps(view)
+            def cached_view(**kwargs):
+                if self.backend is None or request.method != 'GET':
+                    return view(**kwargs)
+
+                route = request.url_rule.rule
+                key = self.key(request.args, [tag.format(**kwargs) for tag in tags])
+                entry = self.backend.get(key)
+                if entry is None:
+                    response = make_response(view(**kwargs))
+                    if response.status_code != 200:
+                        return response
+                    body = response.get_data()
+                    entry = {
+                        'body': body,
+                        'etag': hashlib.sha1(body).hexdigest(),
+                        'headers': [(name, response.headers[name]) for name in CACHED_HEADERS if name in response.headers]
+                    }
+                    self.backend.set(key, entry, self.ttl)
+                    result = 'miss'
+                else:
+                    result = 'hit'
+
+                if request.if_none_match.contains(entry['etag']):
+                    self.count(route, 'not_modified')
+                    response = Response(status=304)
+                else:
+                    self.count(route, result)
+                    response = Response(entry['body'], headers=entry['headers'])
+                response.set_etag(entry['etag'])
+                return response
+            return cached_view
+        return decorate
+
+
+def backend(name, max_entries=1000, redis_url=None):
+    if name == 'none':
+        return None
+    if name == 'uwsgi':
+        try:
+            return UwsgiBackend()
+        except ImportError:
+            # not running under uWSGI, a write only invalidates the entries of its own process
+            logging.warning('[CACHE] Not running under uWSGI, caching responses in each process')
+            return LocalBackend(max_entries)
+    if name == 'redis':
+        return RedisBackend(redis_url)
+    return LocalBackend(max_entries)
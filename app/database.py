@@ -0,0 +1,161 @@
+import os
+import threading
+import time
+
+from pymongo import monitoring, read_preferences
+from pymongo.write_concern import WriteConcern
+
+# Mongo client settings from the environment, so pools, timeouts and
+# durability can be tuned per deployment without changing the code.
+# Unset values keep the driver defaults.
+
+# MongoClient option and the environment variable it is read from
+CLIENT_OPTIONS = [
+    ('maxPoolSize', 'MONGO_MAX_POOL_SIZE'),
+    ('minPoolSize', 'MONGO_MIN_POOL_SIZE'),
+    ('maxIdleTimeMS', 'MONGO_MAX_IDLE_TIME_MS'),
+    ('waitQueueTimeoutMS', 'MONGO_WAIT_QUEUE_TIMEOUT_MS'),
+    ('connectTimeoutMS', 'MONGO_CONNECT_TIMEOUT_MS'),
+    ('socketTimeoutMS', 'MONGO_SOCKET_TIMEOUT_MS'),
+    ('serverSelectionTimeoutMS', 'MONGO_SERVER_SELECTION_TIMEOUT_MS'),
+]
+
+READ_PREFERENCES = {
+    'primary': read_preferences.Primary(),
+    'primaryPreferred': read_preferences.PrimaryPreferred(),
+    'secondary': read_preferences.Secondary(),
+    'secondaryPreferred': read_preferences.SecondaryPreferred(),
+    'nearest': read_preferences.Nearest(),
+}
+
+
+def mongo_uri(database='marketcity'):
+    # MONGO_URI wins over MONGO_HOST
+    host = os.environ.get('MONGO_HOST', '127.0.0.1')
+    return os.environ.get('MONGO_URI', 'mongodb://{}:27017/{}'.format(host, database))
+
+
+def client_options(environ=os.environ):
+    options = {}
+    for option, name in CLIENT_OPTIONS:
+        if environ.get(name):
+            options[option] = int(environ[name])
+    return options
+
+
+def read_preference(name):
+    # None (the client's read preference) when name is empty
+    if not name:
+        return None
+    if name not in READ_PREFERENCES:
+        raise ValueError('Unknown read preference {}, use one of {}'.format(name, ', '.join(READ_PREFERENCES)))
+    return READ_PREFERENCES[name]
+
+
+def write_concern(spec):
+    # 'majority', '1' or 'w=1,j=true,wtimeout=500', None (the client's write concern) when empty
+    if not spec:
+        return None
+    options = {}
+    for part in spec.split(','):
+        name, _, value = part.strip().partition('=')
+        if not value:
+            name, value = 'w', name
+        if name == 'j':
+            options['j'] = value.lower() in ('1', 'true')
+        elif name == 'w':
+            options['w'] = int(value) if value.isdigit() else value
+        elif name == 'wtimeout':
+            options['wtimeout'] = int(value)
+        else:
+            raise ValueError('Unknown write concern option {} in {}'.format(name, spec))
+    return WriteConcern(**options)
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    """ How long requests wait to check a connection out of the pool
+
+    A growing wait means the workers and threads need more connections than
+    maxPoolSize allows, waits that hit waitQueueTimeoutMS are counted as
+    timeouts. Counts are for this process since it started.
+    """
+
+    # upper bounds in seconds of the wait histogram
+    BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.buckets = [0] * (len(self.BUCKETS) + 1)
+        self.open = 0
+        self.checked_out = 0
+
+    def _waited(self):
+        started = getattr(self._local, 'started', None)
+        self._local.started = None
+        return time.time() - started if started is not None else 0.0
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.time()
+
+    def connection_checked_out(self, event):
+        wait = self._waited()
+        bucket = len(self.BUCKETS)
+        for i, bound in enumerate(self.BUCKETS):
+            if wait <= bound:
+                bucket = i
+                break
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            self.buckets[bucket] += 1
+
+    def connection_check_out_failed(self, event):
+        self._waited()
+        with self._lock:
+            if event.reason == monitoring.ConnectionCheckOutFailedReason.TIMEOUT:
+                self.timeouts += 1
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out -= 1
+
+    def connection_created(self, event):
+        with self._lock:
+            self.open += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.open -= 1
+
+    def pool_created(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'pid': os.getpid(),
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'waitSeconds': self.wait_total,
+                'waitMaxSeconds': self.wait_max,
+                'waitAverageSeconds': self.wait_total / self.checkouts if self.checkouts else 0.0,
+                'waitHistogram': dict(zip([str(bound) for bound in self.BUCKETS] + ['+Inf'], self.buckets)),
+                'open': self.open,
+                'checkedOut': self.checked_out
+            }
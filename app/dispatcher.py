@@ -0,0 +1,169 @@
+import datetime
+import threading
+import time
+import uuid
+
+import pymongo
+from pymongo.errors import DuplicateKeyError
+
+# players who signed up longer ago than this are no longer waiting, as on /next/<station>
+WAITING_WINDOW = datetime.timedelta(days=1)
+
+# seconds a transition of a station's next player holds it while it writes the
+# player's flags, see lease
+NEXT_PLAYER_LEASE = 5
+
+
+def lease(seconds=NEXT_PLAYER_LEASE):
+    # set on next_player by the write that wins a transition and taken off once the
+    # player is written, no other transition of the station (or the player, as a
+    # player is at one station at a time) wins meanwhile, so the player's flags are
+    # written in the order the transitions happened
+    return {'lease': uuid.uuid4().hex, 'leaseUntil': datetime.datetime.utcnow() + datetime.timedelta(seconds=seconds)}
+
+
+def unleased():
+    # no transition is writing the player, or it died and its lease ran out
+    return {'leaseUntil': {'$not': {'$gt': datetime.datetime.utcnow()}}}
+
+
+def end_lease(db, station, held):
+    db.next_player.update_one({'_id': station, 'lease': held['lease']}, {'$unset': {'lease': '', 'leaseUntil': ''}})
+
+
+class Dispatcher(object):
+    """ The queue of players waiting to play, handed to stations as they free up
+
+    The queue collection holds one document per waiting player
+    {'_id': email, 'displayName', 'priority', 'enqueuedAt'}
+    and is served highest priority first, then first come first served. pop()
+    takes the head with a single find_one_and_delete, so two workers can never
+    hand the same player to two stations. Players queued longer than window ago
+    are skipped and a TTL index on enqueuedAt removes them, see indexes.py.
+
+    assign() gives the head of the queue to a station with no next player, the
+    same conditional write an operator's assignment makes. assigned is called
+    with the station after each assignment, e.g. to tell the station.
+
+    waiting() reads the queue from an in memory copy, refreshed after every
+    change made by this process and at least every mirror_ttl seconds for the
+    changes of other processes.
+    """
+
+    def __init__(self, db, assigned=None, mirror_ttl=1, window=WAITING_WINDOW):
+        self.db = db
+        self.assigned = assigned
+        self.mirror_ttl = mirror_ttl
+        self.window = window
+        self._lock = threading.Lock()
+        self._mirror = []
+        self._mirrored = 0
+
+    def _changed(self):
+        self._mirrored = 0
+
+    def _fresh(self):
+        # players still waiting, the TTL monitor only removes expired ones every minute
+        return {'enqueuedAt': {'$gte': datetime.datetime.utcnow() - self.window}}
+
+    def enqueue(self, email, display_name, priority=0, now=None):
+        # signing up again keeps a player's place in the queue while they are still waiting
+        # returns False for a player already at a station, who is not queued again
+        if self.db.next_player.find_one({'email': email}, {'_id': True}):
+            return False
+        self.db.queue.delete_one({'_id': email, 'enqueuedAt': {'$lt': datetime.datetime.utcnow() - self.window}})
+        self.db.queue.update_one({'_id': email}, {'$setOnInsert': {
+            'displayName': display_name,
+            'priority': priority,
+            'enqueuedAt': now or datetime.datetime.utcnow()
+        }}, upsert=True)
+        self._changed()
+        return True
+
+    def remove(self, email):
+        # a player an operator picked by hand
+        self.db.queue.delete_one({'_id': email})
+        self._changed()
+
+    def pop(self):
+        head = self.db.queue.find_one_and_delete(self._fresh(), sort=[('priority', pymongo.DESCENDING), ('enqueuedAt', pymongo.ASCENDING)])
+        self._changed()
+        return head
+
+    def push_back(self, head):
+        # put a popped player back in their place
+        try:
+            self.db.queue.insert_one(head)
+        except DuplicateKeyError:
+            # signed up again in the meantime
+            pass
+        self._changed()
+
+    def assign(self, station):
+        # returns the player given to the station, None when it has a next player or nobody is waiting
+        while True:
+            if self.db.next_player.find_one({'_id': station}, {'_id': True}):
+                return None
+            head = self.pop()
+            if not head:
+                return None
+
+            held = lease()
+            try:
+                result = self.db.next_player.update_one({'_id': station}, {'$setOnInsert': dict(held, **{
+                    'email': head['_id'],
+                    'displayName': head.get('displayName', ''),
+                    'isReady': False
+                })}, upsert=True)
+                assigned = result.upserted_id is not None
+            except DuplicateKeyError:
+                if self.db.next_player.find_one({'email': head['_id']}, {'_id': True}):
+                    # the player is at another station, they are not waiting any more
+                    continue
+                assigned = False
+            if not assigned:
+                # an operator got there first
+                self.push_back(head)
+                return None
+
+            self.db.players.update_one({'_id': head['_id']}, {'$unset': {'waiting': '', 'started': ''}})
+            end_lease(self.db, station, held)
+            if self.assigned:
+                self.assigned(station)
+            return head
+
+    def free_stations(self):
+        # stations that have reported a status and have no next player
+        busy = set(self.db.next_player.distinct('_id'))
+        return [station for station in self.db.station.distinct('_id') if station not in busy]
+
+    def dispatch(self, stations=None):
+        # fill the stations (every free station by default) from the queue, returns the number assigned
+        count = 0
+        for station in (self.free_stations() if stations is None else stations):
+            if self.assign(station):
+                count += 1
+            elif not self.db.queue.find_one(self._fresh(), {'_id': True}):
+                break
+        return count
+
+    def waiting(self):
+        # the queue in the order it is served
+        with self._lock:
+            if time.time() - self._mirrored >= self.mirror_ttl:
+                self._mirror = list(self.db.queue.find(self._fresh()).sort([('priority', pymongo.DESCENDING), ('enqueuedAt', pymongo.ASCENDING)]))
+                self._mirrored = time.time()
+            return list(self._mirror)
+
+    def rebuild(self):
+        # queue every player still waiting who has no station, oldest signup first
+        assigned = set(doc.get('email') for doc in self.db.next_player.find({}, {'email': True}))
+        self.db.queue.delete_many({})
+        count = 0
+        query = {'waiting': True, 'updatedAt': {'$gte': datetime.datetime.utcnow() - self.window}}
+        for player in self.db.players.find(query).sort('updatedAt', pymongo.ASCENDING):
+            if player['_id'] in assigned:
+                continue
+            self.enqueue(player['_id'], player.get('displayName', ''), now=player.get('updatedAt'))
+            count += 1
+        return count
@@ -0,0 +1,75 @@
+import logging
+import threading
+
+
+class StationEvents(object):
+    """ Notifies waiting requests when the next player of a station changes
+
+    Every change bumps a version number per station, requests remember the
+    version they last saw and block until it moves on or they time out.
+    Publishing only reaches requests in the same process, other processes
+    pick the change up from the mongo change stream (when available) or on
+    their next timeout.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._versions = {}
+        # bumped for changes every station cares about e.g. a new signup
+        self._everyone = 0
+        self._watcher = None
+        # called with the station (None for every station) on each change
+        self._listeners = []
+
+    def _version(self, station):
+        return self._versions.get(station, 0) + self._everyone
+
+    def version(self, station):
+        with self._condition:
+            return self._version(station)
+
+    def listen(self, listener):
+        # listener must not block, it is called while publishing
+        with self._condition:
+            self._listeners.append(listener)
+
+    def publish(self, station):
+        with self._condition:
+            self._versions[station] = self._versions.get(station, 0) + 1
+            self._condition.notify_all()
+            for listener in self._listeners:
+                listener(station)
+
+    def publish_all(self):
+        with self._condition:
+            self._everyone += 1
+            self._condition.notify_all()
+            for listener in self._listeners:
+                listener(None)
+
+    def wait(self, station, version, timeout):
+        # returns the latest version, which equals version when timed out
+        with self._condition:
+            self._condition.wait_for(lambda: self._version(station) != version, timeout)
+            return self._version(station)
+
+    def watch(self, collection):
+        # publish changes made by other processes, needs mongo running as a replica set
+        # safe to call on every request, only one watcher is ever started per process
+        if self._watcher:
+            return self._watcher
+
+        def run():
+            try:
+                with collection.watch() as stream:
+                    for change in stream:
+                        self.publish(change['documentKey']['_id'])
+            except Exception:
+                logging.exception('[EVENTS] Stopped watching %s for changes', collection.name)
+
+        with self._condition:
+            if not self._watcher:
+                self._watcher = threading.Thread(target=run, name='station-events')
+                self._watcher.daemon = True
+                self._watcher.start()
+            return self._watcher
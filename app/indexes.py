@@ -0,0 +1,120 @@
+import logging
+import pymongo
+
+# Indexes every report query relies on, so none of them scans a whole
+# collection or sorts in memory. Created at startup, creating an index
+# that already exists does nothing.
+# An index is a list of keys or a (keys, options) pair e.g. for unique indexes.
+INDEXES = {
+    'players': [
+        # /next/<station> players waiting to play, newest first
+        [('waiting', pymongo.ASCENDING), ('updatedAt', pymongo.DESCENDING)],
+        # /players?sort=time, _id breaks ties for ?after= pages
+        [('updatedAt', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)],
+        # /players?sort=score
+        [('scores', pymongo.DESCENDING), ('updatedAt', pymongo.DESCENDING)],
+        # /players?sort=score with SCORE_STORAGE=bucket
+        [('bestScore', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)],
+        # /stats wait from signup to first score per hour
+        [('firstScoreAt', pymongo.ASCENDING)],
+    ],
+    'scores': [
+        # /scores and /scoresraw?sort=score, ranges over _id and _id breaks ties for ?after= pages
+        [('score', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)],
+    ],
+    'leaderboard': [
+        # /scores top of the board per hour bucket
+        [('score', pymongo.DESCENDING), ('bucket', pymongo.ASCENDING)],
+        # entries old enough to archive, see archive.archive_leaderboard
+        [('bucket', pymongo.ASCENDING)],
+    ],
+    'next_player': [
+        # a player is the next player of one station at a time, see manage_next_player
+        ([('email', pymongo.ASCENDING)], {'unique': True}),
+    ],
+    'queue': [
+        # the head of the waiting queue, see dispatcher.Dispatcher.pop
+        [('priority', pymongo.DESCENDING), ('enqueuedAt', pymongo.ASCENDING)],
+        # players stop waiting after dispatcher.WAITING_WINDOW (a day)
+        ([('enqueuedAt', pymongo.ASCENDING)], {'expireAfterSeconds': 24 * 3600}),
+    ],
+    'sync': [
+        # rows claimed by a sync sender, see outbox.Outbox.claim
+        [('claim', pymongo.ASCENDING)],
+        # rows of a player held by other senders and signups to compact
+        [('group', pymongo.ASCENDING), ('leaseUntil', pymongo.ASCENDING)],
+    ],
+    'sync_dead': [
+        # dead letters old enough to archive, see archive.archive_sync_dead
+        [('diedAt', pymongo.ASCENDING)],
+    ],
+    'score_buckets': [
+        # one bucket per hour per station at each venue
+        ([('venue', pymongo.ASCENDING), ('hour', pymongo.ASCENDING), ('station', pymongo.ASCENDING)], {'unique': True}),
+        # reports read a range of hours of every venue
+        [('hour', pymongo.ASCENDING)],
+    ],
+}
+
+# Reports of one venue (?venue=) on a server that gets the data of many, with
+# VENUE_INDEXES=1. Every index starts with the venue, so a collection can be
+# sharded on {venue: 1, _id: 1} and a venue's reports stay on its shard.
+VENUE_INDEXES = {
+    'players': [
+        [('venue', pymongo.ASCENDING), ('updatedAt', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)],
+        [('venue', pymongo.ASCENDING), ('bestScore', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)],
+        [('venue', pymongo.ASCENDING), ('firstScoreAt', pymongo.ASCENDING)],
+    ],
+    'scores': [
+        [('venue', pymongo.ASCENDING), ('_id', pymongo.DESCENDING)],
+        [('venue', pymongo.ASCENDING), ('score', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)],
+    ],
+    'leaderboard': [
+        [('venue', pymongo.ASCENDING), ('score', pymongo.DESCENDING), ('bucket', pymongo.ASCENDING)],
+    ],
+}
+
+# Indexes replaced by the ones above, dropped when the indexes are ensured
+DROPPED = {
+    # unique per station and hour, stations of different venues share their ids
+    'score_buckets': ['hour_1_station_1'],
+}
+
+# Plan stages that mean a query is not served by an index
+SLOW_STAGES = ['COLLSCAN', 'SORT']
+
+
+def ensure_indexes(db, venues=False):
+    for indexes_of in [INDEXES, VENUE_INDEXES] if venues else [INDEXES]:
+        for collection, indexes in indexes_of.items():
+            for index in indexes:
+                keys, options = index if isinstance(index, tuple) else (index, {})
+                db[collection].create_index(keys, background=True, **options)
+                logging.debug('[INDEXES] Ensured index %s on %s', keys, collection)
+
+    # after their replacements exist, so a unique key is always enforced
+    for collection, names in DROPPED.items():
+        for name in names:
+            if name in db[collection].index_information():
+                db[collection].drop_index(name)
+                logging.info('[INDEXES] Dropped index %s on %s', name, collection)
+
+
+def plan_stages(plan):
+    # every stage in an explain() winning plan, depth first
+    yield plan.get('stage')
+    if 'inputStage' in plan:
+        for stage in plan_stages(plan['inputStage']):
+            yield stage
+    for input_stage in plan.get('inputStages', []):
+        for stage in plan_stages(input_stage):
+            yield stage
+
+
+def slow_stages(cursor):
+    # stages of the winning plan for a cursor that are not served by an index
+    explain = cursor.explain()
+    plan = explain['queryPlanner']['winningPlan']
+    # newer servers wrap the plan for the slot based engine
+    plan = plan.get('queryPlan', plan)
+    return [stage for stage in plan_stages(plan) if stage in SLOW_STAGES]
@@ -0,0 +1,198 @@
+import atexit
+import fcntl
+import glob
+import logging
+import os
+import threading
+import time
+import uuid
+
+from bson import json_util
+
+
+class ScoreBuffer(object):
+    """ Write-behind buffer for incoming scores
+
+    append() writes the record to a local journal file and keeps it in memory,
+    so the request can be answered without waiting on mongo. A background
+    thread hands the buffered records to write() in micro batches.
+
+    Each process journals into its own segments
+    <directory>/scores-<token>-<seq>.journal and holds a lock on
+    scores-<token>.lock while it runs. At every flush the current segment is
+    closed and a new one started, the old segment is removed once its records
+    were written. Segments left behind by a process that died (its lock file
+    is no longer locked) are replayed by the next buffer that starts or waits
+    for the other processes, write() must therefore ignore records it has seen
+    before.
+    """
+
+    def __init__(self, directory, write, batch_size=500, interval=0.05, fsync=False):
+        self.directory = directory
+        self.write = write
+        self.batch_size = batch_size
+        self.interval = interval
+        self.fsync = fsync
+
+        self._lock = threading.Lock()
+        # only one flush at a time, between the writer thread and readers
+        self._flushing = threading.Lock()
+        self._wake = threading.Event()
+        self._pid = None
+        self._thread = None
+        self._token = None
+        self._lock_file = None
+        self._seq = 0
+        self._file = None
+        self._pending = []
+        # segments that could not be written yet, retried on the next flush
+        self._failed = []
+
+    def _path(self, token, seq):
+        return os.path.join(self.directory, 'scores-{}-{}.journal'.format(token, seq))
+
+    def _running(self, token):
+        # a process holds the lock of its segments while it runs, or while it replays them
+        try:
+            lock_file = open(os.path.join(self.directory, 'scores-{}.lock'.format(token)))
+        except (IOError, OSError):
+            return False
+        with lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except OSError:
+                return True
+            return False
+
+    def _open_segment(self):
+        self._seq += 1
+        self._file = open(self._path(self._token, self._seq), 'a')
+
+    def _start(self):
+        # started on first use so every forked worker gets its own journal and thread
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._pending = []
+        self._failed = []
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self._token = '{}-{}'.format(self._pid, uuid.uuid4().hex[:8])
+        self._lock_file = open(os.path.join(self.directory, 'scores-{}.lock'.format(self._token)), 'w')
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._seq = 0
+        self._open_segment()
+
+        self.recover()
+
+        self._thread = threading.Thread(target=self.run, name='score-buffer')
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.flush)
+        logging.info('[INGEST] Buffering scores in %s', self._path(self._token, self._seq))
+
+    def append(self, record):
+        line = json_util.dumps(record) + '\n'
+        with self._lock:
+            self._start()
+            self._file.write(line)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._pending.append(record)
+            if len(self._pending) >= self.batch_size:
+                self._wake.set()
+
+    def _rotate(self):
+        # hand the current segment over to be written and start a new one
+        with self._lock:
+            if not self._pending:
+                return None
+            path, records = self._file.name, self._pending
+            self._file.close()
+            self._pending = []
+            self._open_segment()
+            return path, records
+
+    def _write_segment(self, path, records):
+        try:
+            for i in range(0, len(records), self.batch_size):
+                self.write(records[i:i + self.batch_size])
+        except Exception:
+            logging.exception('[INGEST] Could not write %s buffered scores, retrying', len(records))
+            return False
+        os.remove(path)
+        return True
+
+    def flush(self):
+        # write every record appended so far, returns the number written
+        if self._pid != os.getpid():
+            return 0
+        with self._flushing:
+            segments, self._failed = self._failed, []
+            segment = self._rotate()
+            if segment is not None:
+                segments.append(segment)
+
+            written = 0
+            for path, records in segments:
+                if self._write_segment(path, records):
+                    written += len(records)
+                else:
+                    self._failed.append((path, records))
+            return written
+
+    def run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+    def wait_flushed(self, timeout):
+        # flush this process and wait for the other processes to write every
+        # record they had buffered when this was called
+        # returns False when some were still buffered after timeout seconds
+        self.flush()
+        # nobody else writes the segments of a process that died
+        self.recover()
+        own = self._path(self._token, self._seq) if self._pid == os.getpid() else None
+        waiting = []
+        for path in glob.glob(os.path.join(self.directory, 'scores-*.journal')):
+            token = os.path.basename(path)[len('scores-'):].rsplit('-', 1)[0]
+            try:
+                if path != own and os.path.getsize(path) > 0 and self._running(token):
+                    waiting.append(path)
+            except OSError:
+                pass
+
+        deadline = time.time() + timeout
+        while waiting and time.time() < deadline:
+            time.sleep(0.01)
+            waiting = [path for path in waiting if os.path.exists(path)]
+        return not waiting
+
+    def recover(self):
+        # replay the journals of processes that stopped before writing them
+        for lock_path in glob.glob(os.path.join(self.directory, 'scores-*.lock')):
+            token = os.path.basename(lock_path)[len('scores-'):-len('.lock')]
+            if token == self._token:
+                continue
+            with open(lock_path, 'a') as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    # still running
+                    continue
+
+                segments = glob.glob(os.path.join(self.directory, 'scores-{}-*.journal'.format(token)))
+                segments.sort(key=lambda path: int(path.rsplit('-', 1)[1].split('.')[0]))
+                for path in segments:
+                    with open(path) as f:
+                        records = [json_util.loads(line) for line in f if line.endswith('\n')]
+                    if records:
+                        logging.warning('[INGEST] Replaying %s buffered scores from %s', len(records), path)
+                    if not self._write_segment(path, records):
+                        break
+                else:
+                    os.remove(lock_path)
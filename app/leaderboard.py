@@ -0,0 +1,210 @@
+import datetime
+import heapq
+import pymongo
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from archive import entry_time, score_time
+
+# The leaderboard collection keeps the best score of each player for each hour
+# so the top of the board can be read without walking every raw score.
+# Each entry is uniquely identified by the hour bucket, the player email and the venue
+# e.g. {'_id': {'bucket': datetime, 'email': str, 'venue': str}, 'bucket', 'email', 'venue',
+#       'displayName', 'score', 'easteregg', 'scoreId'}
+BUCKET_SIZE = datetime.timedelta(hours=1)
+
+TOP_SIZE = 10
+
+score_fields = ['email', 'displayName', 'score', 'easteregg']
+
+
+def bucket_start(when):
+    # bucket times are stored as naive UTC like every other date in the db
+    return when.replace(minute=0, second=0, microsecond=0, tzinfo=None)
+
+
+def entry_id(bucket, email, venue):
+    return {'bucket': bucket, 'email': email, 'venue': venue}
+
+
+def record_score(db, score_id, email, display_name, score, easteregg, venue=None):
+    # keep the entry for this player and hour only if the new score beats it
+    bucket = bucket_start(score_id.generation_time)
+    try:
+        db.leaderboard.update_one({
+                '_id': entry_id(bucket, email, venue),
+                'score': {'$lt': score}
+            }, {
+                '$set': {
+                    'bucket': bucket,
+                    'email': email,
+                    'venue': venue,
+                    'displayName': display_name,
+                    'score': score,
+                    'easteregg': easteregg,
+                    'scoreId': score_id
+                }
+            }, upsert=True)
+    except DuplicateKeyError:
+        # an entry exists with a score at least as good as this one
+        pass
+
+
+def record_scores(db, scores):
+    # record_score for many score documents in one round trip
+    requests = []
+    for score in scores:
+        bucket = bucket_start(score['_id'].generation_time)
+        requests.append(pymongo.UpdateOne({
+                '_id': entry_id(bucket, score['email'], score.get('venue')),
+                'score': {'$lt': score['score']}
+            }, {
+                '$set': {
+                    'bucket': bucket,
+                    'email': score['email'],
+                    'venue': score.get('venue'),
+                    'displayName': score['displayName'],
+                    'score': score['score'],
+                    'easteregg': score['easteregg'],
+                    'scoreId': score['_id']
+                }
+            }, upsert=True))
+    if not requests:
+        return
+
+    try:
+        db.leaderboard.bulk_write(requests, ordered=False)
+    except BulkWriteError as e:
+        # duplicates are entries that already have a better score
+        if any(error['code'] != 11000 for error in e.details['writeErrors']):
+            raise
+
+
+def rebuild(db, store):
+    # recreate the leaderboard from every raw score
+    best = {}
+    for score in store.find(None, None, [('_id', pymongo.ASCENDING)], fields=score_fields + ['venue']):
+        key = (bucket_start(score['_id'].generation_time), score.get('email', ''), score.get('venue'))
+        if key not in best or best[key]['score'] < score.get('score', 0):
+            best[key] = {
+                '_id': entry_id(*key),
+                'bucket': key[0],
+                'email': key[1],
+                'venue': key[2],
+                'displayName': score.get('displayName', ''),
+                'score': score.get('score', 0),
+                'easteregg': score.get('easteregg', False),
+                'scoreId': score['_id']
+            }
+
+    db.leaderboard.delete_many({})
+    if best:
+        db.leaderboard.insert_many(list(best.values()), ordered=False)
+    return len(best)
+
+
+def _entries(cursor):
+    # leaderboard entries shaped like the raw scores they were taken from
+    for entry in cursor:
+        yield {
+            '_id': entry['scoreId'],
+            'email': entry.get('email', ''),
+            'displayName': entry.get('displayName', ''),
+            'score': entry.get('score', 0),
+            'easteregg': entry.get('easteregg', False)
+        }
+
+
+def _best(db, first_bucket, last_bucket, venues=None):
+    # best score per player for every whole bucket in [first_bucket, last_bucket)
+    query = {
+        'bucket': {
+            '$gte': first_bucket,
+            '$lt': last_bucket
+        }
+    }
+    if venues:
+        query['venue'] = {'$in': venues}
+    return db.leaderboard.find(query).sort('score', pymongo.DESCENDING)
+
+
+def _raw(store, start, end, venues=None):
+    # raw scores for a partial bucket at either end of the requested range
+    return store.find(start, end, [('score', pymongo.DESCENDING)], fields=score_fields, venues=venues)
+
+
+def unique_players(scores, limit=TOP_SIZE):
+    # first score seen for each email, skipping display names already shown
+    emails = set()
+    display_names = set()
+    for score in scores:
+        email = score.get('email', '')
+        if email in emails:
+            continue
+        emails.add(email)
+
+        display_name = score.get('displayName', '')
+        if display_name in display_names:
+            continue
+        display_names.add(display_name)
+
+        yield score
+        if len(display_names) >= limit:
+            return
+
+
+def _split(start, end):
+    # the whole buckets [first_bucket, last_bucket) of a range, None when there
+    # are none, and the partial hours at each end of it
+    first_bucket = bucket_start(start)
+    if first_bucket < start:
+        first_bucket += BUCKET_SIZE
+    last_bucket = bucket_start(end)
+
+    if first_bucket >= last_bucket:
+        return None, None, [(start, end)]
+
+    partial = []
+    if start < first_bucket:
+        partial.append((start, first_bucket))
+    if last_bucket < end:
+        partial.append((last_bucket, end))
+    return first_bucket, last_bucket, partial
+
+
+def cursors(db, store, start, end, venues=None):
+    # whole hour buckets come from the leaderboard, the partial hours at each
+    # end of the range from raw scores
+    # returns the leaderboard cursor (or None) and a list of raw score cursors
+    first_bucket, last_bucket, partial = _split(start, end)
+    raw = [_raw(store, partial_start, partial_end, venues) for partial_start, partial_end in partial]
+    if first_bucket is None:
+        return None, raw
+    return _best(db, first_bucket, last_bucket, venues), raw
+
+
+def _archived(archive, start, end, venues=None):
+    # the entries and raw scores of the range moved to an archive.Archive, each stream highest score first
+    def by_score(score):
+        return -score.get('score', 0)
+
+    first_bucket, last_bucket, partial = _split(start, end)
+    streams = [sorted(archive.find('scores', partial_start, partial_end, score_time, venues), key=by_score)
+               for partial_start, partial_end in partial]
+    if first_bucket is not None:
+        entries = archive.find('leaderboard', first_bucket, last_bucket, entry_time, venues)
+        streams.append(_entries(sorted(entries, key=by_score)))
+    return streams
+
+
+def top_scores(db, store, start, end, limit=TOP_SIZE, venues=None, archive=None):
+    # highest scores of unique players in the range, merged highest score first
+    # with an archive the ones moved out of mongo by `flask archive` are merged in
+    best, raw = cursors(db, store, start, end, venues)
+    streams = raw
+    if best is not None:
+        streams = [_entries(best)] + raw
+    if archive is not None:
+        streams += _archived(archive, start, end, venues)
+
+    merged = heapq.merge(*streams, key=lambda score: -score.get('score', 0))
+    return unique_players(merged, limit)
@@ -0,0 +1,253 @@
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+from pymongo import monitoring
+
+# Counters and histograms kept per process and written to a snapshot file
+# <directory>/<name>-<pid>.json, /metrics adds up the snapshots of every
+# process (uWSGI workers, sync-db.py) so it does not matter which worker
+# answers the scrape. Gauges are taken from the most recent snapshot.
+
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+COUNT_BUCKETS = [0, 1, 2, 3, 5, 10, 20, 50, 100]
+
+
+def label_key(labels):
+    return json.dumps(sorted((labels or {}).items()))
+
+
+class Registry(object):
+    """ Metrics of one process, see collect() for adding up every process """
+
+    def __init__(self, directory, name, interval=5):
+        self.directory = directory
+        self.name = name
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._pid = os.getpid()
+        self._written = 0
+        # called before every snapshot, e.g. to copy driver statistics in
+        self._collectors = []
+
+    def define(self, name, kind, help, buckets=None):
+        self._metrics[name] = {'type': kind, 'help': help, 'buckets': buckets, 'samples': {}}
+
+    def collector(self, collect):
+        self._collectors.append(collect)
+
+    def _reset_after_fork(self):
+        # a forked copy starts counting from nothing in its own file
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            for metric in self._metrics.values():
+                metric['samples'] = {}
+
+    def inc(self, name, labels=None, value=1):
+        with self._lock:
+            self._reset_after_fork()
+            samples = self._metrics[name]['samples']
+            key = label_key(labels)
+            samples[key] = samples.get(key, 0) + value
+
+    def set(self, name, labels=None, value=0):
+        with self._lock:
+            self._reset_after_fork()
+            self._metrics[name]['samples'][label_key(labels)] = value
+
+    def observe(self, name, labels=None, value=0):
+        with self._lock:
+            self._reset_after_fork()
+            metric = self._metrics[name]
+            key = label_key(labels)
+            sample = metric['samples'].get(key)
+            if sample is None:
+                sample = metric['samples'][key] = {'buckets': [0] * len(metric['buckets']), 'sum': 0, 'count': 0}
+            for i, bound in enumerate(metric['buckets']):
+                if value <= bound:
+                    sample['buckets'][i] += 1
+            sample['sum'] += value
+            sample['count'] += 1
+
+    def flush(self, force=False):
+        # write the snapshot, at most every interval seconds unless forced
+        now = time.time()
+        if not force and now - self._written < self.interval:
+            return
+        self._written = now
+
+        for collect in self._collectors:
+            try:
+                collect(self)
+            except Exception:
+                logging.exception('[METRICS] Collector failed')
+
+        with self._lock:
+            self._reset_after_fork()
+            snapshot = json.dumps({'updated': now, 'metrics': self._metrics})
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, '{}-{}.json'.format(self.name, self._pid))
+        with open(path + '.tmp', 'w') as f:
+            f.write(snapshot)
+        os.replace(path + '.tmp', path)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in labels) + '}'
+
+
+def collect(directory):
+    # Prometheus text format of every process snapshot in directory
+    merged = {}
+    for path in glob.glob(os.path.join(directory, '*.json')):
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+
+        for name, metric in snapshot['metrics'].items():
+            into = merged.setdefault(name, dict(metric, samples={}, updated={}))
+            for key, value in metric['samples'].items():
+                if metric['type'] == 'gauge':
+                    if snapshot['updated'] >= into['updated'].get(key, 0):
+                        into['samples'][key] = value
+                        into['updated'][key] = snapshot['updated']
+                elif metric['type'] == 'histogram':
+                    sample = into['samples'].setdefault(key, {'buckets': [0] * len(metric['buckets']), 'sum': 0, 'count': 0})
+                    sample['buckets'] = [a + b for a, b in zip(sample['buckets'], value['buckets'])]
+                    sample['sum'] += value['sum']
+                    sample['count'] += value['count']
+                else:
+                    into['samples'][key] = into['samples'].get(key, 0) + value
+
+    lines = []
+    for name in sorted(merged):
+        metric = merged[name]
+        lines.append('# HELP {} {}'.format(name, metric['help']))
+        lines.append('# TYPE {} {}'.format(name, metric['type']))
+        for key in sorted(metric['samples']):
+            labels = [tuple(label) for label in json.loads(key)]
+            value = metric['samples'][key]
+            if metric['type'] != 'histogram':
+                lines.append('{}{} {}'.format(name, format_labels(labels), value))
+                continue
+            for bound, count in zip(metric['buckets'], value['buckets']):
+                lines.append('{}_bucket{} {}'.format(name, format_labels(labels + [('le', bound)]), count))
+            lines.append('{}_bucket{} {}'.format(name, format_labels(labels + [('le', '+Inf')]), value['count']))
+            lines.append('{}_sum{} {}'.format(name, format_labels(labels), value['sum']))
+            lines.append('{}_count{} {}'.format(name, format_labels(labels), value['count']))
+    return '\n'.join(lines) + '\n'
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """ Counts mongo commands overall and for the request running on the thread """
+
+    def __init__(self, registry):
+        self.registry = registry
+        self._local = threading.local()
+        registry.define('marketcity_mongo_commands_total', 'counter', 'Mongo commands run')
+        registry.define('marketcity_mongo_command_seconds_total', 'counter', 'Seconds spent in mongo commands')
+        registry.define('marketcity_mongo_command_failures_total', 'counter', 'Mongo commands that failed')
+
+    def begin(self, capture=False):
+        # capture keeps a summary of every command, for the slow request log
+        self._local.request = {'commands': 0, 'seconds': 0.0, 'queries': [] if capture else None}
+        self._local.started = {}
+
+    def end(self):
+        request = getattr(self._local, 'request', None)
+        self._local.request = None
+        return request
+
+    def started(self, event):
+        request = getattr(self._local, 'request', None)
+        if request is not None and request['queries'] is not None:
+            command = {key: value for key, value in event.command.items() if key not in ('lsid', '$db', '$clusterTime', 'documents', 'updates', 'deletes')}
+            self._local.started[event.request_id] = '{}.{} {}'.format(event.database_name, event.command_name, command)[:500]
+
+    def _finished(self, event, failed):
+        seconds = event.duration_micros / 1000000.0
+        labels = {'command': event.command_name}
+        self.registry.inc('marketcity_mongo_commands_total', labels)
+        self.registry.inc('marketcity_mongo_command_seconds_total', labels, seconds)
+        if failed:
+            self.registry.inc('marketcity_mongo_command_failures_total', labels)
+
+        request = getattr(self._local, 'request', None)
+        if request is not None:
+            request['commands'] += 1
+            request['seconds'] += seconds
+            if request['queries'] is not None:
+                summary = self._local.started.pop(event.request_id, event.command_name)
+                request['queries'].append('{:.1f}ms {}'.format(seconds * 1000, summary))
+
+    def succeeded(self, event):
+        self._finished(event, False)
+
+    def failed(self, event):
+        self._finished(event, True)
+
+
+class RequestMetrics(object):
+    """ WSGI middleware timing every request until its last byte was sent
+
+    The route is read from environ['metrics.route'], set by the app once the
+    request was matched. Streamed reports are timed and counted while they
+    stream, including the mongo commands their cursors run.
+    """
+
+    def __init__(self, wsgi_app, registry, commands, slow=0):
+        self.wsgi_app = wsgi_app
+        self.registry = registry
+        self.commands = commands
+        self.slow = slow
+        registry.define('marketcity_http_request_duration_seconds', 'histogram', 'Request duration until the last byte', LATENCY_BUCKETS)
+        registry.define('marketcity_http_response_bytes_total', 'counter', 'Response bytes sent')
+        registry.define('marketcity_http_request_mongo_commands', 'histogram', 'Mongo commands per request', COUNT_BUCKETS)
+        registry.define('marketcity_http_request_mongo_seconds', 'histogram', 'Seconds in mongo commands per request', LATENCY_BUCKETS)
+
+    def __call__(self, environ, start_response):
+        started = time.time()
+        response = {'status': '500', 'bytes': 0}
+        self.commands.begin(capture=self.slow > 0)
+
+        def start(status, headers, exc_info=None):
+            response['status'] = status.split(' ', 1)[0]
+            return start_response(status, headers, exc_info)
+
+        result = None
+        try:
+            result = self.wsgi_app(environ, start)
+            for data in result:
+                response['bytes'] += len(data)
+                yield data
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+            self.record(environ, response, time.time() - started)
+
+    def record(self, environ, response, seconds):
+        request = self.commands.end() or {'commands': 0, 'seconds': 0.0, 'queries': None}
+        route = environ.get('metrics.route', 'unmatched')
+        labels = {'route': route, 'method': environ.get('REQUEST_METHOD'), 'status': response['status']}
+        self.registry.observe('marketcity_http_request_duration_seconds', labels, seconds)
+        self.registry.inc('marketcity_http_response_bytes_total', {'route': route}, response['bytes'])
+        self.registry.observe('marketcity_http_request_mongo_commands', {'route': route}, request['commands'])
+        self.registry.observe('marketcity_http_request_mongo_seconds', {'route': route}, request['seconds'])
+        self.registry.flush()
+
+        if self.slow and seconds >= self.slow:
+            query = environ.get('QUERY_STRING')
+            logging.warning('[SLOW] %s %s%s %s took %.3fs, %s bytes, %s mongo commands in %.3fs%s',
+                environ.get('REQUEST_METHOD'), environ.get('PATH_INFO'), '?' + query if query else '',
+                response['status'], seconds, response['bytes'], request['commands'], request['seconds'],
+                ''.join('\n    ' + query for query in request['queries'] or []))
@@ -0,0 +1,166 @@
+import datetime
+import logging
+import uuid
+
+import pymongo
+from bson import ObjectId
+
+# The sync collection is an outbox of requests to replay against the upstream
+# server, sent by sync-db.py (see SyncEngine).
+# {'_id': ObjectId, 'url', 'method', 'data', 'group', 'venue', 'attempts', 'leaseUntil', 'claim', 'error'}
+# - the _id is sent as the Idempotency-Key header (and as the id to /sync/batch)
+#   so a row sent again after a timeout is recognised upstream as a duplicate
+# - group is the player email, rows of a group are sent oldest first by one
+#   sender at a time
+# - senders claim rows by setting leaseUntil and their claim token, so many can
+#   drain the outbox in parallel; an expired lease means the sender died and
+#   the rows can be claimed again
+# - signups only carry the fields that changed, a new signup takes in the
+#   fields of the unclaimed signups of the same player queued right before it
+#   and removes them, never past another row of the player e.g. a score, which
+#   has to reach upstream after the signup it follows
+# - rows that can never be applied are moved to the sync_dead collection
+# - a sender given a venue only claims the rows of that venue (and rows queued
+#   before rows had a venue), so each venue's rows drain on their own
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+
+SIGNUP_URL = '/signup'
+
+
+def row(url, data, _id=None, method='post'):
+    return {
+        '_id': _id or ObjectId(),
+        'url': url,
+        'method': method,
+        'data': data,
+        'group': data.get('email') or url,
+        'venue': data.get('venue'),
+        'attempts': 0
+    }
+
+
+def group_key(req):
+    # rows queued before groups were stored
+    if 'group' in req:
+        return req['group']
+    data = req.get('data') or {}
+    return data.get('email') or req.get('url')
+
+
+def unclaimed(now):
+    # never claimed, or the lease ran out
+    return {'leaseUntil': {'$not': {'$gt': now}}}
+
+
+class Outbox(object):
+
+    def __init__(self, collection, dead, venue=None):
+        self.collection = collection
+        self.dead = dead
+        self.venue = venue
+
+    def _claimable(self, now):
+        query = unclaimed(now)
+        if self.venue:
+            query['venue'] = {'$in': [self.venue, None]}
+        return query
+
+    def add(self, req):
+        self.collection.insert_one(req)
+        if req['url'] == SIGNUP_URL:
+            self.compact(req)
+
+    def add_many(self, reqs):
+        # raises BulkWriteError e.g. for rows replayed from the ingest journal, see scorestore.bulk_errors
+        self.collection.insert_many(reqs, ordered=False)
+
+    def compact(self, req):
+        # older signups waiting to be sent are folded into this one, newer fields win
+        # only the signups after the last other row of the player, newest first until then
+        now = datetime.datetime.utcnow()
+        older = []
+        query = {'group': req['group'], '_id': {'$lt': req['_id']}}
+        for doc in self.collection.find(query, {'url': True, 'data': True, 'leaseUntil': True}).sort('_id', pymongo.DESCENDING):
+            if doc.get('url') != SIGNUP_URL or (doc.get('leaseUntil') and doc['leaseUntil'] > now):
+                break
+            older.insert(0, doc)
+        if not older:
+            return
+
+        data = {}
+        for doc in older:
+            data.update(doc.get('data') or {})
+        data.update(req['data'])
+        # only take in the rows still unclaimed when the fields are saved
+        if self.collection.update_one({'_id': req['_id'], 'claim': {'$exists': False}}, {'$set': {'data': data}}).modified_count:
+            req['data'] = data
+            removed = self.collection.delete_many({'_id': {'$in': [doc['_id'] for doc in older]}, 'claim': {'$exists': False}}).deleted_count
+            logging.debug('[OUTBOX] Compacted %s signups of %s', removed, req['group'])
+
+    def claim(self, limit, lease):
+        # claim up to limit rows oldest first for lease seconds, returns them oldest first
+        now = datetime.datetime.utcnow()
+        ids = [doc['_id'] for doc in self.collection.find(self._claimable(now), {'_id': True}).sort('_id', pymongo.ASCENDING).limit(limit)]
+        if not ids:
+            return []
+
+        token = uuid.uuid4().hex
+        query = self._claimable(now)
+        query['_id'] = {'$in': ids}
+        self.collection.update_many(query, {'$set': {'leaseUntil': now + datetime.timedelta(seconds=lease), 'claim': token}})
+        claimed = list(self.collection.find({'claim': token}).sort('_id', pymongo.ASCENDING))
+
+        # a group is sent by whoever holds its oldest row, give back the rows
+        # of groups another sender is part way through
+        groups = set(group_key(req) for req in claimed)
+        others = {}
+        for req in self.collection.find({'group': {'$in': list(groups)}, 'claim': {'$ne': token}, 'leaseUntil': {'$gt': now}}, {'group': True}):
+            others[req['group']] = min(others.get(req['group'], req['_id']), req['_id'])
+
+        keep = []
+        give_back = []
+        for req in claimed:
+            other = others.get(group_key(req))
+            if other is not None and other < req['_id']:
+                give_back.append(req['_id'])
+            else:
+                keep.append(req)
+        if give_back:
+            self.release(give_back)
+        return keep
+
+    def release(self, ids):
+        # let another sender claim the rows straight away
+        self.collection.update_many({'_id': {'$in': ids}}, {'$unset': {'leaseUntil': '', 'claim': ''}})
+
+    def done(self, ids):
+        self.collection.delete_many({'_id': {'$in': ids}})
+
+    def failed(self, req, error):
+        # keeps the row for the next attempt once its lease runs out
+        self.collection.update_one({'_id': req['_id']}, {
+            '$inc': {'attempts': 1},
+            '$set': {'error': error},
+            '$unset': {'leaseUntil': '', 'claim': ''}
+        })
+
+    def bury(self, req, error):
+        # move a row that can never be applied to the dead letter collection
+        doc = dict(req, error=error, attempts=req.get('attempts', 0) + 1, diedAt=datetime.datetime.utcnow())
+        doc.pop('leaseUntil', None)
+        doc.pop('claim', None)
+        self.dead.replace_one({'_id': doc['_id']}, doc, upsert=True)
+        self.collection.delete_one({'_id': req['_id']})
+        logging.warning('[OUTBOX] Moved %s %s to the dead letters: %s', req.get('method'), req.get('url'), error)
+
+    def requeue_dead(self):
+        # send the dead letters again, e.g. after fixing the upstream server
+        count = 0
+        for doc in self.dead.find():
+            req = {key: value for key, value in doc.items() if key not in ('error', 'diedAt')}
+            req['attempts'] = 0
+            self.collection.replace_one({'_id': req['_id']}, req, upsert=True)
+            self.dead.delete_one({'_id': doc['_id']})
+            count += 1
+        return count
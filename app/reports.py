@@ -0,0 +1,117 @@
+import datetime
+import time
+
+# Row formatters for the report routes, built once per format so each row is
+# a single str.format call with no lookups of seperators or field lists
+
+
+def projection(fields):
+    # only read the fields a report sends from mongo, _id is always included
+    return {field: 1 for field in fields}
+
+
+def object_id_time(oid):
+    # same as oid.generation_time.isoformat() without building a timezone aware datetime
+    return time.strftime('%Y-%m-%dT%H:%M:%S+00:00', time.gmtime(int.from_bytes(oid.binary[:4], 'big')))
+
+
+def object_id_datetime(oid):
+    # same as oid.generation_time without the timezone
+    return datetime.datetime.utcfromtimestamp(int.from_bytes(oid.binary[:4], 'big'))
+
+
+def score_line(seperator, newline):
+    # time, score, easteregg, email, displayName
+    line = seperator.join(['{}'] * 5) + newline
+    line = line.format
+
+    def format_score(score):
+        get = score.get
+        return line(
+            object_id_time(score['_id']),
+            get('score', 0),
+            get('easteregg', False),
+            get('email', ''),
+            get('displayName', '')
+        )
+    return format_score
+
+
+def score_json(score):
+    get = score.get
+    return {
+        'time': object_id_time(score['_id']),
+        'score': get('score', 0),
+        'easteregg': get('easteregg', False),
+        'email': get('email', ''),
+        'displayName': get('displayName', '')
+    }
+
+
+def player_line(seperator):
+    # the trailing quote has always been part of the players report
+    line = seperator.join(['{}'] * 8) + '"\n'
+    line = line.format
+
+    def format_player(player):
+        get = player.get
+        return line(
+            get('updatedAt').isoformat(),
+            get('hand', 'both'),
+            get('email', ''),
+            get('phone', ''),
+            get('postcode', ''),
+            get('displayName', ''),
+            get('firstName', ''),
+            get('lastName', '')
+        )
+    return format_player
+
+
+def station_player_line(player):
+    # email, displayName, hand and started of the next player, as read by the stations
+    return "{0}|{1}|{2}|{3}\n".format(
+        player.get('email'),
+        player.get('displayName', ''),
+        player.get('hand', 'right'),
+        player.get('started', False)
+    )
+
+
+def station_overview_line(station):
+    # station, then the fields of station_player_line, isReady, status and players waiting
+    return "{0}|{1}|{2}|{3}|{4}|{5}|{6}|{7}\n".format(
+        station['station'],
+        station.get('email') or '',
+        station.get('displayName') or '',
+        station.get('hand') or '',
+        station.get('started', False),
+        station.get('isReady', False),
+        station.get('status') or '',
+        station.get('waiting', 0)
+    )
+
+
+def player_json(fields):
+    def format_player(player):
+        get = player.get
+        return {field: get(field) for field in fields}
+    return format_player
+
+
+# columns of the parquet reports, (name, type, value of a document) see streaming.parquet
+SCORE_COLUMNS = [
+    ('time', 'timestamp', lambda score: object_id_datetime(score['_id'])),
+    ('score', 'int', lambda score: score.get('score', 0)),
+    ('easteregg', 'bool', lambda score: score.get('easteregg', False)),
+    ('email', 'string', lambda score: score.get('email', '')),
+    ('displayName', 'string', lambda score: score.get('displayName', ''))
+]
+
+PLAYER_COLUMNS = [
+    ('updatedAt', 'timestamp', lambda player: player.get('updatedAt')),
+    ('hand', 'string', lambda player: player.get('hand', 'both'))
+] + [
+    (field, 'string', lambda player, field=field: player.get(field, ''))
+    for field in ['email', 'phone', 'postcode', 'displayName', 'firstName', 'lastName']
+]
@@ -0,0 +1,226 @@
+import pymongo
+from bson import ObjectId
+from bson.son import SON
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from leaderboard import bucket_start
+
+# Scores are stored in one of two ways, chosen with SCORE_STORAGE
+# collection - one document per score in the scores collection (default)
+# bucket     - one document per station per hour in the score_buckets collection
+#              holding an array of compact entries, see BucketStore
+# Both stores give back score documents shaped the same way
+# {'_id': ObjectId, 'email', 'displayName', 'score', 'easteregg'}
+# Scores carry the venue they were played at, venues limits find and aggregate
+# to a list of venues
+
+
+def bulk_errors(e):
+    # index of each failed request in a bulk write and whether it was a duplicate key
+    return {
+        error['index']: 'duplicate' if error['code'] == 11000 else 'error'
+        for error in e.details['writeErrors']
+    }
+
+
+def time_range(start, end):
+    query = {}
+    if start is not None:
+        query['$gte'] = ObjectId.from_datetime(start)
+    if end is not None:
+        query['$lt'] = ObjectId.from_datetime(end)
+    return query
+
+
+class CollectionStore(object):
+    name = 'collection'
+
+    def __init__(self, db):
+        self.db = db
+
+    def insert(self, score, station):
+        # raises DuplicateKeyError when a score with the same _id was stored before
+        doc = dict(score, station=station)
+        self.db.scores.insert_one(doc)
+
+    def insert_many(self, scores):
+        # scores are (score, station) pairs
+        # returns {index: 'duplicate' or 'error'} for the scores that were not stored
+        try:
+            self.db.scores.insert_many([dict(score, station=station) for score, station in scores], ordered=False)
+        except BulkWriteError as e:
+            return bulk_errors(e)
+        return {}
+
+    def find(self, start, end, sort, skip=0, limit=0, extra=None, fields=None, venues=None):
+        # scores between start and end, extra is added to the query e.g. for keyset pages
+        query = {}
+        if venues:
+            query['venue'] = {'$in': venues}
+        if start is not None or end is not None:
+            query['_id'] = time_range(start, end)
+        if extra:
+            query = {'$and': [query, extra]}
+        projection = {field: 1 for field in fields} if fields else None
+        return self.db.scores.find(query, projection).sort(sort).skip(skip).limit(limit)
+
+    def aggregate(self, start, end, stages, venues=None):
+        # run pipeline stages over the scores between start and end, each with its station
+        query = {'_id': time_range(start, end)}
+        if venues:
+            query['venue'] = {'$in': venues}
+        return self.db.scores.aggregate([{'$match': query}] + stages, allowDiskUse=True)
+
+    def remove(self, scores):
+        # delete scores read with find, e.g. once they are archived
+        ids = [score['_id'] for score in scores]
+        for i in range(0, len(ids), 1000):
+            self.db.scores.delete_many({'_id': {'$in': ids[i:i + 1000]}})
+
+
+class BucketStore(object):
+    """ Scores grouped into one document per station per hour
+
+    {'_id', 'venue', 'station', 'hour', 'count', 'entries': [{'_id', 'e', 'd', 's', 'x'}]}
+    where the entries hold the score _id, email, displayName, score and easteregg.
+    Far fewer documents and index entries than one per score, and a new score is
+    a $push onto a document that is already in memory.
+    """
+    name = 'bucket'
+
+    entry_fields = SON([('email', 'e'), ('displayName', 'd'), ('score', 's'), ('easteregg', 'x')])
+
+    def __init__(self, db):
+        self.db = db
+
+    def _entry(self, score):
+        entry = {'_id': score['_id']}
+        for field, short in self.entry_fields.items():
+            entry[short] = score[field]
+        return entry
+
+    def _push(self, score, station):
+        # filter and update adding a score to its bucket unless it is there already
+        return {
+            'venue': score.get('venue'),
+            'station': station,
+            'hour': bucket_start(score['_id'].generation_time),
+            'entries._id': {'$ne': score['_id']}
+        }, {
+            '$push': {'entries': self._entry(score)},
+            '$inc': {'count': 1}
+        }
+
+    def _push_existing(self, score, station):
+        # when an upsert hits the unique venue, hour and station index either another
+        # request created the bucket at the same time or the entry is already there
+        result = self.db.score_buckets.update_one(*self._push(score, station))
+        return result.matched_count > 0
+
+    def insert(self, score, station):
+        # raises DuplicateKeyError when a score with the same _id was stored before
+        try:
+            self.db.score_buckets.update_one(*self._push(score, station), upsert=True)
+        except DuplicateKeyError:
+            if not self._push_existing(score, station):
+                raise
+
+    def insert_many(self, scores):
+        # scores are (score, station) pairs
+        # returns {index: 'duplicate' or 'error'} for the scores that were not stored
+        if not scores:
+            return {}
+        try:
+            self.db.score_buckets.bulk_write([
+                pymongo.UpdateOne(*self._push(score, station), upsert=True) for score, station in scores
+            ], ordered=False)
+        except BulkWriteError as e:
+            errors = bulk_errors(e)
+            for index, status in list(errors.items()):
+                if status == 'duplicate' and self._push_existing(*scores[index]):
+                    del errors[index]
+            return errors
+        return {}
+
+    def _unwind(self, start, end, keep, extra=None, venues=None):
+        # pipeline turning the buckets of the hours between start and end back into score documents
+        hours = {}
+        if start is not None:
+            hours['$gte'] = bucket_start(start)
+        if end is not None:
+            hours['$lt'] = end
+
+        buckets = {}
+        if venues:
+            buckets['venue'] = {'$in': venues}
+        if hours:
+            buckets['hour'] = hours
+
+        pipeline = []
+        if buckets:
+            pipeline.append({'$match': buckets})
+
+        score = {'_id': '$entries._id'}
+        for field, short in self.entry_fields.items():
+            if field in keep:
+                score[field] = '$entries.' + short
+        if 'station' in keep:
+            score['station'] = 1
+        if 'venue' in keep:
+            score['venue'] = 1
+        pipeline += [
+            {'$unwind': '$entries'},
+            {'$project': score},
+        ]
+
+        query = {}
+        if start is not None or end is not None:
+            query['_id'] = time_range(start, end)
+        if extra:
+            query = {'$and': [query, extra]}
+        if query:
+            pipeline.append({'$match': query})
+        return pipeline
+
+    def find(self, start, end, sort, skip=0, limit=0, extra=None, fields=None, venues=None):
+        # scores between start and end, extra is added to the query e.g. for keyset pages
+        # keep the fields asked for and the ones to sort on
+        keep = set(fields or self.entry_fields) | set(field for field, direction in sort)
+        pipeline = self._unwind(start, end, keep, extra, venues)
+        pipeline.append({'$sort': SON(sort)})
+        if skip:
+            pipeline.append({'$skip': skip})
+        if limit:
+            pipeline.append({'$limit': limit})
+        return self.db.score_buckets.aggregate(pipeline, allowDiskUse=True)
+
+    def aggregate(self, start, end, stages, venues=None):
+        # run pipeline stages over the scores between start and end, each with its station
+        keep = set(self.entry_fields) | {'station'}
+        return self.db.score_buckets.aggregate(self._unwind(start, end, keep, venues=venues) + stages, allowDiskUse=True)
+
+    def remove(self, scores):
+        # delete scores read with find including their venue and station, e.g. once they are archived
+        buckets = {}
+        for score in scores:
+            key = (score.get('venue'), score.get('station'), bucket_start(score['_id'].generation_time))
+            buckets.setdefault(key, []).append(score['_id'])
+        if not buckets:
+            return
+        self.db.score_buckets.bulk_write([
+            pymongo.UpdateOne({'venue': venue, 'station': station, 'hour': hour}, {
+                '$pull': {'entries': {'_id': {'$in': ids}}},
+                '$inc': {'count': -len(ids)}
+            }) for (venue, station, hour), ids in buckets.items()
+        ], ordered=False)
+        self.db.score_buckets.delete_many({'hour': {'$in': list(set(hour for venue, station, hour in buckets))}, 'entries': {'$size': 0}})
+
+
+STORES = {
+    CollectionStore.name: CollectionStore,
+    BucketStore.name: BucketStore
+}
+
+
+def score_store(db, name):
+    return STORES[name](db)
@@ -0,0 +1,154 @@
+import datetime
+
+from leaderboard import BUCKET_SIZE, bucket_start
+
+# Event statistics counted per hour with aggregation pipelines, so the admin
+# pages get a few kilobytes instead of every score and player to add up.
+# Hours that are over are kept in the stats_hourly collection the first time
+# they are asked for, only the current hour is counted on every request.
+# {'_id': {'hour', 'venues'}, 'hour', 'venues': venues counted or None for all, 'width': histogram bucket width,
+#  'stations': [{'station', 'plays', 'eastereggs'}],
+#  'histogram': [{'score': lowest score of the bucket, 'plays'}],
+#  'players': [email], 'waits': players who played, 'waitSeconds': total wait}
+# The wait of a player is the time from their last signup (updatedAt) to their
+# first score after it (firstScoreAt), counted in the hour of that score.
+# firstScoreAt comes from the score's ObjectId, whole seconds, so a score in
+# the second of the signup counts as no wait rather than a negative one.
+
+
+def hours(start, end):
+    # every hour overlapping start to end
+    hour = bucket_start(start)
+    while hour < end:
+        yield hour
+        hour += BUCKET_SIZE
+
+
+def count_hour(db, store, hour, width, venues=None):
+    end = hour + BUCKET_SIZE
+    stations = {}
+    histogram = {}
+    players = set()
+    for row in store.aggregate(hour, end, [
+        {'$group': {
+            '_id': {
+                'station': '$station',
+                'score': {'$subtract': ['$score', {'$mod': ['$score', width]}]}
+            },
+            'plays': {'$sum': 1},
+            'eastereggs': {'$sum': {'$cond': ['$easteregg', 1, 0]}},
+            'players': {'$addToSet': '$email'}
+        }}
+    ], venues):
+        station = stations.setdefault(row['_id'].get('station'), {'plays': 0, 'eastereggs': 0})
+        station['plays'] += row['plays']
+        station['eastereggs'] += row['eastereggs']
+        score = row['_id']['score']
+        histogram[score] = histogram.get(score, 0) + row['plays']
+        players.update(row['players'])
+
+    players_query = {'firstScoreAt': {'$gte': hour, '$lt': end}}
+    if venues:
+        players_query['venue'] = {'$in': venues}
+    waits = list(db.players.aggregate([
+        {'$match': players_query},
+        {'$group': {
+            '_id': None,
+            'waits': {'$sum': 1},
+            'milliseconds': {'$sum': {'$max': [0, {'$subtract': ['$firstScoreAt', '$updatedAt']}]}}
+        }}
+    ]))
+
+    return {
+        '_id': {'hour': hour, 'venues': venues},
+        'hour': hour,
+        'venues': venues,
+        'width': width,
+        'stations': [
+            dict(stations[station], station=station) for station in sorted(stations, key=str)
+        ],
+        'histogram': [{'score': score, 'plays': count} for score, count in sorted(histogram.items())],
+        'players': sorted(players),
+        'waits': waits[0]['waits'] if waits else 0,
+        'waitSeconds': waits[0]['milliseconds'] / 1000.0 if waits else 0.0
+    }
+
+
+def empty_hour(hour, width, venues=None):
+    return {
+        '_id': {'hour': hour, 'venues': venues}, 'hour': hour, 'venues': venues, 'width': width,
+        'stations': [], 'histogram': [], 'players': [], 'waits': 0, 'waitSeconds': 0.0
+    }
+
+
+def hourly(db, store, materialized, start, end, width, now=None, venues=None):
+    # counts of every hour overlapping start to end up to now, the hours that
+    # are over are read from or written to the materialized collection
+    # venues counts the scores and players of those venues only, every venue by default
+    now = now or datetime.datetime.utcnow()
+    current = bucket_start(now)
+    wanted = list(hours(start, min(end, now)))
+    closed = [hour for hour in wanted if hour < current]
+    venues = sorted(venues) if venues else None
+
+    counted = {doc['hour']: doc for doc in materialized.find({'hour': {'$in': closed}, 'venues': venues, 'width': width})}
+    missing = [hour for hour in closed if hour not in counted]
+    if missing:
+        # every score has a leaderboard entry in its hour, hours without one had no plays
+        played_query = {'bucket': {'$in': missing}}
+        if venues:
+            played_query['venue'] = {'$in': venues}
+        played = set(db.leaderboard.distinct('bucket', played_query))
+        for hour in missing:
+            doc = count_hour(db, store, hour, width, venues) if hour in played else empty_hour(hour, width, venues)
+            materialized.replace_one({'_id': doc['_id']}, doc, upsert=True)
+            counted[hour] = doc
+
+    counts = [counted[hour] for hour in closed]
+    if current in wanted:
+        counts.append(count_hour(db, store, current, width, venues))
+    return counts
+
+
+def forget(materialized, scores, now=None, archived=None):
+    # scores stored after their hour was over, e.g. synced from another venue
+    # or replayed from the ingest journal, need their hour counted again
+    # hours before archived keep their counts, their other scores are no longer in mongo
+    current = bucket_start(now or datetime.datetime.utcnow())
+    late = set(bucket_start(score['_id'].generation_time) for score in scores)
+    late = [hour for hour in late if hour < current and (archived is None or hour >= archived)]
+    if late:
+        materialized.delete_many({'hour': {'$in': late}})
+
+
+def summary(counts, width):
+    # totals over the hours, plays per station per hour and the score histogram
+    plays = 0
+    eastereggs = 0
+    players = set()
+    waits = 0
+    wait_seconds = 0.0
+    histogram = {}
+    per_hour = []
+    for hour in counts:
+        for station in hour['stations']:
+            plays += station['plays']
+            eastereggs += station['eastereggs']
+        for bucket in hour['histogram']:
+            histogram[bucket['score']] = histogram.get(bucket['score'], 0) + bucket['plays']
+        players.update(hour['players'])
+        waits += hour['waits']
+        wait_seconds += hour['waitSeconds']
+        per_hour.append({'hour': hour['hour'], 'stations': hour['stations']})
+
+    return {
+        'plays': plays,
+        'players': len(players),
+        'eastereggs': eastereggs,
+        'eastereggRate': eastereggs / float(plays) if plays else 0.0,
+        'waits': waits,
+        'averageWaitSeconds': wait_seconds / waits if waits else None,
+        'histogramWidth': width,
+        'histogram': [{'score': score, 'plays': count} for score, count in sorted(histogram.items())],
+        'hours': per_hour
+    }
@@ -0,0 +1,203 @@
+import json
+import zlib
+
+from urllib.parse import quote
+
+from flask import Response, stream_with_context
+
+# Reports are written out while the cursor is read, so memory use stays the
+# same whatever the size of the date range
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Exports are sent compressed with the best Content-Encoding the client accepts
+# of these, zstd needs the zstandard package
+ENCODINGS = ['zstd', 'gzip'] if zstandard else ['gzip']
+
+
+class Page(object):
+    """ Iterates a cursor remembering how many rows were read and the last one
+
+    Used to work out the continuation token once the last row has been sent.
+    """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.count = 0
+        self.last = None
+
+    def __iter__(self):
+        for doc in self.cursor:
+            self.count += 1
+            self.last = doc
+            yield doc
+
+
+def dumps(obj, encoder):
+    # same output as jsonify outside of debug mode
+    return json.dumps(obj, cls=encoder, sort_keys=True, separators=(',', ':'))
+
+
+def json_array(name, rows, query, encoder):
+    # {"<name>": [rows...], "query": {...}} where query is a function called
+    # after the last row so it can describe the page that was sent
+    yield '{{{}:['.format(json.dumps(name))
+    separator = ''
+    for row in rows:
+        yield separator + dumps(row, encoder)
+        separator = ','
+    yield '],"query":{}}}\n'.format(dumps(query(), encoder))
+
+
+def ndjson(rows, encoder):
+    for row in rows:
+        yield dumps(row, encoder) + '\n'
+
+
+def batched(chunks, size):
+    # join rows into one chunk every size rows, so the server and the
+    # compressor handle a few large writes rather than a write per row
+    batch = []
+    for chunk in chunks:
+        batch.append(chunk)
+        if len(batch) >= size:
+            yield ''.join(batch)
+            batch = []
+    if batch:
+        yield ''.join(batch)
+
+
+def negotiate(accept_encodings, allowed):
+    # the Content-Encoding to send, None to send the rows as they are
+    allowed = [encoding for encoding in ENCODINGS if encoding in allowed]
+    return accept_encodings.best_match(allowed) if allowed else None
+
+
+def compressor(encoding, level):
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=level or 3).compressobj()
+    # wbits 31 writes a gzip header and trailer around the deflate stream
+    return zlib.compressobj(level or 6, zlib.DEFLATED, 31)
+
+
+def compress(chunks, encoding, level=None):
+    # only ever holds one chunk and the compressor window in memory
+    stream = compressor(encoding, level)
+    for chunk in chunks:
+        data = stream.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield stream.flush()
+
+
+def export_response(chunks, mimetype, headers=None, encoding=None, batch=500, level=None):
+    # rows of a report batched and compressed with encoding, see negotiate
+    headers = dict(headers or {})
+    headers['Vary'] = 'Accept-Encoding'
+    body = batched(chunks, batch)
+    if encoding:
+        headers['Content-Encoding'] = encoding
+        body = compress(body, encoding, level)
+    return Response(body, headers=headers, mimetype=mimetype)
+
+
+def attachment(filename):
+    # Content-Disposition of a download, filename* keeps names that are not ascii
+    return 'attachment; filename="{}"; filename*=UTF-8\'\'{}'.format(
+        filename.encode('ascii', 'replace').decode('ascii').replace('"', ''),
+        quote(filename))
+
+
+def json_response(name, rows, query, encoder, output='json', encoding=None, batch=500, level=None):
+    if output == 'ndjson':
+        return export_response(ndjson(rows, encoder), 'application/x-ndjson', encoding=encoding, batch=batch, level=level)
+    return export_response(json_array(name, rows, query, encoder), 'application/json', encoding=encoding, batch=batch, level=level)
+
+
+class Sink(object):
+    """ A file for pyarrow to write to that hands back what was written so far """
+
+    closed = False
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def parquet(docs, columns, batch=10000):
+    # one parquet row group per batch of docs, sent once it is written
+    # columns are (name, type, value of a doc), see reports.SCORE_COLUMNS
+    import pyarrow
+    import pyarrow.parquet
+
+    types = {
+        'string': pyarrow.string(),
+        'int': pyarrow.int64(),
+        'bool': pyarrow.bool_(),
+        'timestamp': pyarrow.timestamp('ms', tz='UTC')
+    }
+    schema = pyarrow.schema([(name, types[kind]) for name, kind, value in columns])
+    sink = Sink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema, compression='zstd')
+
+    def write(rows):
+        arrays = [pyarrow.array([value(row) for row in rows], type=types[kind]) for name, kind, value in columns]
+        writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+
+    rows = []
+    for doc in docs:
+        rows.append(doc)
+        if len(rows) >= batch:
+            write(rows)
+            rows = []
+            yield sink.drain()
+    if rows:
+        write(rows)
+    writer.close()
+    yield sink.drain()
+
+
+def parquet_available():
+    try:
+        import pyarrow.parquet
+    except ImportError:
+        return False
+    return True
+
+
+def parquet_response(docs, columns, filename, batch=10000):
+    # parquet compresses its own columns, so it is never sent with a Content-Encoding
+    headers = {'Content-Disposition': attachment(filename)}
+    return Response(parquet(docs, columns, batch), headers=headers, mimetype='application/vnd.apache.parquet')
+
+
+def template_response(app, template_name, **context):
+    # like render_template but sends the page while the template is rendered
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    # send a few rows at a time rather than every template event on its own
+    stream.enable_buffering(20)
+    return Response(stream_with_context(stream))
@@ -1,26 +1,59 @@
 #!/usr/local/bin/python
 
-import requests
-from bson import ObjectId
 from pymongo import MongoClient
-import datetime
 import os
-import time
+import signal
+import tempfile
 import logging
 
+import database
+import metrics
+from sync_engine import SyncEngine
+
 ## SET THESE 
 #SYNC_DESTINATION = '' # should be 'http://server:port'
-SYNC_DESTINATION = 'http://marketcity.australiaeast.cloudapp.azure.com' # should be 'http://server:port'
+SYNC_DESTINATION = os.environ.get('SYNC_DESTINATION', 'http://marketcity.australiaeast.cloudapp.azure.com') # should be 'http://server:port'
 logging.basicConfig(level=logging.DEBUG)
 
 
-MONGO_HOST = os.environ.get('MONGO_HOST', '127.0.0.1')
-MONGO_URI = "mongodb://{}:27017/".format(MONGO_HOST)
-MONGO_COLLECTION = 'marketcity'
+# the venue whose rows this script sends, same as VENUE of the web app
+VENUE = os.environ.get('VENUE', 'default')
 
-SLEEP = 60 # seconds
+MONGO_URI = database.mongo_uri()
+MONGO_COLLECTION = 'marketcity'
 
-mongo = MongoClient(MONGO_URI)
+# requests sent to the destination at the same time
+SYNC_WORKERS = int(os.environ.get('SYNC_WORKERS', 4))
+# rows read from the sync collection at a time
+SYNC_BATCH_SIZE = int(os.environ.get('SYNC_BATCH_SIZE', 100))
+# seconds to wait for the destination to respond
+SYNC_TIMEOUT = float(os.environ.get('SYNC_TIMEOUT', 10))
+# seconds between checks for new rows, grows from min to max while the queue is empty
+SYNC_MIN_INTERVAL = float(os.environ.get('SYNC_MIN_INTERVAL', 1))
+SYNC_MAX_INTERVAL = float(os.environ.get('SYNC_MAX_INTERVAL', 10))
+# longest wait in seconds between retries while the destination is failing
+SYNC_MAX_BACKOFF = float(os.environ.get('SYNC_MAX_BACKOFF', 300))
+
+# seconds a batch of rows is claimed for, another sync-db.py can send them once it runs out
+SYNC_LEASE = float(os.environ.get('SYNC_LEASE', 60))
+# failed sends before a row is moved to the sync_dead collection, 0 retries forever
+# rows the destination rejects with a 4xx response are moved there straight away
+SYNC_MAX_ATTEMPTS = int(os.environ.get('SYNC_MAX_ATTEMPTS', 0))
+
+# set to 1 when mongo runs as a replica set to send new rows as soon as they are queued
+# polling every SYNC_WATCH_INTERVAL seconds then only catches up
+SYNC_CHANGE_STREAM = os.environ.get('SYNC_CHANGE_STREAM') == '1'
+SYNC_WATCH_INTERVAL = float(os.environ.get('SYNC_WATCH_INTERVAL', 60))
+
+# single sends one request per row, batch sends each batch to the /sync/batch
+# endpoint of the destination in one request
+SYNC_MODE = os.environ.get('SYNC_MODE', 'single')
+SYNC_BATCH_URL = '/sync/batch'
+
+# queue depth and age for the /metrics endpoint of the web app, same directory as METRICS_DIR there
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'marketcity-metrics'))
+
+mongo = MongoClient(MONGO_URI, **database.client_options())
 db = mongo[MONGO_COLLECTION]
 
 
@@ -30,47 +63,33 @@ if __name__ == "__main__":
         logging.error('[SYNC-DB] Not syncing requests from this server')
         exit()
 
-    if SYNC_DESTINATION[-1] == '/':
-        # remove trailing slash
-        SYNC_DESTINATION = SYNC_DESTINATION[:-1]
-
-    # for each row in requests collection
-    # where objectId is less than current run time
+    # for each row in requests collection, oldest first
     # preform request to web server
     # if successful remove row from db
 
     logging.warn('[SYNC-DB] Starting Sync DB script')
     logging.warn('[SYNC-DB] Getting requests from %s', MONGO_URI)
 
-    while True:
-        query = {'_id': {'$lt': ObjectId.from_datetime(datetime.datetime.utcnow())}}
-        success = 0
-        fail = 0
-        for req in db.sync.find(query):
-
-            status_ok = True
-
-            method = req.get('method','').lower()
-            url = req.get('url')
-            data = req.get('data', {})
-
-            if method and url:
-                url = SYNC_DESTINATION + url
-                r = requests.request(method, url, data=data)
-
-            logging.debug('[SYNC-DB] %s %s returned %s %s', method, url, r.status_code, data)
-
-            if r.status_code != 200:
-                fail += 1
-            else:
-                success += 1
-                db.sync.delete_one({'_id':req['_id']})
-
-        logging.log(
-            logging.INFO if success or fail else logging.DEBUG,
-            '[SYNC-DB] Completed with %s successful and %s failed requests', 
-            success, 
-            fail
-        )
-
-        time.sleep(60)
+    engine = SyncEngine(
+        db,
+        SYNC_DESTINATION,
+        workers=SYNC_WORKERS,
+        batch_size=SYNC_BATCH_SIZE,
+        timeout=SYNC_TIMEOUT,
+        min_interval=SYNC_MIN_INTERVAL,
+        max_interval=SYNC_MAX_INTERVAL,
+        max_backoff=SYNC_MAX_BACKOFF,
+        batch_url=SYNC_BATCH_URL if SYNC_MODE == 'batch' else None,
+        metrics=metrics.Registry(METRICS_DIR, 'sync'),
+        lease=SYNC_LEASE,
+        max_attempts=SYNC_MAX_ATTEMPTS,
+        watch_interval=SYNC_WATCH_INTERVAL,
+        venue=VENUE
+    )
+    if SYNC_CHANGE_STREAM:
+        engine.watch()
+    signal.signal(signal.SIGTERM, lambda signum, frame: engine.stop())
+    engine.run()
+
+    stats = engine.stats()
+    logging.warn('[SYNC-DB] Stopped after sending %s requests at %.1f requests/second', stats['sent'], stats['rate'])
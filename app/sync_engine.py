@@ -0,0 +1,331 @@
+import calendar
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import logging
+import random
+import threading
+import time
+
+import pymongo
+import pymongo.errors
+import requests
+from requests.adapters import HTTPAdapter
+
+import outbox
+
+
+class SyncEngine(object):
+    """ Replays the sync collection against the upstream server
+
+    Rows are claimed oldest first in batches for lease seconds (see
+    outbox.Outbox), so several engines can drain the same queue. Rows for the
+    same player are sent in order by one worker, different players are sent
+    in parallel over a pooled HTTP session. Rows the destination accepted are
+    removed with one delete_many per batch. When the destination fails the
+    engine backs off exponentially (with jitter), when the queue is empty it
+    polls less often and it starts straight away when wake() is called.
+
+    Rows the destination rejects for good (a 4xx response) are moved to the
+    sync_dead collection, as are rows that failed max_attempts times when
+    max_attempts is set.
+
+    With a batch_url every batch is sent in a single request to the bulk
+    endpoint of the destination (/sync/batch) instead of one request per row.
+
+    watch() tails the queue with a change stream and wakes the engine for
+    every new row, polling then only catches up every watch_interval seconds.
+    """
+
+    def __init__(self, db, destination, workers=4, batch_size=100, timeout=10,
+                 min_interval=1, max_interval=10, max_backoff=300, session=None,
+                 batch_url=None, metrics=None, lease=60, max_attempts=0, watch_interval=60, venue=None):
+        self.db = db
+        self.watch_interval = watch_interval
+        self.outbox = outbox.Outbox(db.sync, db.sync_dead, venue)
+        # the change stream resume token of each venue is kept apart
+        self.state_id = 'change_stream:{}'.format(venue) if venue else 'change_stream'
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.destination = destination.rstrip('/')
+        self.batch_url = batch_url
+        self.workers = workers
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_backoff = max_backoff
+
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+        self._wake = threading.Event()
+        self._stopped = False
+        # True while the change stream is open
+        self.watching = False
+        # number of batches in a row where the destination did not accept anything
+        self.failures = 0
+        self.started = time.time()
+        self.sent = 0
+        self.failed = 0
+        self.dead = 0
+        self.batches = 0
+
+        # a metrics.Registry to report the queue to /metrics
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.define('marketcity_sync_queue_depth', 'gauge', 'Rows waiting in the sync queue')
+            metrics.define('marketcity_sync_queue_oldest_seconds', 'gauge', 'Age of the oldest row in the sync queue')
+            metrics.define('marketcity_sync_sent_total', 'counter', 'Sync rows the destination accepted')
+            metrics.define('marketcity_sync_failed_total', 'counter', 'Sync sends that failed')
+            metrics.define('marketcity_sync_dead_total', 'counter', 'Sync rows moved to the dead letters')
+            metrics.define('marketcity_sync_batches_total', 'counter', 'Sync batches read')
+
+    def wake(self):
+        # start the next batch now instead of waiting for the poll interval
+        self._wake.set()
+
+    def stop(self):
+        self._stopped = True
+        self._wake.set()
+
+    def watch(self):
+        # wake for every row inserted into the queue, needs mongo running as a replica set
+        # the resume token is kept in sync_state so a restart carries on after the last row seen
+        def run():
+            while not self._stopped:
+                state = self.db.sync_state.find_one({'_id': self.state_id}) or {}
+                token = state.get('token')
+                try:
+                    with self.db.sync.watch([{'$match': {'operationType': 'insert'}}],
+                                            resume_after=token, max_await_time_ms=1000) as stream:
+                        self.watching = True
+                        logging.info('[SYNC-DB] Watching the sync queue for new rows')
+                        saved = time.time()
+                        while not self._stopped and stream.alive:
+                            change = stream.try_next()
+                            if change is not None:
+                                self.wake()
+                            # at most once a second, a replayed event only wakes the engine again
+                            if stream.resume_token and time.time() - saved >= 1:
+                                self.db.sync_state.update_one({'_id': self.state_id}, {'$set': {
+                                    'token': stream.resume_token,
+                                    'updatedAt': datetime.datetime.utcnow()
+                                }}, upsert=True)
+                                saved = time.time()
+                except pymongo.errors.OperationFailure as e:
+                    if token is None:
+                        logging.warning('[SYNC-DB] Change streams are not available, polling only: %s', e)
+                        return
+                    # the token fell off the oplog, rows since then are picked up by polling
+                    logging.warning('[SYNC-DB] Could not resume watching the sync queue, starting over: %s', e)
+                    self.db.sync_state.delete_one({'_id': self.state_id})
+                    self.wake()
+                except pymongo.errors.PyMongoError:
+                    logging.exception('[SYNC-DB] Lost the change stream on the sync queue')
+                    time.sleep(self.min_interval)
+                finally:
+                    self.watching = False
+
+        watcher = threading.Thread(target=run, name='sync-watch')
+        watcher.daemon = True
+        watcher.start()
+        return watcher
+
+    def stats(self):
+        elapsed = max(time.time() - self.started, 0.001)
+        return {
+            'sent': self.sent,
+            'failed': self.failed,
+            'dead': self.dead,
+            'batches': self.batches,
+            'elapsed': elapsed,
+            'rate': self.sent / elapsed
+        }
+
+    def queue_stats(self):
+        # number of rows waiting and the age in seconds of the oldest
+        depth = self.db.sync.estimated_document_count()
+        oldest = self.db.sync.find_one(sort=[('_id', pymongo.ASCENDING)], projection={'_id': True})
+        age = 0
+        if oldest:
+            age = max(0, time.time() - calendar.timegm(oldest['_id'].generation_time.utctimetuple()))
+        return depth, age
+
+    def record_metrics(self):
+        depth, age = self.queue_stats()
+        self.metrics.set('marketcity_sync_queue_depth', value=depth)
+        self.metrics.set('marketcity_sync_queue_oldest_seconds', value=age)
+        self.metrics.set('marketcity_sync_sent_total', value=self.sent)
+        self.metrics.set('marketcity_sync_failed_total', value=self.failed)
+        self.metrics.set('marketcity_sync_dead_total', value=self.dead)
+        self.metrics.set('marketcity_sync_batches_total', value=self.batches)
+        self.metrics.flush()
+
+    def send(self, req):
+        # returns 'ok' when the destination accepted the row, 'retry' or 'dead'
+        # (it never will) and the error
+        method = req.get('method', '').lower()
+        url = req.get('url')
+        data = req.get('data', {})
+
+        if not method or not url:
+            return 'dead', 'Missing method or url'
+
+        url = self.destination + url
+        headers = {outbox.IDEMPOTENCY_HEADER: str(req['_id'])}
+        try:
+            r = self.session.request(method, url, data=data, headers=headers, timeout=self.timeout)
+        except requests.RequestException as e:
+            logging.debug('[SYNC-DB] %s %s failed %s', method, url, e)
+            return 'retry', str(e)
+
+        logging.debug('[SYNC-DB] %s %s returned %s %s', method, url, r.status_code, data)
+        if r.status_code == 200:
+            return 'ok', None
+        error = '{} {}'.format(r.status_code, r.text[:200])
+        if 400 <= r.status_code < 500 and r.status_code not in (408, 429):
+            return 'dead', error
+        return 'retry', error
+
+    def failed_row(self, req, error):
+        # keep the row for another try unless it has had all its attempts
+        if self.max_attempts and req.get('attempts', 0) + 1 >= self.max_attempts:
+            self.outbox.bury(req, error)
+            self.dead += 1
+        else:
+            self.outbox.failed(req, error)
+
+    def send_all(self, reqs):
+        # send rows in order, stopping at the first failure so later rows
+        # for the same player never overtake it
+        done = []
+        for i, req in enumerate(reqs):
+            status, error = self.send(req)
+            if status == 'ok':
+                done.append(req['_id'])
+            elif status == 'dead':
+                self.outbox.bury(req, error)
+                self.dead += 1
+            else:
+                self.failed_row(req, error)
+                if reqs[i + 1:]:
+                    self.outbox.release([later['_id'] for later in reqs[i + 1:]])
+                return done, True
+        return done, False
+
+    def send_batch(self, batch):
+        # returns the ids of rows that can be removed and the number that failed
+        body = [{
+            'id': str(req['_id']),
+            'url': req.get('url'),
+            'method': req.get('method'),
+            'data': req.get('data', {})
+        } for req in batch]
+
+        url = self.destination + self.batch_url
+        try:
+            r = self.session.post(url, json=body, timeout=self.timeout)
+            r.raise_for_status()
+            results = r.json()['results']
+        except (requests.RequestException, ValueError, KeyError) as e:
+            logging.debug('[SYNC-DB] post %s failed %s', url, e)
+            # every row was sent and failed, as in single mode
+            for req in batch:
+                self.failed_row(req, str(e))
+            return [], len(batch)
+
+        done = []
+        failed = 0
+        for req, result in zip(batch, results):
+            status = result.get('status')
+            if status == 'invalid':
+                self.outbox.bury(req, result.get('error'))
+                self.dead += 1
+            elif status in ('ok', 'duplicate'):
+                done.append(req['_id'])
+            else:
+                self.failed_row(req, result.get('error', 'error'))
+                failed += 1
+        logging.debug('[SYNC-DB] post %s returned %s for %s requests', url, r.status_code, len(batch))
+        return done, failed
+
+    def run_once(self):
+        # send one batch, returns number of rows read, sent and failed
+        batch = self.outbox.claim(self.batch_size, self.lease)
+        if not batch:
+            return 0, 0, 0
+
+        if self.batch_url:
+            done, failed = self.send_batch(batch)
+        else:
+            groups = {}
+            for req in batch:
+                groups.setdefault(outbox.group_key(req), []).append(req)
+
+            done = []
+            failed = 0
+            for ids, group_failed in self.executor.map(self.send_all, groups.values()):
+                done.extend(ids)
+                if group_failed:
+                    failed += 1
+
+        if done:
+            self.outbox.done(done)
+
+        self.batches += 1
+        self.sent += len(done)
+        self.failed += failed
+        return len(batch), len(done), failed
+
+    def backoff(self):
+        delay = min(self.max_backoff, self.min_interval * 2 ** self.failures)
+        return random.uniform(delay / 2, delay)
+
+    def run(self):
+        interval = self.min_interval
+        while not self._stopped:
+            try:
+                read, sent, failed = self.run_once()
+                if self.metrics is not None:
+                    self.record_metrics()
+            except pymongo.errors.PyMongoError:
+                logging.exception('[SYNC-DB] Could not read the sync queue')
+                read, sent, failed = 0, 0, 1
+
+            if failed and not sent:
+                self.failures += 1
+                delay = self.backoff()
+                logging.warning('[SYNC-DB] Destination failing, retrying in %.1f seconds', delay)
+            else:
+                self.failures = 0
+                if read:
+                    stats = self.stats()
+                    logging.info(
+                        '[SYNC-DB] Sent %s of %s requests (%s failed), %s sent at %.1f requests/second',
+                        sent, read, failed, stats['sent'], stats['rate'])
+
+                if read == self.batch_size and not failed:
+                    # more rows are waiting
+                    interval = self.min_interval
+                    delay = 0
+                elif read:
+                    interval = self.min_interval
+                    delay = interval
+                elif self.watching:
+                    # new rows wake the engine, polling only catches up on expired leases and missed events
+                    delay = self.watch_interval
+                else:
+                    # nothing to do, poll less often until rows arrive
+                    delay = interval
+                    interval = min(interval * 2, self.max_interval)
+
+            if delay:
+                self._wake.wait(delay)
+                self._wake.clear()
+
+        self.executor.shutdown()
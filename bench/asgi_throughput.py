@@ -0,0 +1,95 @@
+#!/usr/local/bin/python
+"""
+Requests per second of the uWSGI and the ASGI (app/asgi.py) servers side by
+side, while a number of idle stations hold Server-Sent Events streams open.
+
+    python bench/asgi_throughput.py [wsgi url] [asgi url] [idle stations] [clients] [seconds]
+
+Defaults to http://localhost:8080, http://localhost:8000, 100 idle stations,
+8 clients and 10 seconds per route. Start both servers against the same
+database with some scores and players in it, e.g.
+
+    uwsgi --ini app/uwsgi.ini --http :8080
+    uvicorn asgi:application --app-dir app --port 8000
+"""
+
+import sys
+import threading
+import time
+
+import requests
+
+ROUTES = [
+    '/station/bench/player',
+    '/scoresraw?output=csv',
+    '/players?output=csv',
+    '/scores',
+]
+
+
+def hold_events(url, station, stop):
+    # an idle station waiting for its next player
+    try:
+        with requests.get('{}/station/bench-{}/player/events'.format(url, station), stream=True, timeout=5) as r:
+            for line in r.iter_lines():
+                if stop.is_set():
+                    return
+    except requests.RequestException:
+        pass
+
+
+def hammer(url, deadline, counts):
+    session = requests.Session()
+    done = 0
+    errors = 0
+    while time.time() < deadline:
+        try:
+            r = session.get(url, timeout=30)
+            if r.status_code in (200, 204):
+                done += 1
+            else:
+                errors += 1
+        except requests.RequestException:
+            errors += 1
+    counts.append((done, errors))
+
+
+def throughput(url, clients, seconds):
+    counts = []
+    deadline = time.time() + seconds
+    threads = [threading.Thread(target=hammer, args=(url, deadline, counts)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(done for done, errors in counts) / float(seconds), sum(errors for done, errors in counts)
+
+
+def run(url, idle, clients, seconds):
+    stop = threading.Event()
+    holders = [threading.Thread(target=hold_events, args=(url, station, stop)) for station in range(idle)]
+    for holder in holders:
+        holder.daemon = True
+        holder.start()
+    # let the streams connect before measuring
+    time.sleep(1)
+
+    results = [throughput(url + route, clients, seconds) for route in ROUTES]
+    stop.set()
+    return results
+
+
+if __name__ == '__main__':
+    wsgi_url = sys.argv[1].rstrip('/') if len(sys.argv) > 1 else 'http://localhost:8080'
+    asgi_url = sys.argv[2].rstrip('/') if len(sys.argv) > 2 else 'http://localhost:8000'
+    idle = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+    clients = int(sys.argv[4]) if len(sys.argv) > 4 else 8
+    seconds = int(sys.argv[5]) if len(sys.argv) > 5 else 10
+
+    wsgi = run(wsgi_url, idle, clients, seconds)
+    asgi = run(asgi_url, idle, clients, seconds)
+
+    print('{} idle stations, {} clients'.format(idle, clients))
+    print('{:<26}{:>12}{:>8}{:>12}{:>8}'.format('route', 'wsgi req/s', 'errors', 'asgi req/s', 'errors'))
+    for route, (wsgi_rate, wsgi_errors), (asgi_rate, asgi_errors) in zip(ROUTES, wsgi, asgi):
+        print('{:<26}{:>12.1f}{:>8}{:>12.1f}{:>8}'.format(route, wsgi_rate, wsgi_errors, asgi_rate, asgi_errors))
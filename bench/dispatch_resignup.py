@@ -0,0 +1,90 @@
+#!/usr/local/bin/python
+"""
+A player who signs up again while at a station, with the automatic
+dispatcher on (AUTO_DISPATCH=1, app/dispatcher.py).
+
+    python bench/dispatch_resignup.py [--mongomock]
+
+Runs app/app.py in process with the Flask test client, against the mongod in
+MONGO_URI / MONGO_HOST or against mongomock with --mongomock:
+- two stations report a status and player A signs up, A goes to a station
+- A signs up again, A must not join the queue
+- player B signs up, B must go to the other station
+- A is put in the queue behind the dispatcher's back, as another process
+  could have queued them before they were assigned, and player C signs up
+  with a free station: the dispatcher must drop A and assign C
+
+Exits with 1 when a check fails.
+"""
+
+import argparse
+import datetime
+import os
+import sys
+
+import venue
+
+
+def signup(client, player):
+    status, body = client.request('POST', '/signup', player)
+    if status != 200:
+        raise Exception('signup of {} failed with {}: {}'.format(player['email'], status, body))
+
+
+def station_of(db, email):
+    doc = db.next_player.find_one({'email': email}, {'_id': True})
+    return doc and doc['_id']
+
+
+def queued(db, email):
+    return db.queue.find_one({'_id': email}) is not None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sign up again while at a station')
+    parser.add_argument('--mongomock', action='store_true', help='use mongomock instead of mongod')
+    args = parser.parse_args()
+
+    os.environ['AUTO_DISPATCH'] = '1'
+    app = venue.in_process_app(args.mongomock)
+    import app as app_module
+
+    db = app_module.mongo.db
+    client = venue.AppClient(app)
+    pool = venue.Players()
+    a, b, c = pool.new(), pool.new(), pool.new()
+    run = a['email'].split('-')[1]
+    stations = ['resignup-{}-{}'.format(run, i) for i in range(1, 4)]
+    problems = []
+
+    def expect(ok, problem):
+        print('{:<6}{}'.format('ok' if ok else 'FAIL', problem))
+        if not ok:
+            problems.append(problem)
+
+    for station in stations[:2]:
+        client.request('POST', '/station/{}'.format(station), {'status': 'Ready'})
+    signup(client, a)
+    at = station_of(db, a['email'])
+    expect(at in stations[:2], 'A goes to a station, at {}'.format(at))
+
+    signup(client, a)
+    expect(not queued(db, a['email']), 'A signing up again at {} is not queued'.format(at))
+    expect(station_of(db, a['email']) == at, 'A stays at {}'.format(at))
+
+    signup(client, b)
+    other = [station for station in stations[:2] if station != at][0]
+    expect(station_of(db, b['email']) == other, 'B goes to the other station {}, at {}'.format(other, station_of(db, b['email'])))
+    expect(not queued(db, b['email']), 'B is not left in the queue')
+
+    # queued before they were assigned, at the head of the queue
+    db.queue.replace_one({'_id': a['email']}, {'displayName': a['displayName'], 'priority': 1,
+                                               'enqueuedAt': datetime.datetime.utcnow()}, upsert=True)
+    client.request('POST', '/station/{}'.format(stations[2]), {'status': 'Ready'})
+    signup(client, c)
+    expect(not queued(db, a['email']), 'A queued while at {} is dropped from the queue'.format(at))
+    expect(station_of(db, a['email']) == at, 'A stays at {}'.format(at))
+    expect(station_of(db, c['email']) == stations[2], 'C goes to the free station {}, at {}'.format(stations[2], station_of(db, c['email'])))
+
+    print('FAIL' if problems else 'OK')
+    sys.exit(1 if problems else 0)
@@ -0,0 +1,136 @@
+#!/usr/local/bin/python
+"""
+Station utilisation and player wait with operators picking players by hand
+against the automatic dispatcher (AUTO_DISPATCH=1, app/dispatcher.py).
+
+    python bench/dispatch_sim.py [--stations 8] [--players-per-hour 120] [--hours 4] ...
+
+Runs the real Dispatcher on mongomock (pip install mongomock) in simulated
+time, with the same arrivals for both flows:
+- players sign up at random at --players-per-hour and join the queue
+- a station sees its next player --poll seconds after they are assigned and
+  a game lasts --game seconds give or take 20%
+- by hand, each operator refreshes /next/<station> every --refresh seconds
+  and takes --pick seconds to assign the head of the queue to a free station
+- automatically, the head of the queue is assigned as soon as a game ends
+
+Utilisation is the share of station time spent playing, the wait is from
+signup to the start of the game.
+"""
+
+import argparse
+import datetime
+import heapq
+import os
+import random
+import sys
+
+import mongomock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+import dispatcher
+
+# queued players expire after dispatcher.WAITING_WINDOW, so simulated time starts now
+EPOCH = datetime.datetime.utcnow()
+
+
+def simulate(args, auto):
+    rng = random.Random(args.seed)
+    db = mongomock.MongoClient()['marketcity']
+    queue = dispatcher.Dispatcher(db)
+    stations = [str(station) for station in range(1, args.stations + 1)]
+    for station in stations:
+        db.station.insert_one({'_id': station, 'status': 'Ready'})
+
+    horizon = args.hours * 3600
+    events = []
+    sequence = [0]
+
+    def at(when, kind, data=None):
+        sequence[0] += 1
+        heapq.heappush(events, (when, sequence[0], kind, data))
+
+    # the same arrivals for both flows
+    when = 0
+    player = 0
+    while True:
+        when += rng.expovariate(args.players_per_hour / 3600.0)
+        if when >= horizon:
+            break
+        player += 1
+        at(when, 'signup', 'player{}@example.com'.format(player))
+
+    if not auto:
+        for station in stations:
+            at(rng.uniform(0, args.refresh), 'refresh', station)
+
+    signed_up = {}
+    waits = []
+    playing = 0.0
+
+    def assign(now, station):
+        head = queue.assign(station)
+        if head:
+            at(now + args.poll, 'start', (station, head['_id']))
+
+    while events:
+        now, _, kind, data = heapq.heappop(events)
+        if now >= horizon:
+            break
+
+        if kind == 'signup':
+            signed_up[data] = now
+            queue.enqueue(data, data, now=EPOCH + datetime.timedelta(seconds=now))
+            if auto:
+                for station in queue.free_stations():
+                    assign(now, station)
+
+        elif kind == 'start':
+            station, email = data
+            waits.append(now - signed_up[email])
+            game = args.game * rng.uniform(0.8, 1.2)
+            playing += min(game, horizon - now)
+            at(now + game, 'complete', station)
+
+        elif kind == 'complete':
+            db.next_player.delete_one({'_id': data})
+            if auto:
+                assign(now, data)
+
+        elif kind == 'refresh':
+            if not db.next_player.find_one({'_id': data}) and db.queue.find_one():
+                at(now + args.pick, 'pick', data)
+            at(now + args.refresh, 'refresh', data)
+
+        elif kind == 'pick':
+            assign(now, data)
+
+    return {
+        'players': len(signed_up),
+        'played': len(waits),
+        'utilisation': playing / (horizon * len(stations)),
+        'wait': sum(waits) / len(waits) if waits else 0.0,
+        'maxWait': max(waits) if waits else 0.0,
+        'left': db.queue.count_documents({})
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare picking players by hand with the automatic dispatcher')
+    parser.add_argument('--stations', type=int, default=8)
+    parser.add_argument('--players-per-hour', type=float, default=120)
+    parser.add_argument('--hours', type=float, default=4)
+    parser.add_argument('--game', type=float, default=180, help='seconds a game lasts')
+    parser.add_argument('--poll', type=float, default=1, help='seconds until a station sees its next player')
+    parser.add_argument('--refresh', type=float, default=60, help='seconds between operator page refreshes')
+    parser.add_argument('--pick', type=float, default=10, help='seconds an operator takes to pick a player')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    print('{} stations, {:.0f} players an hour, {:.0f}s games for {:.1f} hours'.format(
+        args.stations, args.players_per_hour, args.game, args.hours))
+    print('{:<8}{:>9}{:>8}{:>13}{:>11}{:>11}{:>7}'.format('flow', 'players', 'played', 'utilisation', 'avg wait', 'max wait', 'left'))
+    for name, auto in [('manual', False), ('auto', True)]:
+        result = simulate(args, auto)
+        print('{:<8}{:>9}{:>8}{:>12.1%}{:>10.0f}s{:>10.0f}s{:>7}'.format(
+            name, result['players'], result['played'], result['utilisation'], result['wait'], result['maxWait'], result['left']))
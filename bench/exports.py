@@ -0,0 +1,95 @@
+#!/usr/local/bin/python
+"""
+Rows per second, bytes sent and peak memory of the /scoresraw and /players
+exports in every format and Content-Encoding, against the row per write
+uncompressed output they had before.
+
+    python bench/exports.py [rows] [--batch 500] [--parquet-rows 10000]
+
+Runs the generators of app/streaming.py over generated documents so it needs
+no database. zstd needs the zstandard package and parquet the pyarrow package,
+the formats that can not run are left out.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import report_formats
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+import reports
+import streaming
+
+
+def isoformat(value):
+    # datetimes as the app's JSON encoder writes them
+    return value.isoformat()
+
+
+def unbatched(chunks):
+    # one write per row as the exports were sent before
+    for chunk in chunks:
+        yield chunk
+
+
+def cases(args, name, docs, line, row_json, columns):
+    rows = lambda: (line(doc) for doc in docs)
+    ndjson = lambda: (json.dumps(row_json(doc), sort_keys=True, separators=(',', ':'), default=isoformat) + '\n' for doc in docs)
+
+    yield name + ' csv before', lambda: unbatched(rows())
+    yield name + ' csv', lambda: streaming.batched(rows(), args.batch)
+    yield name + ' ndjson', lambda: streaming.batched(ndjson(), args.batch)
+    for encoding in streaming.ENCODINGS:
+        yield '{} csv {}'.format(name, encoding), lambda encoding=encoding: streaming.compress(streaming.batched(rows(), args.batch), encoding)
+        yield '{} ndjson {}'.format(name, encoding), lambda encoding=encoding: streaming.compress(streaming.batched(ndjson(), args.batch), encoding)
+    if streaming.parquet_available():
+        yield name + ' parquet', lambda: streaming.parquet(docs, columns, args.parquet_rows)
+
+
+def measure(make_chunks):
+    # rows are counted by the caller, returns seconds, bytes and writes
+    started = time.perf_counter()
+    size = 0
+    writes = 0
+    for chunk in make_chunks():
+        size += len(chunk if isinstance(chunk, bytes) else chunk.encode('utf-8'))
+        writes += 1
+    return time.perf_counter() - started, size, writes
+
+
+def peak_memory(make_chunks):
+    # most memory held at once while the chunks are made, the documents are already in memory
+    tracemalloc.start()
+    for chunk in make_chunks():
+        pass
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the export formats and encodings')
+    parser.add_argument('rows', type=int, nargs='?', default=100000)
+    parser.add_argument('--batch', type=int, default=500, help='rows joined into each write')
+    parser.add_argument('--parquet-rows', type=int, default=10000, help='rows in each parquet row group')
+    args = parser.parse_args()
+
+    scores = report_formats.make_scores(args.rows)
+    players = report_formats.make_players(args.rows)
+    all_cases = list(cases(args, 'scores', scores, reports.score_line(',', '\n'), reports.score_json, reports.SCORE_COLUMNS))
+    all_cases += list(cases(args, 'players', players, reports.player_line(','), reports.player_json(list(players[0])), reports.PLAYER_COLUMNS))
+
+    print('{} rows, {} rows a write'.format(args.rows, args.batch))
+    print('{:<24}{:>12}{:>9}{:>12}{:>10}{:>9}{:>12}'.format('format', 'rows/s', 'MB/s', 'bytes', 'vs csv', 'writes', 'peak KiB'))
+    plain = {}
+    for name, make_chunks in all_cases:
+        seconds, size, writes = measure(make_chunks)
+        peak = peak_memory(make_chunks)
+        kind = name.split()[0]
+        plain.setdefault(kind, size)
+        print('{:<24}{:>12.0f}{:>9.1f}{:>12}{:>9.0%}{:>9}{:>12.0f}'.format(
+            name, args.rows / seconds, size / seconds / 1e6, size, size / float(plain[kind]), writes, peak / 1024.0))
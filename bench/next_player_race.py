@@ -0,0 +1,163 @@
+#!/usr/local/bin/python
+"""
+Many operators racing on the same few stations and players through
+POST /next/<station>, to show the next player transitions are atomic.
+
+    python bench/next_player_race.py [--mongomock] [--stations 3] [--players 6] [--operators 24] [--actions 200]
+
+Each operator thread picks a station, a player and an action (assign, start,
+complete or cancel) at random, over and over. Runs app/app.py in process with
+the Flask test client, against the mongod in MONGO_URI / MONGO_HOST or
+against mongomock with --mongomock. mongomock runs each command in Python
+without locks, so with --mongomock every collection call holds a lock, as
+mongod applies each single document write atomically; the requests still
+interleave between their writes.
+
+Every transition that changed a station is counted from the [NEXT] line
+app.py logs for it. Exits with 1 when:
+- a player ends up the next player of two stations
+- a player was assigned a different number of times than they were
+  completed or cancelled, plus once if they are still at a station, i.e. a
+  transition was applied twice or lost
+- a player's waiting and started flags disagree with their station
+"""
+
+import argparse
+import collections
+import functools
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+import flask.logging
+
+import venue
+
+
+def serialize_mongomock(lock):
+    # each collection call is one command, applied by mongod as a whole
+    import mongomock
+
+    def locked(method):
+        @functools.wraps(method)
+        def call(*args, **kwargs):
+            with lock:
+                return method(*args, **kwargs)
+        return call
+
+    for name in ['find_one', 'insert_one', 'update_one', 'update_many', 'delete_one', 'delete_many',
+                 'find_one_and_update', 'find_one_and_delete', 'replace_one', 'count_documents', 'distinct']:
+        setattr(mongomock.Collection, name, locked(getattr(mongomock.Collection, name)))
+
+
+class Transitions(logging.Handler):
+    """ Transitions that changed a station, from the [NEXT] lines app.py logs """
+
+    def __init__(self):
+        logging.Handler.__init__(self, logging.DEBUG)
+        self.applied = collections.Counter()
+
+    def emit(self, record):
+        if record.msg.startswith('[NEXT]'):
+            action, email, station = record.args
+            self.applied[(email, action)] += 1
+
+
+def operator(client, args, stations, players, deadline, seed):
+    rng = random.Random(seed)
+    for i in range(args.actions):
+        if time.time() > deadline:
+            return
+        player = rng.choice(players)
+        data = {'email': player['email'], 'displayName': player['displayName']}
+        action = rng.choice(['assign', 'start', 'complete', 'cancel'])
+        if action != 'assign':
+            data['action'] = action
+        client.request('POST', '/next/{}'.format(rng.choice(stations)), data)
+
+
+def check(db, players, transitions):
+    problems = []
+
+    stations = collections.defaultdict(list)
+    for doc in db.next_player.find():
+        stations[doc['email']].append(doc)
+
+    for player in players:
+        email = player['email']
+        at = stations.get(email, [])
+        if len(at) > 1:
+            problems.append('{} ends at stations {}'.format(email, [doc['_id'] for doc in at]))
+
+        assigned = transitions.applied[(email, 'assign')]
+        released = transitions.applied[(email, 'complete')] + transitions.applied[(email, 'cancel')]
+        if assigned != released + len(at):
+            problems.append('{} assigned {} times, completed or cancelled {} times and at {} stations'.format(
+                email, assigned, released, len(at)))
+
+        doc = db.players.find_one({'_id': email})
+        started = bool(doc.get('started'))
+        if at and doc.get('waiting') is True:
+            problems.append('{} is at station {} and still waiting'.format(email, at[0]['_id']))
+        if started != any(station.get('started') for station in at):
+            problems.append('{} started is {} at stations {}'.format(email, started, [station['_id'] for station in at]))
+    return problems
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Race operators on the next player transitions')
+    parser.add_argument('--mongomock', action='store_true', help='use mongomock instead of mongod')
+    parser.add_argument('--stations', type=int, default=3)
+    parser.add_argument('--players', type=int, default=6)
+    parser.add_argument('--operators', type=int, default=24, help='operator threads')
+    parser.add_argument('--actions', type=int, default=200, help='actions of each operator')
+    parser.add_argument('--duration', type=float, default=60, help='most seconds to run for')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    # the dispatcher would assign players without an operator
+    os.environ['AUTO_DISPATCH'] = '0'
+    app = venue.in_process_app(args.mongomock)
+    import app as app_module
+    if args.mongomock:
+        serialize_mongomock(threading.RLock())
+    # switch threads often so requests interleave between their writes
+    sys.setswitchinterval(1e-4)
+
+    db = app_module.mongo.db
+    transitions = Transitions()
+    app_module.app.logger.setLevel(logging.DEBUG)
+    app_module.app.logger.propagate = False
+    app_module.app.logger.removeHandler(flask.logging.default_handler)
+    app_module.app.logger.addHandler(transitions)
+
+    stations = ['race-{}'.format(i) for i in range(1, args.stations + 1)]
+    db.next_player.delete_many({'_id': {'$in': stations}})
+    pool = venue.Players()
+    players = [pool.new() for i in range(args.players)]
+    signups = venue.AppClient(app)
+    for player in players:
+        signups.request('POST', '/signup', player)
+
+    started = time.time()
+    deadline = started + args.duration
+    threads = [threading.Thread(target=operator, args=(venue.AppClient(app), args, stations, players, deadline, args.seed + i))
+               for i in range(args.operators)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print('{} operators, {} actions in {:.1f}s on {} stations and {} players'.format(
+        args.operators, args.operators * args.actions, time.time() - started, args.stations, args.players))
+    for action in ['assign', 'start', 'complete', 'cancel']:
+        print('{:<10}{:>8} applied'.format(action, sum(count for (email, name), count in transitions.applied.items() if name == action)))
+
+    problems = check(db, players, transitions)
+    for problem in problems:
+        print(problem)
+    print('FAIL' if problems else 'OK')
+    sys.exit(1 if problems else 0)
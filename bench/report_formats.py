@@ -0,0 +1,118 @@
+#!/usr/local/bin/python
+"""
+Rows per second of the report row formatters, before and after the
+precompiled formatters in app/reports.py, for the pipe, csv and json formats.
+
+    python bench/report_formats.py [rows]
+
+Runs on generated documents so it needs no database.
+"""
+
+import datetime
+import json
+import os
+import random
+import sys
+import time
+
+from bson import ObjectId
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+import reports
+
+
+def make_scores(count):
+    now = time.time()
+    scores = []
+    for i in range(count):
+        oid = ObjectId.from_datetime(datetime.datetime.utcfromtimestamp(now - random.randint(0, 86400)))
+        scores.append({
+            '_id': oid,
+            'email': 'player{}@example.com'.format(i % 500),
+            'displayName': 'Player {}'.format(i % 500),
+            'score': random.randint(0, 100000),
+            'easteregg': random.random() < 0.1
+        })
+    return scores
+
+
+def make_players(count):
+    now = datetime.datetime.utcnow()
+    return [{
+        '_id': 'player{}@example.com'.format(i),
+        'email': 'player{}@example.com'.format(i),
+        'firstName': 'First',
+        'lastName': 'Last',
+        'displayName': 'Player {}'.format(i),
+        'phone': '0400000000',
+        'postcode': '2000',
+        'hand': 'right',
+        'updatedAt': now - datetime.timedelta(seconds=i)
+    } for i in range(count)]
+
+
+# formatting as it was done inline in the routes before app/reports.py
+def legacy_score_line(score, seperator, newline):
+    return "{1}{0}{2}{0}{3}{0}{4}{0}{5}{6}".format(
+        seperator,
+        score['_id'].generation_time.isoformat(),
+        score.get('score', 0),
+        score.get('easteregg', False),
+        score.get('email',''),
+        score.get('displayName' ,''),
+        newline
+    )
+
+
+def legacy_score_json(score):
+    return json.dumps({
+        'time': score['_id'].generation_time.isoformat(),
+        'score': score.get('score', 0),
+        'easteregg': score.get('easteregg', False),
+        'email': score.get('email',''),
+        'displayName': score.get('displayName' ,''),
+    })
+
+
+def legacy_player_line(player, seperator):
+    return '{1}{0}{2}{0}{3}{0}{4}{0}{5}{0}{6}{0}{7}{0}{8}"\n'.format(
+        seperator,
+        player.get('updatedAt').isoformat(),
+        player.get('hand', 'both'),
+        player.get('email',''),
+        player.get('phone',''),
+        player.get('postcode',''),
+        player.get('displayName' ,''),
+        player.get('firstName' ,''),
+        player.get('lastName' ,'')
+    )
+
+
+def rate(rows, format_row):
+    started = time.perf_counter()
+    for row in rows:
+        format_row(row)
+    return len(rows) / (time.perf_counter() - started)
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    scores = make_scores(count)
+    players = make_players(count)
+
+    pipe = reports.score_line('|', '~~')
+    csv = reports.score_line(',', '\n')
+    player_pipe = reports.player_line('|')
+
+    cases = [
+        ('scores pipe', scores, lambda s: legacy_score_line(s, '|', '~~'), pipe),
+        ('scores csv', scores, lambda s: legacy_score_line(s, ',', '\n'), csv),
+        ('scores json', scores, legacy_score_json, lambda s: json.dumps(reports.score_json(s))),
+        ('players pipe', players, lambda p: legacy_player_line(p, '|'), player_pipe),
+    ]
+
+    print('{:<14}{:>14}{:>14}{:>9}'.format('format', 'before rows/s', 'after rows/s', 'speedup'))
+    for name, rows, before, after in cases:
+        before_rate = rate(rows, before)
+        after_rate = rate(rows, after)
+        print('{:<14}{:>14.0f}{:>14.0f}{:>8.2f}x'.format(name, before_rate, after_rate, after_rate / before_rate))
@@ -0,0 +1,69 @@
+#!/usr/local/bin/python
+"""
+Latency of POST /score/<station> with every station posting at once, run
+against a server started with INGEST_MODE=direct and again with
+INGEST_MODE=buffered to compare them.
+
+    python bench/score_ingest.py [url] [stations] [scores per station]
+
+Defaults to http://localhost:8080, 8 stations and 500 scores each.
+"""
+
+import sys
+import threading
+import time
+
+import requests
+
+
+def percentile(latencies, p):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100.0))]
+
+
+def play(url, station, count, latencies, errors):
+    session = requests.Session()
+    for i in range(count):
+        data = {
+            'email': 'bench{}-{}@example.com'.format(station, i % 50),
+            'displayName': 'Bench {} {}'.format(station, i % 50),
+            'score': i,
+            'easteregg': 'false'
+        }
+        started = time.perf_counter()
+        try:
+            r = session.post('{}/score/{}'.format(url, station), data=data, timeout=30)
+            ok = r.status_code == 200
+        except requests.RequestException:
+            ok = False
+        latencies.append(time.perf_counter() - started)
+        if not ok:
+            errors.append(station)
+
+
+if __name__ == '__main__':
+    url = sys.argv[1].rstrip('/') if len(sys.argv) > 1 else 'http://localhost:8080'
+    stations = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    count = int(sys.argv[3]) if len(sys.argv) > 3 else 500
+
+    latencies = []
+    errors = []
+    threads = [
+        threading.Thread(target=play, args=(url, station, count, latencies, errors))
+        for station in range(1, stations + 1)
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print('{} scores from {} stations in {:.1f}s, {:.0f} scores/s, {} errors'.format(
+        len(latencies), stations, elapsed, len(latencies) / elapsed, len(errors)))
+    print('{:>8}{:>8}{:>8}{:>8}  (ms)'.format('p50', 'p95', 'p99', 'max'))
+    print('{:>8.1f}{:>8.1f}{:>8.1f}{:>8.1f}'.format(
+        percentile(latencies, 50) * 1000,
+        percentile(latencies, 95) * 1000,
+        percentile(latencies, 99) * 1000,
+        latencies[-1] * 1000))
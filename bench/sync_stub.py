@@ -0,0 +1,204 @@
+#!/usr/local/bin/python
+"""
+The sync engine (app/sync_engine.py) against a stub destination, in single
+and in batch mode (SYNC_MODE).
+
+    python bench/sync_stub.py
+
+Runs the real SyncEngine on mongomock (pip install mongomock) against a
+local HTTP server that answers every row, or every /sync/batch request, with
+the status it is set to:
+- success: every row reaches the destination once and leaves the queue
+- 5xx backoff: while the destination fails, the engine waits longer and
+  longer between tries instead of polling every min interval, and sends
+  again straight away once it recovers
+- dead letters: a row the destination rejects (4xx, or invalid in a batch)
+  goes to sync_dead at once, and rows that keep failing with a 5xx go there
+  after max attempts
+
+Exits with 1 when a check fails.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+import mongomock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+import outbox
+from sync_engine import SyncEngine
+
+BATCH_URL = '/sync/batch'
+
+
+class Destination(HTTPServer):
+    """ Answers with status, except for the emails in rejected, and keeps what it accepted """
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.status = 200
+        self.rejected = set()
+        self.requests = 0
+        self.accepted = []
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def answer(self, status, body=''):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server
+        server.requests += 1
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+        if server.status != 200:
+            return self.answer(server.status, 'stub failing')
+
+        if self.path == BATCH_URL:
+            results = []
+            for req in json.loads(body):
+                email = req['data'].get('email')
+                if email in server.rejected:
+                    results.append({'id': req['id'], 'status': 'invalid', 'error': 'rejected'})
+                else:
+                    server.accepted.append(req['id'])
+                    results.append({'id': req['id'], 'status': 'ok'})
+            return self.answer(200, json.dumps({'results': results}))
+
+        if any('email={}'.format(email.replace('@', '%40')) in body for email in server.rejected):
+            return self.answer(400, 'rejected')
+        server.accepted.append(self.headers[outbox.IDEMPOTENCY_HEADER])
+        self.answer(200, 'ok')
+
+
+def queue(db, count, prefix, players=5):
+    rows = [outbox.row('/score/1', {'email': '{}-{}@example.com'.format(prefix, i % players), 'score': str(i)}) for i in range(count)]
+    db.sync.insert_many(rows)
+    return [str(row['_id']) for row in rows]
+
+
+def engine(db, destination, batch, **kwargs):
+    return SyncEngine(db, destination.url, workers=4, batch_size=20, timeout=5,
+                      batch_url=BATCH_URL if batch else None, **kwargs)
+
+
+def drain(sync, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        read, sent, failed = sync.run_once()
+        if not read:
+            return
+    raise Exception('the queue did not drain in {}s'.format(timeout))
+
+
+def run_for(sync, seconds):
+    thread = threading.Thread(target=sync.run)
+    thread.start()
+    time.sleep(seconds)
+    sync.stop()
+    thread.join()
+
+
+def check_success(destination, batch, expect):
+    db = mongomock.MongoClient()['marketcity']
+    destination.status = 200
+    destination.accepted = []
+    ids = queue(db, 50, 'success')
+    drain(engine(db, destination, batch))
+    expect(sorted(destination.accepted) == sorted(ids), 'every row accepted once, {} of {}'.format(len(destination.accepted), len(ids)))
+    expect(db.sync.count_documents({}) == 0, 'the queue is empty')
+
+
+def check_backoff(destination, batch, args, expect):
+    db = mongomock.MongoClient()['marketcity']
+    destination.status = 503
+    destination.requests = 0
+    # one player, so each try is one request in either mode
+    queue(db, 5, 'backoff', players=1)
+    sync = engine(db, destination, batch, min_interval=args.interval, max_backoff=args.max_backoff)
+    run_for(sync, args.duration)
+    polled = int(args.duration / args.interval)
+    expect(destination.requests * 4 < polled, '{} requests in {}s while failing, {} polling every {}s'.format(
+        destination.requests, args.duration, polled, args.interval))
+    expect(sync.failures >= 3, '{} failures in a row'.format(sync.failures))
+    expect(db.sync.count_documents({}) == 5 and db.sync_dead.count_documents({}) == 0, 'rows kept, with no max attempts')
+
+    destination.status = 200
+    sync = engine(db, destination, batch, min_interval=args.interval, max_backoff=args.max_backoff)
+    sync.wake()
+    run_for(sync, 0.5)
+    expect(db.sync.count_documents({}) == 0, 'rows sent once the destination recovers')
+
+
+def check_dead_letters(destination, batch, expect):
+    db = mongomock.MongoClient()['marketcity']
+    destination.status = 200
+    destination.rejected = {'dead-0@example.com'}
+    queue(db, 10, 'dead')
+    drain(engine(db, destination, batch))
+    expect(db.sync_dead.count_documents({}) == 2, 'rejected rows go to sync_dead at once, {} there'.format(db.sync_dead.count_documents({})))
+    destination.rejected = set()
+
+    db = mongomock.MongoClient()['marketcity']
+    destination.status = 500
+    # a player each, single mode only sends the oldest row of a player until it goes through
+    queue(db, 10, 'dead', players=10)
+    sync = engine(db, destination, batch, max_attempts=3)
+    for attempt in range(1, 4):
+        sync.run_once()
+        attempts = sorted(set(doc.get('attempts', 0) for doc in db.sync.find()) | set(doc['attempts'] for doc in db.sync_dead.find()))
+        expect(attempts == [attempt], 'attempt {} counted on every row, attempts {}'.format(attempt, attempts))
+    expect(db.sync.count_documents({}) == 0 and db.sync_dead.count_documents({}) == 10,
+           'failing rows go to sync_dead after 3 attempts, {} there'.format(db.sync_dead.count_documents({})))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the sync engine against a stub destination')
+    parser.add_argument('--interval', type=float, default=0.02, help='min interval of the engine in seconds')
+    parser.add_argument('--max-backoff', type=float, default=1, help='max backoff of the engine in seconds')
+    parser.add_argument('--duration', type=float, default=3, help='seconds to run against the failing destination')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    destination = Destination()
+    server = threading.Thread(target=destination.serve_forever)
+    server.daemon = True
+    server.start()
+
+    problems = []
+    for batch in [False, True]:
+        print('{} mode'.format('batch' if batch else 'single'))
+
+        def expect(ok, problem):
+            print('  {:<6}{}'.format('ok' if ok else 'FAIL', problem))
+            if not ok:
+                problems.append(problem)
+
+        check_success(destination, batch, expect)
+        check_backoff(destination, batch, args, expect)
+        check_dead_letters(destination, batch, expect)
+
+    destination.shutdown()
+    print('FAIL' if problems else 'OK')
+    sys.exit(1 if problems else 0)
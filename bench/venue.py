@@ -0,0 +1,373 @@
+#!/usr/local/bin/python
+"""
+A whole venue at once, to find how many stations and signups one container
+can take:
+- every station polls /station/<id>/player for its next player and posts a
+  score after each game
+- an operator per station assigns, starts and completes players on /next/<id>
+- signups arrive in bursts
+- staff download the reports and watch the station status
+
+    python bench/venue.py --url http://localhost:8080 [options]
+    python bench/venue.py --in-process [--mongomock] [options]
+
+--url runs against a server (uWSGI or the Flask dev server) and --in-process
+imports app/app.py and calls it with the Flask test client, against the
+mongod in MONGO_URI / MONGO_HOST or against mongomock with --mongomock.
+
+Prints requests per second, p50/p95/p99 latency and mongo commands per
+request of every route. Mongo commands are read from /metrics before and
+after the run, mongomock runs no commands so they show as 0.
+
+--save-baseline writes the results to a JSON file and --compare reads one
+back and flags routes whose --percentile (p50 by default, the p95 of a one
+minute run moves with a single slow request) got slower than --tolerance
+allows, of the routes with at least --min-requests requests, exiting with 1
+when any did. Both default to bench/venue-baseline.json, which is not
+committed: latencies only compare on the machine and setup they were
+measured on, so the first --compare run without a baseline saves its results
+as the baseline and later runs compare with it. A baseline only compares
+with runs of the same setup (in process on mongomock or mongod, or against
+a server).
+"""
+
+import argparse
+import collections
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import requests
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'venue-baseline.json')
+
+REPORTS = [
+    ('GET /scores', '/scores', '/scores'),
+    ('GET /scoresraw', '/scoresraw?output=csv', '/scoresraw'),
+    ('GET /players', '/players?output=csv', '/players'),
+    ('GET /stats', '/stats', '/stats'),
+]
+
+
+class HttpClient(object):
+
+    def __init__(self, url):
+        self.url = url
+        self.session = requests.Session()
+
+    def request(self, method, path, data=None):
+        r = self.session.request(method, self.url + path, data=data, timeout=30, allow_redirects=False)
+        return r.status_code, r.content
+
+
+class AppClient(object):
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        r = self.client.open(path, method=method, data=data)
+        return r.status_code, r.get_data()
+
+
+def in_process_app(use_mongomock):
+    # the app reads its settings when imported, metrics go to a directory of their own
+    os.environ.setdefault('METRICS_DIR', tempfile.mkdtemp(prefix='venue-metrics-'))
+    sys.path.insert(0, APP_DIR)
+    if use_mongomock:
+        import flask_pymongo
+        import mongomock
+
+        client = mongomock.MongoClient()
+
+        class MockPyMongo(object):
+            def __init__(self, app=None, *args, **kwargs):
+                self.cx = client
+                self.db = client['marketcity']
+
+        flask_pymongo.PyMongo = MockPyMongo
+    import app
+    return app.app
+
+
+def percentile(latencies, p):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100.0))]
+
+
+class Recorder(object):
+    """ Latency and errors of every request by route """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.defaultdict(int)
+        # route label to the Flask rule /metrics labels it with
+        self.rules = {}
+
+    def call(self, client, label, rule, method, path, data=None, ok=(200,)):
+        started = time.perf_counter()
+        try:
+            status, body = client.request(method, path, data)
+        except requests.RequestException:
+            status, body = None, b''
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.latencies[label].append(elapsed)
+            self.rules[label] = rule
+            if status not in ok:
+                self.errors[label] += 1
+        return status, body
+
+
+class Players(object):
+    """ Players signed up and waiting for an operator to pick them """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiting = collections.deque()
+        self._run = uuid.uuid4().hex[:6]
+        self._count = 0
+
+    def new(self):
+        with self._lock:
+            self._count += 1
+            n = self._count
+        return {
+            'email': 'venue-{}-{}@example.com'.format(self._run, n),
+            'firstName': 'Venue',
+            'lastName': str(n),
+            'displayName': 'Venue {}'.format(n),
+            'phone': '0400000000',
+            'postcode': '2000',
+            'hand': random.choice(['left', 'right'])
+        }
+
+    def add(self, player):
+        with self._lock:
+            self._waiting.append(player)
+
+    def take(self):
+        with self._lock:
+            return self._waiting.popleft() if self._waiting else None
+
+
+def signup(client, recorder, players):
+    player = players.new()
+    status, body = recorder.call(client, 'POST /signup', '/signup', 'POST', '/signup', player)
+    if status == 200:
+        players.add(player)
+
+
+def signup_bursts(make_client, recorder, players, args, deadline):
+    # bursts of players signing up at the same time, as when a group arrives
+    clients = [make_client() for i in range(args.burst_size)]
+    while time.time() < deadline:
+        threads = [threading.Thread(target=signup, args=(client, recorder, players)) for client in clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        time.sleep(max(0, min(args.burst_interval, deadline - time.time())))
+
+
+def station(make_client, recorder, players, args, station_id, deadline):
+    # the operator and the game of one station, one game after another
+    operator = make_client()
+    game = make_client()
+    next_path = '/next/{}'.format(station_id)
+    player_path = '/station/{}/player'.format(station_id)
+    score_path = '/score/{}'.format(station_id)
+
+    def manage(data=None):
+        if data is None:
+            return recorder.call(operator, 'GET /next/<station>', '/next/<station>', 'GET', next_path)
+        return recorder.call(operator, 'POST /next/<station>', '/next/<station>', 'POST', next_path, data, ok=(302,))
+
+    while time.time() < deadline:
+        manage()
+        player = players.take()
+        if player is None:
+            time.sleep(args.poll)
+            continue
+
+        who = {'email': player['email'], 'displayName': player['displayName']}
+        manage(who)
+
+        # the station polls until it sees the player it was given
+        while time.time() < deadline:
+            status, body = recorder.call(game, 'GET /station/<station>/player', '/station/<station>/player', 'GET', player_path, ok=(200, 204))
+            if body.startswith(player['email'].encode('utf-8')):
+                break
+            time.sleep(args.poll)
+
+        manage(dict(who, action='start'))
+        time.sleep(args.game)
+        recorder.call(game, 'POST /score/<station>', '/score/<station>', 'POST', score_path, {
+            'email': player['email'],
+            'displayName': player['displayName'],
+            'score': random.randint(0, 1000),
+            'easteregg': 'true' if random.random() < 0.05 else 'false'
+        })
+        manage(dict(who, action='complete'))
+
+
+def staff(make_client, recorder, args, deadline):
+    # report downloads and the station status dashboard
+    client = make_client()
+    while time.time() < deadline:
+        for label, path, rule in REPORTS:
+            recorder.call(client, label, rule, 'GET', path)
+        for station_id in range(1, args.stations + 1):
+            recorder.call(client, 'GET /station/<station>/status', '/station/<station>/status', 'GET', '/station/{}/status'.format(station_id))
+        time.sleep(max(0, min(args.report_interval, deadline - time.time())))
+
+
+MONGO_COMMANDS = re.compile(r'^marketcity_http_request_mongo_commands_(sum|count)\{route="([^"]*)"\} (\S+)$')
+
+
+def mongo_commands(client):
+    # {rule: [commands, requests]} from /metrics, added up over every process
+    status, body = client.request('GET', '/metrics')
+    totals = collections.defaultdict(lambda: [0.0, 0.0])
+    if status != 200:
+        return totals
+    for line in body.decode('utf-8').splitlines():
+        match = MONGO_COMMANDS.match(line)
+        if match:
+            totals[match.group(2)][0 if match.group(1) == 'sum' else 1] += float(match.group(3))
+    return totals
+
+
+def setup_name(args):
+    # what the results were measured against, baselines of another setup do not compare
+    if args.in_process:
+        return 'in-process mongomock' if args.mongomock else 'in-process mongod'
+    return 'server'
+
+
+def run(make_client, args):
+    recorder = Recorder()
+    players = Players()
+    setup = make_client()
+
+    for station_id in range(1, args.stations + 1):
+        setup.request('POST', '/station/{}'.format(station_id), {'status': 'Ready'})
+    for i in range(args.stations * 2):
+        signup(setup, recorder, players)
+
+    before = mongo_commands(setup)
+    deadline = time.time() + args.seconds
+    threads = [threading.Thread(target=signup_bursts, args=(make_client, recorder, players, args, deadline))]
+    threads += [threading.Thread(target=staff, args=(make_client, recorder, args, deadline))]
+    threads += [
+        threading.Thread(target=station, args=(make_client, recorder, players, args, station_id, deadline))
+        for station_id in range(1, args.stations + 1)
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    after = mongo_commands(setup)
+
+    results = {}
+    for label, latencies in recorder.latencies.items():
+        latencies.sort()
+        rule = recorder.rules[label]
+        commands = after[rule][0] - before[rule][0]
+        requests_seen = after[rule][1] - before[rule][1]
+        results[label] = {
+            'requests': len(latencies),
+            'errors': recorder.errors[label],
+            'rate': len(latencies) / elapsed,
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            # GET and POST of a route share the count in /metrics
+            'mongoCommands': commands / requests_seen if requests_seen else 0.0
+        }
+    return {'seconds': elapsed, 'stations': args.stations, 'setup': setup_name(args), 'routes': results}
+
+
+def report(results, baseline=None, tolerance=0.3, min_requests=50, percentile_name='p50'):
+    # prints the results, returns the routes slower than the baseline
+    # routes with fewer than min_requests requests are too few for their p95 to count
+    total = sum(route['requests'] for route in results['routes'].values())
+    print('{} stations, {} requests in {:.1f}s, {:.1f} req/s'.format(
+        results['stations'], total, results['seconds'], total / results['seconds']))
+    print('{:<32}{:>8}{:>7}{:>9}{:>9}{:>9}{:>9}{:>8}{:>12}'.format(
+        'route', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'mongo', percentile_name + ' vs base'))
+
+    regressions = []
+    for label in sorted(results['routes']):
+        route = results['routes'][label]
+        change = ''
+        base = (baseline or {}).get('routes', {}).get(label)
+        if base and base[percentile_name]:
+            ratio = route[percentile_name] / base[percentile_name] - 1
+            change = '{:+.0%}'.format(ratio)
+            if ratio > tolerance and min(route['requests'], base['requests']) >= min_requests:
+                change += ' !'
+                regressions.append(label)
+        print('{:<32}{:>8}{:>7}{:>9.1f}{:>9.1f}{:>9.1f}{:>9.1f}{:>8.1f}{:>12}'.format(
+            label, route['requests'], route['errors'], route['rate'],
+            route['p50'] * 1000, route['p95'] * 1000, route['p99'] * 1000, route['mongoCommands'], change))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate a venue of stations, operators, signups and reports')
+    parser.add_argument('--url', default='http://localhost:8080', help='server to run against')
+    parser.add_argument('--in-process', action='store_true', help='call app/app.py with the Flask test client instead of a server')
+    parser.add_argument('--mongomock', action='store_true', help='with --in-process, use mongomock instead of mongod')
+    parser.add_argument('--stations', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=60)
+    parser.add_argument('--game', type=float, default=5, help='seconds each game lasts')
+    parser.add_argument('--poll', type=float, default=0.5, help='seconds between station polls')
+    parser.add_argument('--burst-size', type=int, default=10, help='players signing up at once')
+    parser.add_argument('--burst-interval', type=float, default=10, help='seconds between signup bursts')
+    parser.add_argument('--report-interval', type=float, default=5, help='seconds between report downloads')
+    parser.add_argument('--save-baseline', nargs='?', const=BASELINE, help='write the results to this file')
+    parser.add_argument('--compare', nargs='?', const=BASELINE, help='compare with the results in this file')
+    parser.add_argument('--percentile', choices=['p50', 'p95', 'p99'], default='p50', help='latency compared with the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.3, help='slowdown over the baseline that counts as a regression')
+    parser.add_argument('--min-requests', type=int, default=50, help='fewest requests of a route for its latency to be compared')
+    args = parser.parse_args()
+
+    if args.in_process:
+        app = in_process_app(args.mongomock)
+        make_client = lambda: AppClient(app)
+    else:
+        url = args.url.rstrip('/')
+        make_client = lambda: HttpClient(url)
+
+    baseline = None
+    if args.compare and os.path.exists(args.compare):
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    elif args.compare and not args.save_baseline:
+        print('No baseline in {}, this run is saved as the baseline'.format(args.compare))
+        args.save_baseline = args.compare
+
+    if baseline and baseline.get('setup') != setup_name(args):
+        print('The baseline was measured {}, this run is {}'.format(baseline.get('setup'), setup_name(args)))
+
+    results = run(make_client, args)
+    regressions = report(results, baseline, args.tolerance, args.min_requests, args.percentile)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('Saved baseline to {}'.format(args.save_baseline))
+
+    if regressions:
+        print('{} regressed by more than {:.0%} on {}'.format(args.percentile, args.tolerance, ', '.join(regressions)))
+        sys.exit(1)